@@ -1,19 +1,46 @@
 # Demonstrates how to export service statistics to a CSV file.
 # ArcGIS Server 10.3 or higher
 
-# For HTTP calls
-import httplib, urllib, urllib2, json
+# For HTTP calls (pooled keep-alive connections shared by all the scripts)
+import httpclient, tokencache, json
+# For parsing large usage report responses as they arrive
+import jsonstream
+# For listing the services in the site
+import servicecatalog
+# For running from the command line or from a batch of jobs
+import exportjobs
+# For only fetching statistics newer than the ones fetched by earlier runs
+import statsstore
+# For CSV, Parquet or Arrow output of site-wide exports and their summary
+import reportoutput
 # For time-based functions
 import time, uuid
 # For system tools
 import sys, os
 # For reading passwords without echoing
 import getpass
-# For writing csv files
-import csv
+# For fetching report windows in parallel
+import threading
+try: import Queue
+except ImportError: import queue as Queue
 
-# Defines the entry point into the script
+# Long ranges are split into windows of this many minutes, each fetched through its own temporary report,
+# so the server never has to build one huge report (rounded to a multiple of the aggregation interval)
+window_minutes = 7 * 24 * 60
+# Number of temporary reports created and fetched at the same time
+fetch_thread_count = 4
+# Services per report when exporting all services of a site; each batch and window is a separate report
+report_batch_size = 100
+
+# Defines the entry point into the script; exports what the command line arguments ask for (see --help),
+# or asks for everything when there are none
 def main(argv=None):
+    if argv: job = exportjobs.parseArguments(argv, "Export service statistics to a CSV, Parquet or Arrow file.", interval=True, service=True)
+    else: job = askJob()
+    return runJob(job)
+
+# A function that asks for the inputs of an export
+def askJob():
     # Print some info
     print("")
     print("This tool demonstrates how to export service statistics to a CSV file.")
@@ -25,161 +52,277 @@ def main(argv=None):
     
     # Ask for server name
     serverName = raw_input("Enter server name: ")
-    serverPort = 6080 # assumes server is enabled for HTTP access, HTTPS only sites will require (minor) script changes
+    serverPort = 6080 # assumes server is enabled for HTTP access; run with --https --port 6443 for HTTPS only sites
 
     # Ask for FromTime
-    fromTime = 0
-    while fromTime == 0:
+    fromTime = None
+    while fromTime is None:
         fromTime = raw_input("Start date and time of report in YYYY-MM-DD HH:MM format (e.g. 2014-05-10 14:00): ")
-        # Convert input to Python struct_time and then to Unix timestamp in ms
-        try: fromTime = int(time.mktime(time.strptime(fromTime, '%Y-%m-%d %H:%M'))*1000) 
-        except:
-            print('Unable to parse input. Ensure date and time is in YYYY-MM-DD HH:MM format')
-            fromTime = 0
+        try: exportjobs.parseTime(fromTime)
+        except exportjobs.JobError as e:
+            print(e)
+            fromTime = None
     
     # Ask for ToTime
-    toTime = 0
-    while toTime == 0:
+    toTime = None
+    while toTime is None:
         toTime = raw_input("End date and time of report in YYYY-MM-DD HH:MM format (e.g. 2014-05-10 14:00): ")
-        # Convert input to Python struct_time and then to Unix timestamp in ms
-        try: toTime = int(time.mktime(time.strptime(toTime, '%Y-%m-%d %H:%M'))*1000)
-        except: 
-            print('Unable to parse input. Ensure date and time is in YYYY-MM-DD HH:MM format')
-            toTime = 0
+        try: exportjobs.parseTime(toTime)
+        except exportjobs.JobError as e:
+            print(e)
+            toTime = None
     
     # Ask for time interval
     interval = int(raw_input("Time interval to report statistics (in minutes): "))
     
     # Ask for service name
-    serviceName = raw_input("Service name and type.  If the service is nested in a folder, include the folder name (for example, planning/firehydrants.MapServer): ")
-    if not serviceName.startswith('services/'): serviceName = "services/" + serviceName
+    serviceName = raw_input("Service name and type, or * for all services in the site.  If the service is nested in a folder, include the folder name (for example, planning/firehydrants.MapServer): ")
     
-    # Ask for output csv file name
+    # Ask for output file name; site-wide exports to .parquet, .arrow and .feather files are written in those formats (requires pyarrow)
     fileName = raw_input("Enter the name of the output CSV file to be created: ")
+    
+    return { 'server' : serverName, 'port' : serverPort, 'user' : username, 'password' : password, 'from' : fromTime, 'to' : toTime,
+             'interval' : interval, 'service' : serviceName, 'output' : fileName }
+
+# A function that runs one export and returns the exit code: 0 when done, 1 when it failed and 2 for invalid inputs
+def runJob(job):
+    try:
+        fromTime = exportjobs.parseTime(job['from'])
+        toTime = exportjobs.parseTime(job['to'])
+        interval = int(job['interval'])
+    except (exportjobs.JobError, KeyError, ValueError) as e:
+        print("Invalid job: {0}".format(e))
+        return 2
+    siteURL = exportjobs.siteURL(job)
+
+    serviceName = job.get('service', '*')
+    if serviceName != '*' and not serviceName.startswith('services/'): serviceName = "services/" + serviceName
+    
+    fileName = job['output']
     if os.path.splitext(fileName)[1] == '': fileName = fileName + ".csv"
+    try: reportoutput.checkFormat(fileName)
+    except RuntimeError as e:
+        print(e)
+        return 2
     
     # Get a token
-    token = getToken(username, password, serverName, serverPort)
-    if token == "":
+    tokens = getToken(job['user'], job['password'], siteURL)
+    if not tokens:
         print("Could not generate a token with the username and password provided.")
-        return
-
-    # Construct URL to query the logs
-    statsCreateReportURL = "http://{0}:{1}/arcgis/admin/usagereports/add".format(serverName, serverPort)
-
-    # Create unique name for temp report
-    reportName = uuid.uuid4().hex 
-
-    # Create report JSON definition
-    statsDefinition = {'reportname' : reportName, 'since' : 'CUSTOM', 
-           'queries' : [{'resourceURIs' : [serviceName],
-           'metrics' : ['RequestCount', 'RequestsFailed', 'RequestsTimedOut', 
-           'RequestMaxResponseTime', 'RequestAvgResponseTime'] }],
-           'from' : fromTime, 'to': toTime, 'aggregationInterval' : interval,
-           'metadata' : {'temp' : True, 'tempTimer' : int(time.time() * 1000)}}
+        return 1
 
-    postdata = { 'usagereport' : json.dumps(statsDefinition) }
-    createReportResult = postAndLoadJSON(statsCreateReportURL, token, postdata)
+    # Get list of all services in all folders on site, or just the one asked for
+    if serviceName == '*': services = getServiceList(siteURL, tokens)
+    else: services = [serviceName]
     
-    # Query newly created report
-    statsQueryReportURL = "http://{0}:{1}/arcgis/admin/usagereports/{2}/data".format(serverName, serverPort, reportName)
-    postdata = { 'filter' : { 'machines' : '*'} }
-    reportData = postAndLoadJSON(statsQueryReportURL, token, postdata)
-    print(reportData)
+    # Query the statistics, in parallel batches of services and windows of the time range
+    metrics = ['RequestCount', 'RequestsFailed', 'RequestsTimedOut', 'RequestMaxResponseTime', 'RequestAvgResponseTime']
+    def fetch(resources, fetchFrom, fetchTo):
+        return fetchUsageReport(siteURL, tokens, resources, metrics, fetchFrom, fetchTo, interval)
+    
+    if statsstore.store_file:
+        # only the time slices missing from the local store are fetched from the server
+        print("Using statistics stored in {0}".format(statsstore.store_file))
+        store = statsstore.StatsStore(statsstore.store_file)
+        try: reportData = { 'report' : statsstore.fetchIncremental(store, siteURL, fetch, services, metrics, interval, fromTime, toTime) }
+        finally: store.close()
+    else:
+        reportData = { 'report' : fetch(services, fromTime, toTime) }
     
     # Get list of timeslices covered by this report
     timeslices = reportData['report']['time-slices']
-    print(timeslices)
+    
+    if serviceName == '*' or reportoutput.isColumnar(fileName):
+        # One row per service, metric and time slice, for all services in the site (or a Parquet or Arrow file)
+        reportoutput.writeLongFormat(fileName, reportData['report'])
+        
+        # and the total, maximum, mean and percentiles of every metric of every service next to it
+        name, ext = os.path.splitext(fileName)
+        header = ['Service Name', 'Metric', 'Total', 'Max', 'Mean'] + ['P{0}'.format(q) for q in reportoutput.percentiles]
+        rows = [[row['resourceURI'], row['metric-type'], row['total'], row['max'], row['mean']] + [row['p{0}'.format(q)] for q in reportoutput.percentiles]
+                for row in reportoutput.aggregate(reportData['report'])]
+        reportoutput.writeTable(name + '_summary' + ext, header, rows)
+        print("Export done!")
+        return 0
     
     header = [serviceName]
     for timeslice in timeslices:
         t = time.localtime(timeslice/1000.0)
         header.append(time.strftime('%Y-%m-%d %H:%M', t))
     
-    # Open output file
-    output = open(fileName, 'wb')
-    csvwriter = csv.writer(output, dialect='excel')
-    csvwriter.writerow(header)
+    # Dig into the report for the data for individual services, one row per metric
+    rows = [[serviceMetric['metric-type']] + serviceMetric['data'] for serviceMetric in reportData['report']['report-data'][0]]
+    reportoutput.writeTable(fileName, header, rows)
+    
+    print("Export done!")
+
+    return 0
+
+# A function that creates a temporary usage report for one window of time, returns its data and deletes it
+def fetchReportWindow(siteURL, tokens, queries, fromTime, toTime, interval=None):
+    # Construct URL to query the logs
+    statsCreateReportURL = "{0}/admin/usagereports/add".format(siteURL)
+
+    # Create unique name for temp report
+    reportName = uuid.uuid4().hex 
+
+    # Create report JSON definition
+    statsDefinition = {'reportname' : reportName, 'since' : 'CUSTOM', 'queries' : queries,
+           'from' : fromTime, 'to': toTime,
+           'metadata' : {'temp' : True, 'tempTimer' : int(time.time() * 1000)}}
+    if interval: statsDefinition['aggregationInterval'] = interval # otherwise the server picks one for the time range
+
+    try:
+        postdata = { 'usagereport' : json.dumps(statsDefinition) }
+        createReportResult = postAndLoadJSON(statsCreateReportURL, tokens, postdata)
+        
+        # Query newly created report
+        statsQueryReportURL = "{0}/admin/usagereports/{1}/data".format(siteURL, reportName)
+        postdata = { 'filter' : { 'machines' : '*'} }
+        return postAndStreamReport(statsQueryReportURL, tokens, postdata)
+    finally:
+        # Cleanup (delete) statistics report, also when creating or querying it failed
+        statsDeleteReportURL = "{0}/admin/usagereports/{1}/delete".format(siteURL, reportName)
+        try: deleteReportResult = postAndLoadJSON(statsDeleteReportURL, tokens)
+        except Exception: pass # the report was never created, or the server will expire the temp report itself
+
+# A function that fetches a usage report for many services and a (possibly long) time range as
+# several smaller reports in parallel and stitches their time slices back together in order
+def fetchUsageReport(siteURL, tokens, resources, metrics, fromTime, toTime, interval):
+    # Windows are a whole number of aggregation intervals so time slices line up across windows
+    windowMs = max(1, window_minutes // interval) * interval * 60 * 1000
+    windows = []
+    windowStart = fromTime
+    while windowStart < toTime:
+        windows.append((windowStart, min(windowStart + windowMs, toTime)))
+        windowStart += windowMs
+    
+    # Every batch of services in every window is a report of its own
+    batches = [resources[i:i + report_batch_size] for i in range(0, len(resources), report_batch_size)]
+    windowQueue = Queue.Queue()
+    for w, window in enumerate(windows):
+        for b, batch in enumerate(batches): windowQueue.put((w * len(batches) + b, batch, window))
+    reports = [None] * (len(batches) * len(windows)) # in window order, whichever thread fetches them first
+    errors = []
+    fetched = [0]
+    fetchedLock = threading.Lock()
     
-    # Dig into the report for the data for individual services
-    print(reportData)
-    for serviceMetric in reportData['report']['report-data'][0]:
-        name = serviceMetric['metric-type']
-        data = serviceMetric['data']
-        csvwriter.writerow([name] + data)
+    def fetchThread():
+        while True:
+            try: i, batch, (windowFrom, windowTo) = windowQueue.get_nowait()
+            except Queue.Empty: return
+            queries = [{ 'resourceURIs' : batch, 'metrics' : metrics }]
+            try: reports[i] = fetchReportWindow(siteURL, tokens, queries, windowFrom, windowTo, interval)
+            except Exception as e: errors.append(e)
+            with fetchedLock:
+                fetched[0] += 1
+                print("Fetched {0} of {1} reports".format(fetched[0], len(batches) * len(windows)))
     
-    output.close()
+    threadList = [threading.Thread(target=fetchThread) for i in range(min(fetch_thread_count, len(batches) * len(windows)))]
+    for thread in threadList: thread.start()
+    for thread in threadList: thread.join()
+    if errors: raise errors[0]
     
-    # Cleanup (delete) statistics report
-    statsDeleteReportURL = "http://{0}:{1}/arcgis/admin/usagereports/{2}/delete".format(serverName, serverPort, reportName)
-    deleteReportResult = postAndLoadJSON(statsDeleteReportURL, token)
+    # Stitch the reports together in window order; a slice on the boundary of two windows keeps the value of the earlier one
+    series = {} # (resourceURI, metric-type) -> { time slice : value }
+    for report in reports:
+        for serviceMetric in report['report-data'][0]:
+            values = series.setdefault((serviceMetric['resourceURI'], serviceMetric['metric-type']), {})
+            for t, value in zip(report['time-slices'], serviceMetric['data']):
+                if t not in values: values[t] = value
+    timeslices = sorted(set(t for values in series.values() for t in values))
     
-    print("Export done!")
-
-    return
+    # in the order the services and metrics were asked for
+    reportData = []
+    for resource in resources:
+        for metric in metrics:
+            values = series.get((resource, metric), {})
+            reportData.append({ 'resourceURI' : resource, 'metric-type' : metric, 'data' : [values.get(t) for t in timeslices] })
+    return { 'time-slices' : timeslices, 'report-data' : [reportData] }
 
 # A function that makes an HTTP POST request and returns the result JSON object
-def postAndLoadJSON(url, token = None, postdata = None):
+def postAndLoadJSON(url, tokens = None, postdata = None):
     if not postdata: postdata = {}
-    # Add token to POST data if not already present and supplied
-    if token and 'token' not in postdata: postdata['token'] = token 
     # Add JSON format specifier to POST data if not already present
     if 'f' not in postdata: postdata['f'] = 'json' 
     
-    # Encode data and POST to server
-    postdata = urllib.urlencode(postdata)
-    response = urllib2.urlopen(url, data = postdata)
-    
-    if (response.getcode() != 200):
-        response.close()
-        raise Exception('Error performing request to {0}'.format(url))
+    def post(token):
+        # Add token to POST data if supplied
+        if token: postdata['token'] = token
+        
+        # Encode data and POST to server
+        response = httpclient.post(url, postdata)
+        
+        if (response.getcode() != 200):
+            raise Exception('Error performing request to {0}'.format(url))
 
-    data = response.read()
-    response.close()
+        # Deserialize response into Python object; raises if the token has expired
+        result = tokencache.checkToken(response.json())
 
-    # Check that data returned is not an error object
-    if not assertJsonSuccess(data):          
-        raise Exception("Error returned by operation. " + data)
+        # Check that data returned is not an error object
+        if not assertJsonSuccess(result):
+            raise Exception("Error returned by operation. " + json.dumps(result))
 
-    # Deserialize response into Python object
-    return json.loads(data)
+        return result
 
-#A function to generate a token given username, password and the adminURL.
-def getToken(username, password, serverName, serverPort):
-    # Token URL is typically http://server[:port]/arcgis/admin/generateToken
-    tokenURL = "/arcgis/admin/generateToken"
-    
-    # URL-encode the token parameters
-    params = urllib.urlencode({'username': username, 'password': password, 'client': 'requestip', 'f': 'json'})
-    
-    headers = {"Content-type": "application/x-www-form-urlencoded", "Accept": "text/plain"}
+    # The token manager supplies a valid token and retries once with a new one if it has expired
+    if tokens: return tokens.call(post)
+    return post(None)
+
+# A function that POSTs for the data of a usage report and returns the report, parsing the response as it
+# arrives so the raw body of a large report is never held in memory; the report-data entries are collected
+# as they are parsed and the rest of the response is checked for errors without parsing it a second time
+def postAndStreamReport(url, tokens = None, postdata = None):
+    if not postdata: postdata = {}
+    if 'f' not in postdata: postdata['f'] = 'json'
+
+    def post(token):
+        if token: postdata['token'] = token
+
+        response = httpclient.postStream(url, postdata)
+        try:
+            if (response.getcode() != 200):
+                raise Exception('Error performing request to {0}'.format(url))
+
+            stream = jsonstream.JSONStream(response.iterChunks(), ('report', 'report-data', '*', '*'))
+            reportData = list(stream.items())
+
+            # An error response has no report data, only the error itself
+            result = tokencache.checkToken(stream.document)
+            if not assertJsonSuccess(result):
+                raise Exception("Error returned by operation. " + json.dumps(result))
+        finally: response.close()
+
+        report = result['report']
+        report['report-data'] = [reportData]
+        return report
+
+    if tokens: return tokens.call(post)
+    return post(None)
+
+# A function that enumerates all services in all folders on site; the folders are listed concurrently and
+# the catalog is shared with the rest of the script (and cached between runs, see servicecatalog.py)
+def getServiceList(siteURL, tokens):
+    return servicecatalog.getCatalog(siteURL + "/admin", tokens).resources()
     
-    # Connect to URL and post parameters
-    httpConn = httplib.HTTPConnection(serverName, serverPort)
-    httpConn.request("POST", tokenURL, params, headers)
+#A function to get a token manager given username, password and the site URL (e.g. https://server:6443/arcgis).
+def getToken(username, password, siteURL):
+    # Token URL is typically http://server[:port]/arcgis/admin/generateToken
+    tokenURL = "{0}/admin/generateToken".format(siteURL)
     
-    # Read response
-    response = httpConn.getresponse()
-    if (response.status != 200):
-        httpConn.close()
+    # The token manager generates a token now and refreshes it before it expires, so long
+    # exports don't fail partway through; see tokencache.py for caching tokens between runs
+    tokens = tokencache.getTokenManager(tokenURL, username, password)
+    try: tokens.getToken()
+    except Exception:
         print("Error while fetching tokens from admin URL. Please check the URL and try again.")
         return
-    else:
-        data = response.read()
-        httpConn.close()
-        
-        # Check that data returned is not an error object
-        if not assertJsonSuccess(data):            
-            return
-        
-        # Extract the toke from it
-        token = json.loads(data)       
-        return token['token']            
+    
+    return tokens
 
 #A function that checks that the input JSON object
 #  is not an error object.    
-def assertJsonSuccess(data):
-    obj = json.loads(data)
+def assertJsonSuccess(obj):
     if 'status' in obj and obj['status'] == "error":
         print("Error: JSON object returns an error. " + str(obj))
         return False
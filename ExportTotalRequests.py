@@ -1,19 +1,35 @@
 # Export total number of requests for all services in a site
 # ArcGIS Server 10.3 or higher
 
-# For HTTP calls
-import httplib, urllib, urllib2, json
-# For time-based functions
-import time, uuid
+# For generating and refreshing tokens
+import tokencache
+# For the temporary usage reports, shared with ExportServiceStats.py; report data is parsed as it arrives
+from ExportServiceStats import fetchReportWindow
+# For listing the services in the site
+import servicecatalog
+# For running from the command line or from a batch of jobs
+import exportjobs
+# For only fetching statistics newer than the ones fetched by earlier runs
+import statsstore
+# For totals computed over whole arrays and CSV, Parquet or Arrow output
+import reportoutput
 # For system tools
 import sys, os
 # For reading passwords without echoing
 import getpass
-# For writing csv files
-import csv
 
-# Defines the entry point into the script
+# Aggregation interval (in minutes) of the statistics kept in the local store, when one is used (see statsstore.py)
+store_interval = 60
+
+# Defines the entry point into the script; exports what the command line arguments ask for (see --help),
+# or asks for everything when there are none
 def main(argv=None):
+    if argv: job = exportjobs.parseArguments(argv, "Export the total number of requests for all services in a site.")
+    else: job = askJob()
+    return runJob(job)
+
+# A function that asks for the inputs of an export
+def askJob():
     # Print some info
     print("")
     print("This tool demonstrates how to export the total number of requests for all services in a site")
@@ -25,178 +41,103 @@ def main(argv=None):
     
     # Ask for server name
     serverName = raw_input("Enter server name: ")
-    serverPort = 6080 # assumes server is enabled for HTTP access, HTTPS only sites will require (minor) script changes
+    serverPort = 6080 # assumes server is enabled for HTTP access; run with --https --port 6443 for HTTPS only sites
 
     # Ask for FromTime
-    fromTime = 0
-    while fromTime == 0:
+    fromTime = None
+    while fromTime is None:
         fromTime = raw_input("Total requests from (YYYY-MM-DD HH:MM format, e.g. 2014-05-10 14:00): ")
-        # Convert input to Python struct_time and then to Unix timestamp in ms
-        try: fromTime = int(time.mktime(time.strptime(fromTime, '%Y-%m-%d %H:%M'))*1000) 
-        except:
-            print('Unable to parse input. Ensure date and time is in YYYY-MM-DD HH:MM format')
-            fromTime = 0
+        try: exportjobs.parseTime(fromTime)
+        except exportjobs.JobError as e:
+            print(e)
+            fromTime = None
     
     # Ask for ToTime
-    toTime = 0
-    while toTime == 0:
+    toTime = None
+    while toTime is None:
         toTime = raw_input("Total requests to (YYYY-MM-DD HH:MM format, e.g. 2014-05-10 14:00): ")
-        # Convert input to Python struct_time and then to Unix timestamp in ms
-        try: toTime = int(time.mktime(time.strptime(toTime, '%Y-%m-%d %H:%M'))*1000)
-        except: 
-            print('Unable to parse input. Ensure date and time is in YYYY-MM-DD HH:MM format')
-            toTime = 0
+        try: exportjobs.parseTime(toTime)
+        except exportjobs.JobError as e:
+            print(e)
+            toTime = None
     
-    # Ask for output csv file name
+    # Ask for output file name; .parquet, .arrow and .feather files are written in those formats (requires pyarrow)
     fileName = raw_input("Enter the name of the output CSV file to be created: ")
+    
+    return { 'server' : serverName, 'port' : serverPort, 'user' : username, 'password' : password, 'from' : fromTime, 'to' : toTime,
+             'output' : fileName }
+
+# A function that runs one export and returns the exit code: 0 when done, 1 when it failed and 2 for invalid inputs
+def runJob(job):
+    try:
+        fromTime = exportjobs.parseTime(job['from'])
+        toTime = exportjobs.parseTime(job['to'])
+    except (exportjobs.JobError, KeyError) as e:
+        print("Invalid job: {0}".format(e))
+        return 2
+    siteURL = exportjobs.siteURL(job)
+    
+    fileName = job['output']
     if os.path.splitext(fileName)[1] == '': fileName = fileName + ".csv"
+    try: reportoutput.checkFormat(fileName)
+    except RuntimeError as e:
+        print(e)
+        return 2
     
     # Get a token
-    token = getToken(username, password, serverName, serverPort)
-    if token == "":
+    tokens = getToken(job['user'], job['password'], siteURL)
+    if not tokens:
         print("Could not generate a token with the username and password provided.")
-        return
+        return 1
 
     # Get list of all services in all folders on sites
-    services = getServiceList(serverName, serverPort, token)
-    
-    # Construct URL to query the logs
-    statsCreateReportURL = "http://{0}:{1}/arcgis/admin/usagereports/add".format(serverName, serverPort)
-
-    # Create unique name for temp report
-    reportName = uuid.uuid4().hex 
-
-    # Create report JSON definition
-    statsDefinition = { 'reportname' : reportName, 'since' : 'CUSTOM', 
-           'queries' : [{ 'resourceURIs' : services,
-           'metrics' : ['RequestCount'] }],
-           'from' : fromTime, 'to': toTime, 
-           'metadata' : { 'temp' : True,
-           'tempTimer' : int(time.time() * 1000) } }
-
-    postdata = { 'usagereport' : json.dumps(statsDefinition) }
-    createReportResult = postAndLoadJSON(statsCreateReportURL, token, postdata)
-    
-    # Query newly created report
-    statsQueryReportURL = "http://{0}:{1}/arcgis/admin/usagereports/{2}/data".format(serverName, serverPort, reportName)
-    postdata = { 'filter' : { 'machines' : '*'} }
-    reportData = postAndLoadJSON(statsQueryReportURL, token, postdata)
+    services = getServiceList(siteURL, tokens)
+    
+    # Stored statistics need a fixed interval; otherwise the server picks one for the time range
+    interval = store_interval if statsstore.store_file else None
+    def fetch(resources, fetchFrom, fetchTo):
+        queries = [{ 'resourceURIs' : resources, 'metrics' : ['RequestCount'] }]
+        return fetchReportWindow(siteURL, tokens, queries, fetchFrom, fetchTo, interval)
+    
+    if statsstore.store_file:
+        # only the time slices missing from the local store are fetched from the server
+        print("Using statistics stored in {0}".format(statsstore.store_file))
+        store = statsstore.StatsStore(statsstore.store_file)
+        try: reportData = { 'report' : statsstore.fetchIncremental(store, siteURL, fetch, services, ['RequestCount'], interval, fromTime, toTime) }
+        finally: store.close()
+    else:
+        reportData = { 'report' : fetch(services, fromTime, toTime) }
     
-    # Get list of timeslices covered by this report
-    timeslices = reportData['report']['time-slices']
     header = ['Service Name', 'RequestCount']
     
-    # Open output file
-    output = open(fileName, 'wb')
-    csvwriter = csv.writer(output, dialect='excel')
-    csvwriter.writerow(header)
-    
-    # Dig into the report for the data for individual services
-    for serviceMetric in reportData['report']['report-data'][0]:
-        name = serviceMetric['resourceURI']
-        totalCount = 0
-        for count in serviceMetric['data']:
-            if count: totalCount += int(count)
-        csvwriter.writerow([name, totalCount])
-    
-    output.close()
-    
-    # Cleanup (delete) statistics report
-    statsDeleteReportURL = "http://{0}:{1}/arcgis/admin/usagereports/{2}/delete".format(serverName, serverPort, reportName)
-    deleteReportResult = postAndLoadJSON(statsDeleteReportURL, token)
+    # Sum the requests of every service; null time slices count as no requests
+    totals = reportoutput.aggregate(reportData['report'])
+    reportoutput.writeTable(fileName, header, [(total['resourceURI'], int(total['total'])) for total in totals])
     
     print("Export done!")
 
-    return
+    return 0
 
-# A function that makes an HTTP POST request and returns the result JSON object
-def postAndLoadJSON(url, token = None, postdata = None):
-    if not postdata: postdata = {}
-    # Add token to POST data if not already present and supplied
-    if token and 'token' not in postdata: postdata['token'] = token 
-    # Add JSON format specifier to POST data if not already present
-    if 'f' not in postdata: postdata['f'] = 'json' 
+# A function that enumerates all services in all folders on site; the folders are listed concurrently and
+# the catalog is shared with the rest of the script (and cached between runs, see servicecatalog.py)
+def getServiceList(siteURL, tokens):
+    return servicecatalog.getCatalog(siteURL + "/admin", tokens).resources()
     
-    # Encode data and POST to server
-    postdata = urllib.urlencode(postdata)
-    response = urllib2.urlopen(url, data = postdata)
-    
-    if (response.getcode() != 200):
-        response.close()
-        raise Exception('Error performing request to {0}'.format(url))
-
-    data = response.read()
-    response.close()
-
-    # Check that data returned is not an error object
-    if not assertJsonSuccess(data):          
-        raise Exception("Error returned by operation. " + data)
-
-    # Deserialize response into Python object
-    return json.loads(data)
-
-# A function that enumerates all services in all folders on site
-def getServiceList(serverName, serverPort, token):
-    rooturl = "http://{0}:{1}/arcgis/admin/services".format(serverName, serverPort)
-    
-    root = postAndLoadJSON(rooturl, token)
-    
-    services = [] 
-    for service in root['services']:
-        services.append("services/{0}.{1}".format(service['serviceName'], service['type']))
-    
-    folders = root['folders']
-    for folderName in folders:
-        folderurl = "{0}/{1}".format(rooturl, folderName)
-        folder = postAndLoadJSON(folderurl, token)
-        for service in folder['services']:
-            services.append("services/{0}/{1}.{2}".format(folderName, service['serviceName'], service['type']))
-    
-    return services
-    
-#A function to generate a token given username, password and the adminURL.
-def getToken(username, password, serverName, serverPort):
+#A function to get a token manager given username, password and the site URL (e.g. https://server:6443/arcgis).
+def getToken(username, password, siteURL):
     # Token URL is typically http://server[:port]/arcgis/admin/generateToken
-    tokenURL = "/arcgis/admin/generateToken"
+    tokenURL = "{0}/admin/generateToken".format(siteURL)
     
-    # URL-encode the token parameters
-    params = urllib.urlencode({'username': username, 'password': password, 'client': 'requestip', 'f': 'json'})
-    
-    headers = {"Content-type": "application/x-www-form-urlencoded", "Accept": "text/plain"}
-    
-    # Connect to URL and post parameters
-    httpConn = httplib.HTTPConnection(serverName, serverPort)
-    httpConn.request("POST", tokenURL, params, headers)
-    
-    # Read response
-    response = httpConn.getresponse()
-    if (response.status != 200):
-        httpConn.close()
+    # The token manager generates a token now and refreshes it before it expires, so long
+    # exports don't fail partway through; see tokencache.py for caching tokens between runs
+    tokens = tokencache.getTokenManager(tokenURL, username, password)
+    try: tokens.getToken()
+    except Exception:
         print("Error while fetching tokens from admin URL. Please check the URL and try again.")
         return
-    else:
-        data = response.read()
-        httpConn.close()
-        
-        # Check that data returned is not an error object
-        if not assertJsonSuccess(data):            
-            return
-        
-        # Extract the toke from it
-        token = json.loads(data)       
-        return token['token']            
-
-#A function that checks that the input JSON object
-#  is not an error object.    
-def assertJsonSuccess(data):
-    obj = json.loads(data)
-    if 'status' in obj and obj['status'] == "error":
-        print("Error: JSON object returns an error. " + str(obj))
-        return False
-    else:
-        return True
     
-        
+    return tokens
+
 # Script start
 if __name__ == "__main__":
     sys.exit(main(sys.argv[1:]))
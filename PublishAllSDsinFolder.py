@@ -3,29 +3,55 @@
 # Latest here: https://github.com/Cintruenigo/ArcGIS-Server-Stuff/blob/master/PublishAllSDsinFolder
 # Pieces liberally borrowed from portalpy at https://github.com/esri/portalpy
 
-import os, sys, time
-import urllib, urllib2, urlparse, httplib, json
+import os, sys, time, hashlib
+import urlparse, json
 import mimetools, mimetypes
 from cStringIO import StringIO
-import threading, Queue
+import threading, Queue, heapq, multiprocessing, argparse
+import httpclient, tokencache, atomicfile
 
-thread_count = 2
+thread_count = 2 # number of .sd files uploaded in parallel; publishing jobs are sized from the server's capacity
+poll_interval = 2 # minimum seconds between checks of the status of a running publishing job
+poll_max_interval = 30 # maximum seconds between checks of the status of a long running publishing job
+poll_backoff_factor = 0.25 # a job is next checked after this fraction of the time it has been running
+poll_thread_count = 8 # maximum number of job status requests in flight at the same time
+poll_max_failures = 10 # a job whose status can't be read this many times in a row is counted as failed
+upload_chunk_size = 1024 * 1024 # bytes read from disk and sent per write when uploading .sd files
+upload_in_parts_threshold = 500 * 1024 * 1024 # .sd files at least this large are uploaded in resumable parts; None disables
+upload_part_size = 50 * 1024 * 1024 # size of each part when uploading in parts
+upload_part_thread_count = 4 # number of parts of a single .sd sent in parallel
+upload_journal_folder = os.path.join(os.path.expanduser('~'), '.publishallsds', 'uploads') # tracks parts already sent
+manifest_folder = os.path.join(os.path.expanduser('~'), '.publishallsds', 'published') # hashes of the .sd files last published per server
+history_file = os.path.join(os.path.expanduser('~'), '.publishallsds', 'history.json') # durations of earlier runs, to order the queue
+default_upload_rate = 10 * 1024 * 1024 # bytes per second assumed for uploads until a run has measured the rate
+default_publish_seconds = 30 # seconds assumed per publishing job, plus the size based part below, until a run has measured one
+default_publish_rate = 50 * 1024 * 1024 # bytes of .sd published per second assumed until a run has measured the rate
+timings_file = os.path.join(os.path.expanduser('~'), '.publishallsds', 'timings.jsonl') # phase timings of every .sd and run, as JSON lines
+hash_thread_count = multiprocessing.cpu_count() # .sd files hashed at the same time; hashlib releases the GIL, so this uses every core
 printLock = threading.Lock()
-serviceDefinitionQueue = Queue.Queue()
-publishedQueue = Queue.Queue();
+serviceDefinitionQueue = Queue.PriorityQueue() # (-estimated seconds, sdpath) waiting to be uploaded, most expensive first
+uploadedQueue = Queue.PriorityQueue() # (-estimated seconds, itemid, sdpath) uploaded and waiting for a free publishing slot
+pendingJobs = {} # jobid -> (sdpath, submitted time, failed status checks in a row) for publishing jobs submitted and not yet finished
+pendingJobsSchedule = [] # heap of (next status check time, jobid) for the pending jobs; a jobid of None stops a poller
+pendingJobsCondition = threading.Condition() # guards both of the above, notified when a check is scheduled
+publishedQueue = Queue.Queue() # (jobid, sdpath) published successfully
 failedQueue = Queue.Queue()
+publishedManifest = {} # sdpath -> { sha256, size, published } of the .sd files published successfully to the server
+plannedHashes = {} # sdpath -> sha256 of the .sd files queued for publishing this run
+manifestLock = threading.Lock()
+runTimings = {} # sdpath -> timings of the phases of publishing the .sd this run, see _finishTiming
+runTimingsLock = threading.Lock() # also guards appending to timings_file
 
 def getToken(baseurl, username, password):
     url = urlparse.urljoin(baseurl, '/arcgis/admin/generateToken')
 
-    """ Generates and returns a new token. """
-    postdata = { 'username': username, 'password': password,
-                 'client': 'requestip', 'expiration': 60, 'f': 'json' }
+    """ Returns the token manager that hands out (and refreshes) tokens for the site. """
+    tokens = tokencache.getTokenManager(url, username, password, expiration=60)
 
-    resp_json = _post(url, postdata)
-    
-    if resp_json: return resp_json['token']
-    raise Exception('Unable to authenticate with ArcGIS Server to retrieve token')
+    try: tokens.getToken()
+    except: raise Exception('Unable to authenticate with ArcGIS Server to retrieve token')
+
+    return tokens
 
 def _tostr(obj):
     if not obj:
@@ -38,145 +64,511 @@ def _get_content_type(filename):
     return mimetypes.guess_type(filename)[0] or 'application/octet-stream'
 
 def _encode_multipart_formdata(fields, files):
+    # the body is returned as a list of parts rather than a single string so that (potentially multi-GB) .sd
+    # files never have to be read into memory: string parts are sent as-is, (filepath, offset, length) parts
+    # are streamed from disk. files entries may carry an optional (offset, length) to send only a slice of a file
     boundary = mimetools.choose_boundary()
+    parts = []
     buf = StringIO()
     for (key, value) in fields.iteritems():
         buf.write('--%s\r\n' % boundary)
         buf.write('Content-Disposition: form-data; name="%s"' % key)
         buf.write('\r\n\r\n' + _tostr(value) + '\r\n')
-    for (key, filepath, filename) in files:
+    for file in files:
+        (key, filepath, filename) = file[:3]
+        if len(file) > 3: (offset, size) = file[3:]
+        else: (offset, size) = (0, os.path.getsize(filepath))
         buf.write('--%s\r\n' % boundary)
         buf.write('Content-Disposition: form-data; name="%s"; filename="%s"\r\n' % (key, filename))
         buf.write('Content-Type: %s\r\n' % (_get_content_type(filename)))
-        f = open(filepath, "rb")
-        try:
-            buf.write('\r\n' + f.read() + '\r\n')
-        finally:
-            f.close()
+        buf.write('\r\n')
+        parts.append(buf.getvalue())
+        parts.append((filepath, offset, size))
+        buf = StringIO()
+        buf.write('\r\n')
     buf.write('--' + boundary + '--\r\n\r\n')
-    buf = buf.getvalue()
-    return boundary, buf
+    parts.append(buf.getvalue())
+
+    # compute the content length up front so the body can be sent without chunked transfer encoding
+    length = 0
+    for part in parts:
+        if isinstance(part, tuple): length += part[2]
+        else: length += len(part)
+
+    return boundary, parts, length
 
-def _post(url, postdata):
+def _readfile(filepath, offset, length):
+    f = open(filepath, 'rb')
+    try:
+        f.seek(offset)
+        while length > 0:
+            chunk = f.read(min(upload_chunk_size, length))
+            if not chunk: raise Exception('Unexpected end of file {0}'.format(filepath))
+            yield chunk
+            length -= len(chunk)
+    finally:
+        f.close()
+
+def _post(url, postdata, tokens=None):
     if 'f' not in postdata: postdata['f'] = 'json' # add json format parameter if format not already specified
-    encoded_postdata = urllib.urlencode(postdata)
-    opener = urllib2.build_opener()
-    resp = opener.open(url, data=encoded_postdata)
-    resp_data = resp.read() # read raw response
-    resp_json = json.loads(resp_data) # parse json response
-    
-    return resp_json
-    
-def _postmultipart(host, selector, fields, files, ssl):
-    boundary, body = _encode_multipart_formdata(fields, files)
-    headers = { 'Content-Type': 'multipart/form-data; boundary={0}'.format(boundary) }
-    if ssl: h = httplib.HTTPSConnection(host)
-    else: h = httplib.HTTPConnection(host)
+    if tokens: return tokens.postJSON(url, postdata) # adds the token, retries once if it has expired
+    return httpclient.postJSON(url, postdata) # pooled keep-alive connection, parsed json response
+
+def _postmultipartJSON(url, fields, files, tokens):
+    # a token that expired mid-upload means the whole request has to be sent again, with a fresh token
+    def post(token):
+        return tokencache.checkToken(json.loads(_postmultipart(url, dict(fields, token=token), files)))
+    return tokens.call(post)
     
-    h.request('POST', selector, body, headers)
-    resp = h.getresponse()
+def _postmultipart(url, fields, files):
+    boundary, parts, length = _encode_multipart_formdata(fields, files)
+    headers = { 'Content-Type': 'multipart/form-data; boundary={0}'.format(boundary), 'Content-Length': str(length) }
+
+    # send the body piece by piece so memory use stays flat regardless of the file size
+    def body():
+        for part in parts:
+            if isinstance(part, tuple):
+                for chunk in _readfile(*part): yield chunk
+            else: yield part
+
+    resp = httpclient.request('POST', url, body, headers)
 
     return resp.read()
 
-def uploadFile(baseurl, token, file):
+def uploadFile(baseurl, tokens, file):
     url = urlparse.urljoin(baseurl, '/arcgis/admin/uploads/upload')
 
     files = [('itemFile', file, os.path.split(file)[1])]
-    fields = { 'token' : token, 'f' : 'json' }
+    fields = { 'f' : 'json' }
 
-    ssl = url.startswith('https://')
-    
-    parsed_url = urlparse.urlparse(url)
-    
-    resp = _postmultipart(parsed_url.netloc, str(parsed_url.path), fields, files, ssl)
-    resp_json = json.loads(resp)
+    resp_json = _postmultipartJSON(url, fields, files, tokens)
     
     try: return resp_json['item']['itemID']
     except: raise Exception('Unable to upload file {0}'.format(file))
 
-def getPublishingServiceMaxInstances(baseurl, token):
+def registerUpload(baseurl, tokens, file):
+    url = urlparse.urljoin(baseurl, '/arcgis/admin/uploads/register')
+
+    resp_json = _post(url, { 'itemName' : os.path.split(file)[1] }, tokens)
+
+    try: return resp_json['item']['itemID']
+    except: raise Exception('Unable to register upload of file {0}'.format(file))
+
+def uploadPart(baseurl, tokens, itemid, file, partNumber, offset, length):
+    url = urlparse.urljoin(baseurl, '/arcgis/admin/uploads/{0}/uploadPart'.format(itemid))
+
+    files = [('partFile', file, os.path.split(file)[1], offset, length)]
+    fields = { 'f' : 'json', 'partNumber' : partNumber }
+
+    resp_json = _postmultipartJSON(url, fields, files, tokens)
+
+    if resp_json.get('status') != 'success':
+        raise Exception('Unable to upload part {0} of file {1}'.format(partNumber, file))
+
+def commitUpload(baseurl, tokens, itemid, partNumbers):
+    url = urlparse.urljoin(baseurl, '/arcgis/admin/uploads/{0}/commit'.format(itemid))
+
+    resp_json = _post(url, { 'parts' : ','.join(map(str, partNumbers)) }, tokens)
+
+    if resp_json.get('status') != 'success':
+        raise Exception('Unable to commit upload {0}'.format(itemid))
+
+def uploadExists(baseurl, tokens, itemid):
+    url = urlparse.urljoin(baseurl, '/arcgis/admin/uploads/{0}'.format(itemid))
+
+    try: resp_json = _post(url, {}, tokens)
+    except: return False
+
+    return 'error' not in resp_json and resp_json.get('status') != 'error'
+
+def _uploadJournalPath(baseurl, file):
+    key = '{0}|{1}'.format(baseurl, os.path.abspath(file))
+    return os.path.join(upload_journal_folder, hashlib.md5(key).hexdigest() + '.json')
+
+def _loadUploadJournal(baseurl, file):
+    # a journal is only valid for the exact same file it was written for; anything else starts over
+    journalPath = _uploadJournalPath(baseurl, file)
+    if not os.path.exists(journalPath): return None
+
+    try:
+        with open(journalPath, 'r') as f: journal = json.load(f)
+    except: return None
+
+    stat = os.stat(file)
+    if journal.get('size') != stat.st_size or journal.get('mtime') != int(stat.st_mtime): return None
+
+    return journal
+
+def _saveUploadJournal(baseurl, file, journal):
+    if not os.path.isdir(upload_journal_folder): os.makedirs(upload_journal_folder)
+    atomicfile.writeAtomically(_uploadJournalPath(baseurl, file), lambda f: json.dump(journal, f))
+
+def _removeUploadJournal(baseurl, file):
+    journalPath = _uploadJournalPath(baseurl, file)
+    if os.path.exists(journalPath): os.remove(journalPath)
+
+def uploadFileInParts(baseurl, tokens, file):
+    # resume a previous upload of this file if one was journaled and the server still has the item
+    journal = _loadUploadJournal(baseurl, file)
+    if journal and not uploadExists(baseurl, tokens, journal['itemID']): journal = None
+
+    if not journal:
+        stat = os.stat(file)
+        journal = { 'file' : os.path.abspath(file), 'size' : stat.st_size, 'mtime' : int(stat.st_mtime),
+                    'partSize' : upload_part_size, 'itemID' : registerUpload(baseurl, tokens, file), 'parts' : [] }
+        _saveUploadJournal(baseurl, file, journal)
+
+    itemid = journal['itemID']
+    partSize = journal['partSize']
+    partCount = max(1, (journal['size'] + partSize - 1) // partSize)
+
+    partQueue = Queue.Queue()
+    for partNumber in range(1, partCount + 1):
+        if partNumber not in journal['parts']: partQueue.put(partNumber)
+
+    journalLock = threading.Lock()
+    failedParts = []
+
+    def partUploaderThread():
+        while True:
+            try: partNumber = partQueue.get_nowait()
+            except Queue.Empty: return
+
+            offset = (partNumber - 1) * partSize
+            try:
+                uploadPart(baseurl, tokens, itemid, file, partNumber, offset, min(partSize, journal['size'] - offset))
+                with journalLock:
+                    journal['parts'].append(partNumber)
+                    _saveUploadJournal(baseurl, file, journal)
+            except Exception as e:
+                with journalLock: failedParts.append((partNumber, e))
+
+    thread_list = []
+    for i in range(min(upload_part_thread_count, partQueue.qsize())):
+        t = threading.Thread(target=partUploaderThread)
+        t.daemon = True
+        thread_list.append(t)
+
+    for thread in thread_list: thread.start()
+    for thread in thread_list: thread.join()
+
+    if failedParts:
+        raise Exception('Unable to upload {0} of {1} parts of file {2}; the upload will resume on the next run'.format(len(failedParts), partCount, file))
+
+    commitUpload(baseurl, tokens, itemid, range(1, partCount + 1))
+    _removeUploadJournal(baseurl, file)
+
+    return itemid
+
+def getPublishingServiceMaxInstances(baseurl, tokens):
     url = urlparse.urljoin(baseurl, '/arcgis/admin/services/System/PublishingTools.GPServer')
     
-    resp_json = _post(url, { 'token' : token })
+    resp_json = _post(url, {}, tokens)
     
     return int(resp_json['maxInstancesPerNode'])
     
-def publishService(baseurl, token, itemid):
+def getMachineCount(baseurl, tokens):
+    url = urlparse.urljoin(baseurl, '/arcgis/admin/machines')
+
+    try: return max(1, len(_post(url, {}, tokens)['machines']))
+    except: return 1 # assume a single machine site if the machine list can't be read
+
+def publishService(baseurl, tokens, itemid):
     url = urlparse.urljoin(baseurl, '/arcgis/rest/services/System/PublishingTools/GPServer/Publish%20Service%20Definition/submitJob')
     
-    postdata = { 'token': token, 'f': 'json', 'in_sdp_id' : itemid }
+    postdata = { 'f': 'json', 'in_sdp_id' : itemid }
 
-    encoded_postdata = urllib.urlencode(postdata)
-    opener = urllib2.build_opener()
-    resp = opener.open(url, data=encoded_postdata)
-    resp_data = resp.read() # read raw response
-    resp_json = json.loads(resp_data) # parse json response
+    resp_json = _post(url, postdata, tokens)
 
     if not resp_json: raise Exception('Unable to publish item {0}'.format(itemid))
     
     return resp_json['jobId']
 
-def getPublishingJobStatus(baseurl, token, jobid):
+def getPublishingJob(baseurl, tokens, jobid):
+    # the job's jobStatus and the messages it logged so far
     url = urlparse.urljoin(baseurl, '/arcgis/rest/services/System/PublishingTools/GPServer/Publish%20Service%20Definition/jobs/' + jobid)
-    postdata = { 'token' : token }
-    resp_json = _post(url, postdata)
-    status = resp_json['jobStatus']
-    return status
+    resp_json = _post(url, {}, tokens)
+    if 'jobStatus' not in resp_json: raise Exception('Unable to check publishing job {0}'.format(jobid))
+    return resp_json
+
+def _jobMessages(job):
+    # the errors and warnings of a job, or everything it logged if there are none
+    messages = job.get('messages', [])
+    important = [message for message in messages if message.get('type') in ('esriJobMessageTypeError', 'esriJobMessageTypeWarning')]
+    return [message.get('description') for message in (important or messages)]
     
-def main(path, baseurl, username, password):
-    token = getToken(baseurl, username, password)
+def findServiceDefinitions(path):
+    # all service definition files within the input folder and its subdirectories, or the input file itself
+    if os.path.isfile(path): return [os.path.abspath(path)]
+    serviceDefinitionFiles = []
+    for root, subFolders, files in os.walk(path):
+        for fname in files:
+            extension = os.path.splitext(fname)[1][1:].strip().lower()
+            if extension == 'sd': serviceDefinitionFiles.append(os.path.abspath(os.path.join(root, fname)))
+    return serviceDefinitionFiles
 
+def hashFile(file):
+    digest = hashlib.sha256()
+    for chunk in _readfile(file, 0, os.path.getsize(file)): digest.update(chunk) # streamed, never the whole file in memory
+    return digest.hexdigest()
+
+def hashFiles(files):
+    # returns sdpath -> sha256, hashing hash_thread_count files at the same time
+    pending = list(reversed(files))
+    hashes = {}
+    errors = []
+    lock = threading.Lock()
+
+    def hasherThread():
+        while True:
+            with lock:
+                if not pending: return
+                file = pending.pop()
+            try: digest = hashFile(file)
+            except Exception as e:
+                with lock: errors.append(e)
+                return
+            with lock: hashes[file] = digest
+
+    thread_list = [threading.Thread(target=hasherThread) for i in range(min(hash_thread_count, len(files)))]
+    for thread in thread_list: thread.start()
+    for thread in thread_list: thread.join()
+    if errors: raise errors[0]
+    return hashes
+
+def _manifestPath(baseurl):
+    return os.path.join(manifest_folder, hashlib.md5(baseurl.rstrip('/')).hexdigest() + '.json')
+
+def loadManifest(baseurl):
+    manifestPath = _manifestPath(baseurl)
+    if not os.path.exists(manifestPath): return {}
+
+    try:
+        with open(manifestPath, 'r') as f: return json.load(f)['published']
+    except: return {} # corrupt manifest, publish everything again
+
+def saveManifest(baseurl, manifest):
+    if not os.path.isdir(manifest_folder): os.makedirs(manifest_folder)
+    atomicfile.writeAtomically(_manifestPath(baseurl), lambda f: json.dump({ 'baseurl' : baseurl, 'published' : manifest }, f, indent=1))
+
+def planPublishing(files, hashes, manifest):
+    # returns (sdpath, 'new' | 'changed' | 'unchanged') per .sd, compared with what was last published
+    plan = []
+    for file in files:
+        published = manifest.get(file)
+        if not published: plan.append((file, 'new'))
+        elif published.get('sha256') != hashes[file]: plan.append((file, 'changed'))
+        else: plan.append((file, 'unchanged'))
+    return plan
+
+def _recordPublished(baseurl, sdpath):
+    # saved after every service so an interrupted run doesn't publish the same services again
+    with manifestLock:
+        publishedManifest[sdpath] = { 'sha256' : plannedHashes[sdpath], 'size' : os.path.getsize(sdpath), 'published' : int(time.time()) }
+        saveManifest(baseurl, publishedManifest)
+
+def loadHistory(baseurl):
+    # sdpath -> { size, uploadSeconds, publishSeconds } of the last time each .sd was published to the server
+    if not os.path.exists(history_file): return {}
+
+    try:
+        with open(history_file, 'r') as f: return json.load(f).get(baseurl.rstrip('/'), {})
+    except: return {} # corrupt history, fall back on the defaults
+
+def saveHistory(baseurl, durations):
+    history = {}
+    if os.path.exists(history_file):
+        try:
+            with open(history_file, 'r') as f: history = json.load(f)
+        except: pass
+    serverHistory = history.setdefault(baseurl.rstrip('/'), {})
+    for sdpath, measured in durations.items():
+        serverHistory.setdefault(sdpath, {}).update((key, measured[key]) for key in ('size', 'uploadSeconds', 'publishSeconds') if key in measured)
+
+    if not os.path.isdir(os.path.dirname(history_file)): os.makedirs(os.path.dirname(history_file))
+    atomicfile.writeAtomically(history_file, lambda f: json.dump(history, f))
+
+def estimateDurations(files, history):
+    # returns sdpath -> (upload seconds, publish seconds); publish durations recorded for the same .sd are used as is,
+    # everything else is estimated from the file size and the rates measured over the whole history
+    uploaded = [entry for entry in history.values() if entry.get('uploadSeconds')]
+    published = [entry for entry in history.values() if entry.get('publishSeconds')]
+    uploadRate = sum(entry['size'] for entry in uploaded) / sum(entry['uploadSeconds'] for entry in uploaded) if uploaded else default_upload_rate
+    publishSecondsPerByte = sum(entry['publishSeconds'] for entry in published) / float(sum(entry['size'] for entry in published) or 1) if published else None
+
+    estimates = {}
+    for file in files:
+        size = os.path.getsize(file)
+        if history.get(file, {}).get('publishSeconds'): publishSeconds = history[file]['publishSeconds']
+        elif publishSecondsPerByte is not None: publishSeconds = size * publishSecondsPerByte
+        else: publishSeconds = default_publish_seconds + size / float(default_publish_rate)
+        estimates[file] = (size / float(uploadRate), publishSeconds)
+    return estimates
+
+def predictMakespan(durations, uploaderCount, publishingCapacity):
+    # simulates the pipeline for (upload seconds, publish seconds) in queue order: each .sd goes to the first free
+    # uploader, then to the first free publishing slot once uploaded
+    uploaders = [0.0] * uploaderCount
+    slots = [0.0] * publishingCapacity
+    for uploadSeconds, publishSeconds in durations:
+        uploaded = heapq.heappop(uploaders) + uploadSeconds
+        heapq.heappush(uploaders, uploaded)
+        heapq.heappush(slots, max(heapq.heappop(slots), uploaded) + publishSeconds)
+    return max(slots)
+
+def _recordTiming(sdpath, **measured):
+    with runTimingsLock: runTimings.setdefault(sdpath, { 'sd' : sdpath, 'size' : os.path.getsize(sdpath) }).update(measured)
+
+def _recordPoll(sdpath, jobStatus, seconds):
+    # polling overhead: the status requests made and the time spent on them; and when the job was first seen executing
+    with runTimingsLock:
+        timing = runTimings[sdpath]
+        timing['pollCount'] = timing.get('pollCount', 0) + 1
+        timing['pollSeconds'] = timing.get('pollSeconds', 0) + seconds
+        if jobStatus == 'esriJobExecuting' and 'executingSeen' not in timing: timing['executingSeen'] = time.time()
+        timing['previousPoll'], timing['lastPoll'] = timing.get('lastPoll'), time.time()
+
+def _finishTiming(baseurl, sdpath, status, messages=None):
+    # completes the timings of a .sd and appends them to timings_file as one JSON line:
+    # uploadSeconds / uploadBytesPerSecond   sending the .sd
+    # slotWaitSeconds                        uploaded, waiting for a free publishing instance
+    # submitSeconds                          latency of submitJob
+    # jobSeconds                             submitted until seen finished, split into
+    # jobWaitingSeconds / jobExecutingSeconds  submitted until first seen executing / from then until seen finished
+    # pollCount / pollSeconds / detectionDelaySeconds  status requests, time spent on them and the most the end
+    #                                        of the job can have gone unnoticed (time since the check before last)
+    # totalSeconds                           from the start of the upload until the job was seen finished
+    finished = time.time()
+    with runTimingsLock:
+        timing = runTimings.setdefault(sdpath, { 'sd' : sdpath, 'size' : os.path.getsize(sdpath) })
+        timing.update({ 'server' : baseurl, 'status' : status, 'messages' : messages or [], 'finished' : finished })
+        if 'uploadStarted' in timing: timing['totalSeconds'] = finished - timing['uploadStarted']
+        if 'submitted' in timing:
+            timing['jobSeconds'] = finished - timing['submitted']
+            if 'executingSeen' in timing: # jobs finished by their first check can't be split
+                timing['jobWaitingSeconds'] = timing['executingSeen'] - timing['submitted']
+                timing['jobExecutingSeconds'] = finished - timing['executingSeen']
+            if timing.get('previousPoll'): timing['detectionDelaySeconds'] = finished - timing['previousPoll']
+        line = dict((key, value) for key, value in timing.items() if key not in ('lastPoll', 'previousPoll'))
+
+        if not os.path.isdir(os.path.dirname(timings_file)): os.makedirs(os.path.dirname(timings_file))
+        with open(timings_file, 'a') as f: f.write(json.dumps(line, sort_keys=True) + '\n')
+
+def _finishTimingOrWarn(baseurl, sdpath, status, messages=None):
+    # the timings are bookkeeping: failing to write them (e.g. a full disk) must not keep the .sd off the queues,
+    # or main would wait for it forever
+    try: _finishTiming(baseurl, sdpath, status, messages)
+    except Exception as e:
+        printLock.acquire()
+        print(' ... unable to record the timings ({0}): {1}'.format(e, sdpath))
+        printLock.release()
+
+def summarizeTimings(baseurl, timings, started, makespan, predictedMakespan):
+    # throughput of the run and the mean of every phase, to tell a slow network (upload rate), too few publishing
+    # instances (slot wait, job waiting) and the script itself (polling, detection delay) apart
+    published = [timing for timing in timings if timing.get('status') == 'esriJobSucceeded']
+    uploaded = [timing for timing in timings if 'uploadSeconds' in timing]
+    uploadedBytes = sum(timing['size'] for timing in uploaded)
+
+    def mean(key):
+        values = [timing[key] for timing in timings if key in timing]
+        return sum(values) / float(len(values)) if values else None
+
+    summary = { 'type' : 'summary', 'server' : baseurl, 'started' : started, 'seconds' : makespan, 'predictedSeconds' : predictedMakespan,
+                'published' : len(published), 'failed' : len(timings) - len(published),
+                'servicesPerHour' : len(published) * 3600.0 / makespan if makespan else None,
+                'uploadedBytes' : uploadedBytes, 'megabytesPerSecond' : uploadedBytes / 1048576.0 / makespan if makespan else None,
+                'uploadMegabytesPerSecond' : uploadedBytes / 1048576.0 / sum(timing['uploadSeconds'] for timing in uploaded) if uploaded else None }
+    for key in ('uploadSeconds', 'slotWaitSeconds', 'submitSeconds', 'jobSeconds', 'jobWaitingSeconds', 'jobExecutingSeconds', 'pollCount', 'pollSeconds', 'detectionDelaySeconds'):
+        summary['mean' + key[0].upper() + key[1:]] = mean(key)
+    return summary
+
+def printSummary(summary):
+    def seconds(value): return '-' if value is None else '{0:.1f}s'.format(value)
+    print('Published {0} services ({1} failed) in {2:.0f}s, predicted {3:.0f}s'.format(summary['published'], summary['failed'], summary['seconds'], summary['predictedSeconds']))
+    print(' {0:.1f} services/hour, {1:.2f} MB/s overall, {2} MB/s per upload'.format(summary['servicesPerHour'] or 0, summary['megabytesPerSecond'] or 0,
+        '-' if summary['uploadMegabytesPerSecond'] is None else '{0:.2f}'.format(summary['uploadMegabytesPerSecond'])))
+    print(' mean per service: upload {0}, waiting for a publishing instance {1}, submit {2}, job {3} (waiting {4}, executing {5})'.format(
+        seconds(summary['meanUploadSeconds']), seconds(summary['meanSlotWaitSeconds']), seconds(summary['meanSubmitSeconds']),
+        seconds(summary['meanJobSeconds']), seconds(summary['meanJobWaitingSeconds']), seconds(summary['meanJobExecutingSeconds'])))
+    print(' polling: {0} status checks per job taking {1}, end of job noticed within {2}'.format(
+        '-' if summary['meanPollCount'] is None else '{0:.1f}'.format(summary['meanPollCount']), seconds(summary['meanPollSeconds']), seconds(summary['meanDetectionDelaySeconds'])))
+
+def main(path, baseurl, username, password, dryRun=False, force=False):
     print('This script publishes all Service Definitions at {0} into {1}'.format(path, baseurl))
+
+    # only .sd files that are new or changed since they were last published to this server are published again
+    serviceDefinitionFiles = findServiceDefinitions(path)
+    started = time.time()
+    plannedHashes.update(hashFiles(serviceDefinitionFiles))
+    publishedManifest.update(loadManifest(baseurl))
+    plan = planPublishing(serviceDefinitionFiles, plannedHashes, {} if force else publishedManifest)
+    print('Hashed {0} service definitions in {1:.1f}s'.format(len(serviceDefinitionFiles), time.time() - started))
+
+    # longest processing time first: the most expensive .sd files start first and the cheap ones fill the gaps
+    queued = [sdpath for sdpath, change in plan if change != 'unchanged']
+    estimates = estimateDurations(queued, loadHistory(baseurl))
+    queued.sort(key=lambda sdpath: -sum(estimates[sdpath]))
+    changes = dict(plan)
+    for serviceDefinitionFile in queued:
+        print(' {0:<9} {1:>8.0f}s {2}'.format(changes[serviceDefinitionFile], sum(estimates[serviceDefinitionFile]), serviceDefinitionFile))
+    unchangedCount = len([change for sdpath, change in plan if change == 'unchanged'])
+    print('{0} to publish, {1} unchanged'.format(len(plan) - unchangedCount, unchangedCount))
+    if dryRun or unchangedCount == len(plan): return
+
+    tokens = getToken(baseurl, username, password)
     
     # check the max instances for the publishing endpoint and output warning if default (or less) is in use
-    maxInstances = getPublishingServiceMaxInstances(baseurl, token)
+    maxInstances = getPublishingServiceMaxInstances(baseurl, tokens)
     
     if maxInstances <= 2:
         print('NOTE: The site is using a max of {0} processes per server to publish services.'.format(maxInstances))
         print('Increase the max instances if server resources allow.')
 
-    # build a Queue containing all service definition files within the input folder and its subdirectories
-    for root, subFolders, files in os.walk(path):
-        for fname in files:
-            extension = os.path.splitext(fname)[1][1:].strip().lower()
-            if extension == 'sd':
-                serviceDefinitionFile = os.path.join(root,fname)
-                print(' Adding to queue {0}'.format(serviceDefinitionFile))
-                serviceDefinitionQueue.put(serviceDefinitionFile)
+    # the site can run at most this many publishing jobs at the same time; keep exactly that many in flight
+    publishingCapacity = maxInstances * getMachineCount(baseurl, tokens)
+    publishingSlots = threading.Semaphore(publishingCapacity)
+
+    for serviceDefinitionFile in queued: serviceDefinitionQueue.put((-sum(estimates[serviceDefinitionFile]), serviceDefinitionFile))
+
+    serviceDefinitionCount = serviceDefinitionQueue.qsize()
+    predictedMakespan = predictMakespan([estimates[sdpath] for sdpath in queued], thread_count, publishingCapacity)
+    print('Predicted time to publish {0} services: {1:.0f}s'.format(serviceDefinitionCount, predictedMakespan))
+    started = time.time()
+    runTimings.clear()
 
-    # create and start a pool of publishing threads 
+    # uploads, job submission and status polling all run at the same time: a .sd is submitted as soon as it
+    # is uploaded and a publishing slot is free, and a slot is freed as soon as its job is seen to finish
     thread_list = []
     for i in range (thread_count):
-        t = threading.Thread(target=publisherThread, args = (baseurl, token))
-        t.daemon = True
-        thread_list.append(t)
+        thread_list.append(threading.Thread(target=uploaderThread, args = (baseurl, tokens)))
+    for i in range (publishingCapacity):
+        thread_list.append(threading.Thread(target=submitterThread, args = (baseurl, tokens, publishingSlots)))
+    for i in range (poll_thread_count):
+        thread_list.append(threading.Thread(target=pollerThread, args = (baseurl, tokens, publishingSlots)))
 
-    for thread in thread_list: thread.start()
+    for thread in thread_list:
+        thread.daemon = True
+        thread.start()
 
-    # wait for queue to be empty
-    serviceDefinitionQueue.join()
-    
-    print('All .sd files have been sent to the server for publishing. Waiting for publishing jobs to complete..')
-    time.sleep(2) 
-    
-    # poll for publishing status until all jobs are finished (successfully or not)
-    pendingJobs = list(publishedQueue.queue)
-    successfulJobs = []
+    # wait for every .sd to either be published or have failed
+    while publishedQueue.qsize() + failedQueue.qsize() < serviceDefinitionCount:
+        time.sleep(poll_interval)
+        if publishedQueue.qsize() + failedQueue.qsize() >= serviceDefinitionCount: break
+        with pendingJobsCondition: runningJobCount = len(pendingJobs)
+        printLock.acquire()
+        print('Still waiting.. {0} services still being created, {1} waiting to be uploaded or submitted'.format(
+            runningJobCount, serviceDefinitionCount - publishedQueue.qsize() - failedQueue.qsize() - runningJobCount))
+        printLock.release()
+
+    makespan = time.time() - started
+    stopPollers(poll_thread_count)
+    successfulJobs = list(publishedQueue.queue)
     failedJobs = list(failedQueue.queue)
-    
-    while len(pendingJobs) > 0:
-        stillPendingJobs = []
-        for jobid, sdpath in pendingJobs:
-            jobStatus = getPublishingJobStatus(baseurl, token, jobid)
-            if jobStatus == 'esriJobSucceeded': successfulJobs.append((jobid, sdpath))
-            elif jobStatus == 'esriJobFailed': failedJobs.append((jobid, sdpath))
-            elif jobStatus in ('esriJobWaiting', 'esriJobExecuting', 'esriJobSubmitted'): stillPendingJobs.append((jobid, sdpath))
-            else: failedJobs.append((jobid, sdpath)) # cancelled statuses mostly
-            
-        pendingJobs = stillPendingJobs
-        if len(pendingJobs) > 0:
-            print('Still waiting.. {0} services still being created'.format(len(pendingJobs)))
-            time.sleep(2) # give the server some breathing room..
+    with runTimingsLock:
+        saveHistory(baseurl, runTimings)
+        summary = summarizeTimings(baseurl, runTimings.values(), started, makespan, predictedMakespan)
+        with open(timings_file, 'a') as f: f.write(json.dumps(summary, sort_keys=True) + '\n')
 
     # print out publishing results
     if len(successfulJobs) > 0: 
@@ -184,42 +576,205 @@ def main(path, baseurl, username, password):
         for jobid, sdpath in successfulJobs: print(' ... {0}'.format(sdpath))
     if len(failedJobs) > 0:
         print('Services that FAILED to publish:')
-        for jobid, sdpath in failedJobs: print(' ... {0}'.format(sdpath))
+        for jobid, sdpath in failedJobs:
+            print(' ... {0}'.format(sdpath))
+            for message in runTimings[sdpath]['messages']: print('       {0}'.format(message))
+    printSummary(summary)
+    print('Timings of every service written to {0}'.format(timings_file))
     
-def publisherThread(baseurl, token):
-    while not serviceDefinitionQueue.empty():
+def uploaderThread(baseurl, tokens):
+    while True:
+        try: priority, serviceDefinitionFile = serviceDefinitionQueue.get_nowait()
+        except Queue.Empty: return
+
+        printLock.acquire() # synchronize print statement, otherwise they have a tendency to overlap in the console
+        print(' ... uploading: {0}'.format(serviceDefinitionFile))
+        printLock.release()
+
         try:
-            serviceDefinitionFile = serviceDefinitionQueue.get()
-            printLock.acquire() # synchronize print statement, otherwise they have a tendency to overlap in the console
-            print(' ... publishing: {0}'.format(serviceDefinitionFile))
+            uploadStarted = time.time()
+            # upload the sd to the server, in resumable parts if it is large
+            if upload_in_parts_threshold is not None and os.path.getsize(serviceDefinitionFile) >= upload_in_parts_threshold:
+                itemid = uploadFileInParts(baseurl, tokens, serviceDefinitionFile)
+            else:
+                itemid = uploadFile(baseurl, tokens, serviceDefinitionFile)
+            uploaded = time.time()
+            _recordTiming(serviceDefinitionFile, uploadStarted=uploadStarted, uploaded=uploaded, uploadSeconds=uploaded - uploadStarted,
+                          uploadBytesPerSecond=os.path.getsize(serviceDefinitionFile) / max(uploaded - uploadStarted, 0.001))
+            uploadedQueue.put((priority, itemid, serviceDefinitionFile)) # hand over to the submitters, most expensive first
+        except Exception as e:
+            printLock.acquire()
+            print(' ... FAILED to upload ({0}): {1}'.format(e, serviceDefinitionFile))
             printLock.release()
-            
-            try: 
-                itemid = uploadFile(baseurl, token, serviceDefinitionFile) # upload the sd to the server
-                jobid = publishService(baseurl, token, itemid) # start publishing job for uploaded file
-                publishedQueue.put((jobid, serviceDefinitionFile)) # store publishing jobid to check status later
-            except:
-                failedQueue.put(('-', serviceDefinitionFile))
-            
-            serviceDefinitionQueue.task_done()
+            _finishTimingOrWarn(baseurl, serviceDefinitionFile, 'uploadFailed', [str(e)])
+            failedQueue.put((None, serviceDefinitionFile)) # last: main stops waiting once every .sd is on a queue
+
+        serviceDefinitionQueue.task_done()
+
+def submitterThread(baseurl, tokens, publishingSlots):
+    while True:
+        priority, itemid, serviceDefinitionFile = uploadedQueue.get()
+        publishingSlots.acquire() # wait until the site has a publishing instance available
+
+        printLock.acquire()
+        print(' ... publishing: {0}'.format(serviceDefinitionFile))
+        printLock.release()
+
+        try:
+            _recordTiming(serviceDefinitionFile, slotWaitSeconds=time.time() - runTimings[serviceDefinitionFile]['uploaded'])
+            submitStarted = time.time()
+            jobid = publishService(baseurl, tokens, itemid) # start publishing job for uploaded file
+            submitted = time.time()
+            _recordTiming(serviceDefinitionFile, jobId=jobid, submitted=submitted, submitSeconds=submitted - submitStarted)
+            _schedulePendingJob(jobid, serviceDefinitionFile, submitted) # store publishing jobid to check status
         except Exception as e:
-            print(e.message)
+            printLock.acquire()
+            print(' ... FAILED to submit ({0}): {1}'.format(e, serviceDefinitionFile))
+            printLock.release()
+            _finishTimingOrWarn(baseurl, serviceDefinitionFile, 'submitFailed', [str(e)])
+            publishingSlots.release()
+            failedQueue.put((None, serviceDefinitionFile)) # last: main stops waiting once every .sd is on a queue
+
+        uploadedQueue.task_done()
+
+def _pollDelay(runningTime):
+    # a job that has been running for a while is likely to keep running, so check it less often
+    return min(poll_max_interval, max(poll_interval, runningTime * poll_backoff_factor))
+
+def _schedulePendingJob(jobid, sdpath, submitted, failures=0):
+    with pendingJobsCondition:
+        pendingJobs[jobid] = (sdpath, submitted, failures)
+        heapq.heappush(pendingJobsSchedule, (time.time() + _pollDelay(time.time() - submitted), jobid))
+        pendingJobsCondition.notify()
+
+def stopPollers(count):
+    # one stop signal per poller thread, due at once, ahead of the jobs still pending
+    with pendingJobsCondition:
+        for i in range(count): heapq.heappush(pendingJobsSchedule, (0, None))
+        pendingJobsCondition.notify_all()
+
+def _nextDuePendingJob():
+    # blocks until the status of one of the pending jobs is due to be checked, or a stop signal
+    with pendingJobsCondition:
+        while True:
+            now = time.time()
+            if pendingJobsSchedule and pendingJobsSchedule[0][0] <= now:
+                nextCheck, jobid = heapq.heappop(pendingJobsSchedule)
+                if jobid is None: return None, None, None, None
+                sdpath, submitted, failures = pendingJobs[jobid]
+                return jobid, sdpath, submitted, failures
+            if pendingJobsSchedule: pendingJobsCondition.wait(pendingJobsSchedule[0][0] - now)
+            else: pendingJobsCondition.wait()
+
+def pollerThread(baseurl, tokens, publishingSlots):
+    # each poller thread checks one job at a time, so at most poll_thread_count checks are in flight
+    while True:
+        jobid, sdpath, submitted, failures = _nextDuePendingJob()
+        if jobid is None: return # stopPollers
+
+        checked = time.time()
+        try:
+            job = getPublishingJob(baseurl, tokens, jobid)
+            messages = _jobMessages(job)
+        except Exception as e:
+            # most likely transient, check again later; but not forever, the job may be gone or the token revoked
+            failures += 1
+            job = { 'jobStatus' : 'statusFailed' if failures >= poll_max_failures else None }
+            messages = ['Unable to check the status {0} times in a row: {1}'.format(failures, e)]
+        jobStatus = job.get('jobStatus')
+        try: _recordPoll(sdpath, jobStatus, time.time() - checked)
+        except Exception: pass # only the polling overhead of this .sd goes unrecorded
+
+        if jobStatus in (None, 'esriJobWaiting', 'esriJobExecuting', 'esriJobSubmitted'):
+            _schedulePendingJob(jobid, sdpath, submitted, failures if jobStatus is None else 0)
+            continue
+
+        with pendingJobsCondition: del pendingJobs[jobid]
+        printLock.acquire()
+        if jobStatus == 'esriJobSucceeded': print(' ... published in {0:.0f}s: {1}'.format(time.time() - submitted, sdpath))
+        else: print(' ... FAILED to publish ({0}): {1}'.format(jobStatus, sdpath)) # failed and cancelled statuses mostly
+        printLock.release()
+        if jobStatus == 'esriJobSucceeded':
+            try:
+                _recordTiming(sdpath, publishSeconds=time.time() - submitted)
+                _recordPublished(baseurl, sdpath)
+            except Exception as e:
+                # published, but not in the manifest, so the next run would publish it again: report it as failed
+                printLock.acquire()
+                print(' ... FAILED to record the publishing ({0}): {1}'.format(e, sdpath))
+                printLock.release()
+                jobStatus = 'recordFailed'
+                messages = messages + ['Published, but unable to record it: {0}'.format(e)]
+        _finishTimingOrWarn(baseurl, sdpath, jobStatus, messages)
+        publishingSlots.release() # let the next uploaded .sd start publishing right away
+
+        # last: main stops waiting, and reads the timings, once every .sd is on one of these queues; by then
+        # the manifest has been saved, so the next run doesn't publish this .sd again
+        if jobStatus == 'esriJobSucceeded': publishedQueue.put((jobid, sdpath))
+        else: failedQueue.put((jobid, sdpath))
         
-if __name__ == '__main__':
+def _benchmark(sizeMB):
+    # uploads a synthetic .sd of sizeMB to a local stand-in server that discards what it receives, and reports the
+    # throughput and the peak memory (RSS) of the process, which stays flat however large the file is
+    import resource, tempfile, BaseHTTPServer, SocketServer
+
+    class DiscardHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        def do_POST(self):
+            remaining = int(self.headers.getheader('content-length'))
+            while remaining > 0: remaining -= len(self.rfile.read(min(upload_chunk_size, remaining)))
+            body = json.dumps({ 'item' : { 'itemID' : 'benchmark' } })
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        def log_message(self, format, *args): pass
+
+    class StandInServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+        daemon_threads = True
+
+    server = StandInServer(('127.0.0.1', 0), DiscardHandler)
+    serverThread = threading.Thread(target=server.serve_forever)
+    serverThread.daemon = True
+    serverThread.start()
+
+    fd, path = tempfile.mkstemp(suffix='.sd')
     try:
-        path = sys.argv[1]
-        baseurl = sys.argv[2] # note: baseurl is expected to be the root of the server and the site name is always expected to be /arcgis
-        username = sys.argv[3]
-        password = sys.argv[4]
-    except:
-        print('Usage:')
-        print('PublishAllSDsinFolder.py <folderWithSDs> <serverPath> <username> <password>')
-        print('')
-        print('E.g.: PublishAllSDsinFolder.py d:\\temp https://server1.example.com:6443 siteadmin sitepassword')
-        sys.exit(1)
+        with os.fdopen(fd, 'wb') as f:
+            block = os.urandom(upload_chunk_size)
+            for i in range(sizeMB * 1024 * 1024 // upload_chunk_size): f.write(block)
+        before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+        begin = time.time()
+        url = 'http://127.0.0.1:{0}/arcgis/admin/uploads/upload'.format(server.server_address[1])
+        json.loads(_postmultipart(url, { 'f' : 'json' }, [('itemFile', path, os.path.basename(path))]))
+        elapsed = time.time() - begin
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+        print('{0} MB uploaded in {1:.1f}s ({2:.0f} MB/s), peak RSS {3:.1f} MB ({4:.1f} MB before the upload)'.format(
+            sizeMB, elapsed, sizeMB / elapsed, peak, before))
+    finally:
+        os.remove(path)
+        httpclient.closeAll()
+        server.shutdown()
+
+if __name__ == '__main__':
+    # PublishAllSDsinFolder.py --benchmark [size in MB] times a streamed upload to a local stand-in server
+    if sys.argv[1:2] == ['--benchmark']:
+        _benchmark(int(sys.argv[2]) if len(sys.argv) > 2 else 2048)
+        sys.exit(0)
+
+    parser = argparse.ArgumentParser(description='Publishes the Service Definitions in a folder that are new or changed since they were last published.',
+                                     epilog='E.g.: PublishAllSDsinFolder.py d:\\temp https://server1.example.com:6443 siteadmin sitepassword')
+    parser.add_argument('path', metavar='folderWithSDs')
+    # note: baseurl is expected to be the root of the server and the site name is always expected to be /arcgis
+    parser.add_argument('baseurl', metavar='serverPath')
+    parser.add_argument('username')
+    parser.add_argument('password')
+    parser.add_argument('--dry-run', action='store_true', help='Only print which service definitions would be published')
+    parser.add_argument('--force', action='store_true', help='Publish every service definition, changed or not')
+    args = parser.parse_args()
 
-    if not (os.path.isdir(path) or os.path.isfile(path)):
-        print("File or folder {0} not found. Please check input parameters.".format(path))
+    if not (os.path.isdir(args.path) or os.path.isfile(args.path)):
+        print("File or folder {0} not found. Please check input parameters.".format(args.path))
         sys.exit(1)
         
-    main(path, baseurl, username, password)
+    main(args.path, args.baseurl, args.username, args.password, args.dry_run, args.force)
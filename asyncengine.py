@@ -0,0 +1,266 @@
+"""Event loop based engine for BurstOfHttpRequests.
+
+Drives thousands of concurrent clients from a single thread: every client is a
+coroutine on one asyncio event loop talking HTTP/1.1 over keep-alive
+connections, instead of an OS thread with its own stack. The load can be
+spread over several worker processes, each running its own event loop, and
+their results are merged at the end.
+
+Requires Python 3.7 or higher; the threaded engine in BurstOfHttpRequests
+works on any version.
+
+Run it directly to compare the requests per second both engines sustain
+against a local stub server, closed-loop at each number of clients:
+    asyncengine.py [seconds per run] [client counts...]"""
+
+import asyncio
+import multiprocessing
+import os
+import ssl
+import sys
+import time
+import zlib
+from urllib.parse import urlparse
+
+from loadtest import Results, responseError, arrivalRate, timer
+
+class ConnectionPool:
+    """Idle keep-alive connections per host, shared by all clients on one event loop."""
+    def __init__(self):
+        self.idle = {}
+        self.sslContext = ssl._create_default_https_context()
+
+    async def _connect(self, parsed):
+        if parsed.scheme == 'https':
+            return await asyncio.open_connection(parsed.hostname, parsed.port or 443, ssl=self.sslContext)
+        return await asyncio.open_connection(parsed.hostname, parsed.port or 80)
+
+    async def request(self, url, body, timeout):
+        """POSTs the url-encoded body to url (or GETs it if body is None) and returns (status, body)."""
+        parsed = urlparse(url)
+        idle = self.idle.setdefault((parsed.scheme, parsed.netloc), [])
+        reused = bool(idle)
+        conn = idle.pop() if reused else await asyncio.wait_for(self._connect(parsed), timeout)
+        try: status, data, keepAlive = await asyncio.wait_for(self._roundtrip(conn, parsed, body), timeout)
+        except (OSError, asyncio.IncompleteReadError, ValueError) as e:
+            conn[1].close()
+            if not reused or isinstance(e, asyncio.TimeoutError): raise
+            # the server may have closed the idle connection in the meantime; retry once on a new one
+            conn = await asyncio.wait_for(self._connect(parsed), timeout)
+            try: status, data, keepAlive = await asyncio.wait_for(self._roundtrip(conn, parsed, body), timeout)
+            except BaseException:
+                conn[1].close()
+                raise
+        except BaseException:
+            conn[1].close()
+            raise
+
+        if keepAlive: idle.append(conn)
+        else: conn[1].close()
+        return status, data
+
+    async def _roundtrip(self, conn, parsed, requestBody):
+        reader, writer = conn
+        path = (parsed.path or '/') + ('?' + parsed.query if parsed.query else '')
+        if requestBody is None:
+            head = 'GET {0} HTTP/1.1\r\nHost: {1}\r\nAccept-Encoding: gzip\r\n\r\n'.format(path, parsed.netloc)
+            writer.write(head.encode('latin-1'))
+        else:
+            requestBody = requestBody.encode('utf-8')
+            head = ('POST {0} HTTP/1.1\r\nHost: {1}\r\nAccept-Encoding: gzip\r\n'
+                    'Content-Type: application/x-www-form-urlencoded\r\nContent-Length: {2}\r\n\r\n').format(path, parsed.netloc, len(requestBody))
+            writer.write(head.encode('latin-1') + requestBody)
+        await writer.drain()
+
+        statusLine = await reader.readline()
+        if not statusLine: raise ConnectionResetError('connection closed by server')
+        status = int(statusLine.split()[1])
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''): break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+
+        keepAlive = headers.get('connection', '').lower() != 'close'
+        if headers.get('transfer-encoding', '').lower() == 'chunked':
+            chunks = []
+            while True:
+                size = int((await reader.readline()).split(b';')[0], 16)
+                if size == 0: break
+                chunks.append(await reader.readexactly(size))
+                await reader.readline()
+            while (await reader.readline()) not in (b'\r\n', b'\n', b''): pass # trailers
+            body = b''.join(chunks)
+        elif 'content-length' in headers:
+            body = await reader.readexactly(int(headers['content-length']))
+        else:
+            body = await reader.read()
+            keepAlive = False
+
+        if headers.get('content-encoding') == 'gzip': body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+        return status, body, keepAlive
+
+    def close(self):
+        for idle in self.idle.values():
+            for reader, writer in idle: writer.close()
+        self.idle.clear()
+
+async def _send(pool, url, requestBody, label, results, started, timeout):
+    size, error = 0, None
+    try:
+        status, body = await pool.request(url, requestBody, timeout)
+        size = len(body)
+        error = responseError(status, body)
+    except asyncio.TimeoutError: error = 'timeout'
+    except Exception as e: error = getattr(e, 'strerror', None) or type(e).__name__
+    results.record(label, timer() - started, size, error)
+
+async def _closedLoop(pool, requests, clients, rampUp, duration, timeout, results):
+    deadline = timer() + duration if duration else None
+
+    async def client(startDelay):
+        # a client with no think-time: sends the next request as soon as the previous one finishes
+        await asyncio.sleep(startDelay)
+        while deadline is None or timer() < deadline:
+            try: label, url, requestBody = next(requests)
+            except StopIteration: return
+            await _send(pool, url, requestBody, label, results, timer(), timeout)
+
+    await asyncio.gather(*(client(rampUp * i / float(clients)) for i in range(clients)))
+
+async def _openLoop(pool, requests, rate, clients, rampUp, duration, timeout, results):
+    inFlight = asyncio.Semaphore(clients) # caps the number of open connections
+    tasks = set()
+
+    async def limitedSend(label, url, requestBody, scheduled):
+        async with inFlight:
+            # latency is measured from when the request was due, so waiting for a free connection counts too
+            await _send(pool, url, requestBody, label, results, scheduled, timeout)
+
+    start = timer()
+    scheduled = start
+    for label, url, requestBody in requests:
+        elapsed = scheduled - start
+        if duration and elapsed >= duration: break
+        scheduled += 1.0 / arrivalRate(rate, elapsed, rampUp)
+        delay = scheduled - timer()
+        if delay > 0.001: await asyncio.sleep(delay) # below timer resolution, just send
+        task = asyncio.ensure_future(limitedSend(label, url, requestBody, scheduled))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+
+    if tasks: await asyncio.gather(*tasks)
+
+async def _run(requests, clients, rate, rampUp, duration, timeout):
+    pool = ConnectionPool()
+    results = Results()
+    results.start = time.time()
+    try:
+        if rate: await _openLoop(pool, requests, rate, clients, rampUp, duration, timeout, results)
+        else: await _closedLoop(pool, requests, clients, rampUp, duration, timeout, results)
+    finally:
+        pool.close()
+    results.end = time.time()
+    return results
+
+def _raiseFileLimit():
+    # every client holds a connection open, so thousands of them need more than the default 1024 descriptors
+    try:
+        import resource
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if soft != resource.RLIM_INFINITY and (hard == resource.RLIM_INFINITY or soft < hard):
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    except (ImportError, ValueError, OSError): pass
+
+def _runProcess(makeRequests, index, count, clients, rate, rampUp, duration, timeout):
+    _raiseFileLimit()
+    return asyncio.run(_run(makeRequests(index, count), clients, rate, rampUp, duration, timeout))
+
+def run(makeRequests, clients, rate=None, rampUp=0, duration=None, timeout=60, processes=1):
+    """Runs the load and returns the merged Results.
+
+    makeRequests(index, count) returns the (label, url, body) requests for worker process index of count; it must
+    be picklable when processes > 1. Clients and the open-loop rate are divided evenly over the processes."""
+    if processes <= 1: return _runProcess(makeRequests, 0, 1, clients, rate, rampUp, duration, timeout)
+
+    args = []
+    for i in range(processes):
+        processClients = clients // processes + (1 if i < clients % processes else 0)
+        args.append((makeRequests, i, processes, max(1, processClients), rate / processes if rate else None, rampUp, duration, timeout))
+    with multiprocessing.Pool(processes) as pool: parts = pool.starmap(_runProcess, args)
+
+    results = Results()
+    for part in parts: results.merge(part)
+    return results
+
+async def _stubServer(port, ready):
+    # answers every request with a small JSON body over keep-alive connections, like a cached map service
+    body = b'{"currentVersion":10.91,"serviceDescription":"stub"}'
+    response = b'HTTP/1.1 200 OK\r\nContent-Type: application/json\r\nContent-Length: ' + str(len(body)).encode() + b'\r\n\r\n' + body
+
+    async def handle(reader, writer):
+        try:
+            while True:
+                length = 0
+                while True:
+                    line = await reader.readline()
+                    if not line: return
+                    if line in (b'\r\n', b'\n'): break
+                    if line.lower().startswith(b'content-length:'): length = int(line.split(b':')[1])
+                if length: await reader.readexactly(length)
+                writer.write(response)
+                await writer.drain()
+        except (OSError, asyncio.IncompleteReadError): pass
+        finally: writer.close()
+
+    server = await asyncio.start_server(handle, '127.0.0.1', port, backlog=4096)
+    ready.set()
+    async with server: await server.serve_forever()
+
+def _runStubServer(port, ready):
+    _raiseFileLimit()
+    asyncio.run(_stubServer(port, ready))
+
+def _benchmark(seconds, clientCounts):
+    import socket, importlib.machinery
+    # the threaded engine is the BurstOfHttpRequests script itself, which has no .py extension
+    burst = importlib.machinery.SourceFileLoader('BurstOfHttpRequests', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'BurstOfHttpRequests')).load_module()
+    _raiseFileLimit()
+
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+    ready = multiprocessing.Event()
+    server = multiprocessing.Process(target=_runStubServer, args=(port, ready), daemon=True)
+    server.start() # in a process of its own, so it doesn't compete with the engine being measured
+    ready.wait()
+    url = 'http://127.0.0.1:{0}/arcgis/rest/services/SampleWorldCities/MapServer'.format(port)
+    makeRequests = lambda index, count: iter(lambda: (url, url, 'f=pjson'), None)
+
+    def threaded(clients):
+        results = Results()
+        burst.runClosedLoop(makeRequests(0, 1), clients, 0, seconds, results)
+        return results
+
+    def evented(clients):
+        return run(makeRequests, clients, duration=seconds)
+
+    print('{0:<10} {1:>8} {2:>12} {3:>10} {4:>10}'.format('engine', 'clients', 'requests/s', 'p99 ms', 'errors'))
+    best = {}
+    try:
+        for clients in clientCounts:
+            for name, engine in (('threaded', threaded), ('async', evented)):
+                try: total = engine(clients).summary()['rows'][-1]
+                except (RuntimeError, MemoryError) as e: # e.g. can't start new thread
+                    print('{0:<10} {1:>8} failed: {2}'.format(name, clients, e))
+                    continue
+                print('{0:<10} {1:>8} {2:>12.0f} {3:>10.1f} {4:>10}'.format(name, clients, total['throughput'], total['p99'] * 1000, total['errors']))
+                if not total['errors']: best[name] = max(best.get(name, 0), total['throughput'])
+    finally:
+        server.terminate()
+    for name in ('threaded', 'async'):
+        print('{0}: at most {1:.0f} requests/s without errors'.format(name, best.get(name, 0)))
+
+if __name__ == '__main__':
+    _benchmark(float(sys.argv[1]) if len(sys.argv) > 1 else 10, [int(n) for n in sys.argv[2:]] or [10, 100, 1000, 5000])
@@ -0,0 +1,22 @@
+"""Atomic file replacement shared by the scripts in this repository.
+
+Journals, caches, manifests and baselines are written to a temporary file
+next to the target, flushed to disk and then moved over the target in one
+step, so a crash or a full disk leaves either the old file or the new one,
+never a truncated file or no file at all. Works with both Python 2.7 and
+Python 3."""
+
+import os
+
+def writeAtomically(path, write, mode='w'):
+    """Replaces the file at path with what write(f) writes to the file object f; mode is 'w' or 'wb'."""
+    tempPath = path + '.tmp'
+    with open(tempPath, mode) as f:
+        write(f)
+        f.flush()
+        os.fsync(f.fileno())
+    if hasattr(os, 'replace'): os.replace(tempPath, path)
+    else:
+        # Python 2: os.rename replaces the target in one step everywhere but on Windows, where it fails if the target exists
+        if os.name == 'nt' and os.path.exists(path): os.remove(path)
+        os.rename(tempPath, path)
@@ -0,0 +1,136 @@
+"""Command line and batch front end for the usage report exporters.
+
+ExportServiceStats.py and ExportTotalRequests.py ask for their inputs when
+run without arguments; given arguments they run one export without asking
+anything (see their --help). Run this module with a JSON file of jobs to
+run many exports, possibly against many servers:
+    exportjobs.py jobs.json [--workers N]
+
+    { "defaults" : { "port" : 6443, "https" : true, "user" : "admin", "passwordEnv" : "ARCGIS_PASSWORD" },
+      "jobs" : [
+        { "exporter" : "ExportServiceStats", "server" : "gis1.example.com", "service" : "*",
+          "from" : "2024-01-01 00:00", "to" : "2024-02-01 00:00", "interval" : 60, "output" : "gis1.parquet" },
+        { "exporter" : "ExportTotalRequests", "server" : "gis2.example.com",
+          "from" : "2024-01-01 00:00", "to" : "2024-02-01 00:00", "output" : "gis2_totals.csv" } ] }
+
+Jobs against different servers run at the same time, up to --workers of
+them; the jobs of one server run one after another so a site is never
+asked for several exports at once. Exits with 0 when every job succeeded,
+1 when a job failed and 2 for invalid arguments or jobs. Works with both
+Python 2.7 and Python 3."""
+
+import os
+import sys
+import json
+import time
+import getpass
+import argparse
+import threading
+import traceback
+
+batch_worker_count = 4 # default number of servers exported from at the same time
+time_format = '%Y-%m-%d %H:%M'
+
+class JobError(Exception):
+    pass
+
+def parseTime(text):
+    """Converts a YYYY-MM-DD HH:MM local time to epoch milliseconds; raises JobError if it can't be parsed."""
+    try: return int(time.mktime(time.strptime(text, time_format)) * 1000)
+    except (TypeError, ValueError): raise JobError('Unable to parse {0!r}. Ensure date and time is in YYYY-MM-DD HH:MM format'.format(text))
+
+def siteURL(job):
+    """The URL of the ArcGIS Server site of a job, e.g. https://gis.example.com:6443/arcgis."""
+    return '{0}://{1}:{2}/{3}'.format('https' if job.get('https') else 'http', job['server'], job.get('port', 6080), job.get('context', 'arcgis'))
+
+def parseArguments(argv, description, interval=False, service=False):
+    """Returns the job given by command line arguments; interval and service add the options only some exporters have."""
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('--server', required=True, help='ArcGIS Server machine name')
+    parser.add_argument('--port', type=int, default=6080, help='ArcGIS Server port (default %(default)s, 6443 for HTTPS)')
+    parser.add_argument('--https', action='store_true', help='Connect over HTTPS')
+    parser.add_argument('--context', default='arcgis', help='Web context of the site (default %(default)s)')
+    parser.add_argument('--user', required=True, help='Administrator or publisher user name')
+    parser.add_argument('--password', help='Password; read from the ARCGIS_PASSWORD environment variable or asked for when not given')
+    parser.add_argument('--from', dest='fromTime', required=True, help='Start of the report, YYYY-MM-DD HH:MM')
+    parser.add_argument('--to', dest='toTime', required=True, help='End of the report, YYYY-MM-DD HH:MM')
+    if interval: parser.add_argument('--interval', type=int, required=True, help='Time interval to report statistics (in minutes)')
+    if service: parser.add_argument('--service', default='*', help='Service name and type (e.g. planning/firehydrants.MapServer), or * for all services in the site (default)')
+    parser.add_argument('--output', required=True, help='Output file; .parquet, .arrow and .feather files are written in those formats')
+    args = parser.parse_args(argv)
+
+    job = { 'server' : args.server, 'port' : args.port, 'https' : args.https, 'context' : args.context, 'user' : args.user,
+            'password' : args.password or os.environ.get('ARCGIS_PASSWORD') or getpass.getpass('Enter password: '),
+            'from' : args.fromTime, 'to' : args.toTime, 'output' : args.output }
+    if interval: job['interval'] = args.interval
+    if service: job['service'] = args.service
+    return job
+
+def loadJobs(path):
+    """Reads a JSON file of jobs, each merged over the file's defaults; passwordEnv names the environment variable
+    holding the password."""
+    with open(path, 'r') as f: config = json.load(f)
+    jobs = []
+    for i, entry in enumerate(config['jobs']):
+        job = dict(config.get('defaults', {}))
+        job.update(entry)
+        if 'passwordEnv' in job: job['password'] = os.environ.get(job['passwordEnv'])
+        for key in ('exporter', 'server', 'user', 'password', 'from', 'to', 'output'):
+            if not job.get(key): raise JobError('Job {0} has no {1}'.format(i + 1, key))
+        job.setdefault('name', '{0} {1} {2}'.format(job['exporter'], job['server'], job['output']))
+        jobs.append(job)
+    return jobs
+
+def runJobs(jobs, runners, workerCount=batch_worker_count):
+    """Runs every job with runners[job['exporter']](job), which returns an exit code; the jobs of one server run one
+    after another and up to workerCount servers at the same time. Returns (job, exit code, seconds) per job."""
+    servers = {}
+    for job in jobs: servers.setdefault(siteURL(job), []).append(job)
+    pending = list(servers.values())
+    results = []
+    lock = threading.Lock()
+
+    def workerThread():
+        while True:
+            with lock:
+                if not pending: return
+                serverJobs = pending.pop(0)
+            for job in serverJobs:
+                started = time.time()
+                try: code = runners[job['exporter']](job)
+                except Exception:
+                    traceback.print_exc()
+                    code = 1
+                with lock: results.append((job, code, time.time() - started))
+
+    threadList = [threading.Thread(target=workerThread) for i in range(min(workerCount, len(pending)))]
+    for thread in threadList: thread.start()
+    for thread in threadList: thread.join()
+    return results
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run the usage report export jobs of a JSON file.')
+    parser.add_argument('jobs', help='JSON file with the jobs to run')
+    parser.add_argument('--workers', type=int, default=batch_worker_count, help='Servers exported from at the same time (default %(default)s)')
+    args = parser.parse_args(argv)
+
+    import ExportServiceStats, ExportTotalRequests
+    runners = { 'ExportServiceStats' : ExportServiceStats.runJob, 'ExportTotalRequests' : ExportTotalRequests.runJob }
+    try:
+        jobs = loadJobs(args.jobs)
+        for job in jobs:
+            if job['exporter'] not in runners: raise JobError('Unknown exporter {0!r} in job {1}'.format(job['exporter'], job['name']))
+    except (JobError, IOError, OSError, ValueError, KeyError) as e:
+        print('Invalid jobs file {0}: {1}'.format(args.jobs, e))
+        return 2
+
+    results = runJobs(jobs, runners, args.workers)
+
+    print('')
+    print('{0:<60} {1:<7} {2:>8}'.format('Job', 'Result', 'Time (s)'))
+    for job, code, elapsed in sorted(results, key=lambda result: result[0]['name']):
+        print('{0:<60} {1:<7} {2:>8.1f}'.format(job['name'], 'ok' if code == 0 else 'FAILED', elapsed))
+    return 0 if all(code == 0 for job, code, elapsed in results) else 1
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
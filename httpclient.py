@@ -0,0 +1,244 @@
+"""Shared HTTP client for the scripts in this repository.
+
+Keeps a pool of persistent (keep-alive) connections per host so repeated
+calls to the same ArcGIS Server or Portal don't pay for a new TCP and TLS
+handshake every time, reuses TLS sessions when a new connection has to be
+opened, asks for and decodes gzip responses and applies a timeout to every
+request. Works with both Python 2.7 and Python 3.
+
+Run it directly to compare pooled requests with a new connection per request:
+    httpclient.py <url> [number of requests]"""
+
+import sys
+import ssl
+import json
+import time
+import zlib
+import select
+import socket
+import threading
+
+try:
+    import http.client as httplib
+    from urllib.parse import urlparse, urlencode
+except ImportError:
+    import httplib
+    from urlparse import urlparse
+    from urllib import urlencode
+
+timeout = 60 # default timeout in seconds for connecting and for each read
+max_idle_connections_per_host = 10 # idle connections kept open per host, extra ones are closed
+
+_pools = {} # (scheme, netloc) -> list of idle connections
+_idempotentMethods = frozenset(('GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE')) # safe to send twice
+_tlsSessions = {} # netloc -> last TLS session negotiated with that host
+_sslContext = None
+_lock = threading.Lock()
+
+class Response(object):
+    """A fully read response; body is already gzip-decoded."""
+    def __init__(self, status, headers, body):
+        self.status = status
+        self.headers = headers
+        self.body = body
+
+    def getcode(self): return self.status
+    def read(self): return self.body
+    def text(self): return self.body.decode('utf-8')
+    def json(self): return json.loads(self.text())
+
+class StreamingResponse(object):
+    """A response whose body is read as it arrives, for bodies too large to hold in memory; gzip is decoded on the fly.
+
+    The connection goes back to the pool once the body has been read to the end; call close() when done with it."""
+    def __init__(self, scheme, netloc, conn, resp):
+        self.status = resp.status
+        self.headers = dict((name.lower(), value) for name, value in resp.getheaders())
+        self._scheme, self._netloc, self._conn, self._resp = scheme, netloc, conn, resp
+
+    def getcode(self): return self.status
+
+    def iterChunks(self, chunkSize=1 << 20):
+        """Yields the (decoded) body in chunks of bytes."""
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS) if self.headers.get('content-encoding') == 'gzip' else None
+        while True:
+            chunk = self._resp.read(chunkSize)
+            if not chunk: break
+            if decompressor: chunk = decompressor.decompress(chunk)
+            if chunk: yield chunk
+        if decompressor:
+            chunk = decompressor.flush()
+            if chunk: yield chunk
+
+        conn, self._conn = self._conn, None
+        if conn is None: return
+        if self._resp.will_close: conn.close()
+        else: _release(self._scheme, self._netloc, conn)
+
+    def close(self):
+        # a connection with part of the body still unread can't be reused
+        conn, self._conn = self._conn, None
+        if conn is not None: conn.close()
+
+def _getSSLContext():
+    # created lazily so scripts that swap ssl._create_default_https_context (e.g. to ignore self-signed
+    # certificates) before their first request get the context they asked for
+    global _sslContext
+    with _lock:
+        if _sslContext is None: _sslContext = ssl._create_default_https_context()
+        return _sslContext
+
+class _HTTPSConnection(httplib.HTTPSConnection):
+    # resumes the last TLS session negotiated with the same host when a new connection is opened
+    def connect(self):
+        sock = socket.create_connection((self.host, self.port), self.timeout)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if getattr(self, '_tunnel_host', None):
+            self.sock = sock
+            self._tunnel()
+        key = '{0}:{1}'.format(self.host, self.port)
+        session = _tlsSessions.get(key)
+        try: self.sock = self._context.wrap_socket(sock, server_hostname=self.host, session=session)
+        except TypeError: self.sock = self._context.wrap_socket(sock, server_hostname=self.host) # no session support
+        if getattr(self.sock, 'session', None) is not None: _tlsSessions[key] = self.sock.session
+
+class _HTTPConnection(httplib.HTTPConnection):
+    def connect(self):
+        httplib.HTTPConnection.connect(self)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+def _newConnection(scheme, netloc, requestTimeout):
+    if scheme == 'https': return _HTTPSConnection(netloc, timeout=requestTimeout, context=_getSSLContext())
+    return _HTTPConnection(netloc, timeout=requestTimeout)
+
+def _isClosed(conn):
+    # an idle connection has nothing to read unless the server has closed it (or sent something unexpected)
+    try: return conn.sock is None or bool(select.select([conn.sock], [], [], 0)[0])
+    except (socket.error, ValueError): return True
+
+def _acquire(scheme, netloc, requestTimeout):
+    while True:
+        with _lock:
+            idle = _pools.get((scheme, netloc))
+            conn = idle.pop() if idle else None
+        if conn is None: return _newConnection(scheme, netloc, requestTimeout), False
+        if not _isClosed(conn): break
+        conn.close()
+    conn.timeout = requestTimeout
+    if conn.sock is not None: conn.sock.settimeout(requestTimeout)
+    return conn, True
+
+def _release(scheme, netloc, conn):
+    with _lock:
+        idle = _pools.setdefault((scheme, netloc), [])
+        if len(idle) < max_idle_connections_per_host:
+            idle.append(conn)
+            return
+    conn.close()
+
+def closeAll():
+    """Closes every pooled connection."""
+    with _lock:
+        pools = list(_pools.values())
+        _pools.clear()
+    for idle in pools:
+        for conn in idle: conn.close()
+
+def _send(method, url, body, headers, requestTimeout):
+    # sends the request and reads the response headers; returns the parsed url, connection and response
+    parsed = urlparse(url)
+    selector = parsed.path or '/'
+    if parsed.query: selector += '?' + parsed.query
+    if requestTimeout is None: requestTimeout = timeout
+
+    allHeaders = { 'Accept-Encoding' : 'gzip' }
+    if headers: allHeaders.update(headers)
+    if body is not None and not callable(body):
+        if not isinstance(body, bytes): body = body.encode('utf-8')
+        allHeaders['Content-Length'] = str(len(body))
+
+    while True:
+        conn, reused = _acquire(parsed.scheme, parsed.netloc, requestTimeout)
+        sent = False
+        try:
+            conn.putrequest(method, selector, skip_accept_encoding=True)
+            for name, value in allHeaders.items(): conn.putheader(name, value)
+            if callable(body):
+                conn.endheaders()
+                for chunk in body(): conn.send(chunk)
+            else: conn.endheaders(body) # headers and a small body go out together
+            sent = True
+            return parsed, conn, conn.getresponse()
+        except (httplib.HTTPException, socket.error) as e:
+            conn.close()
+            # an idle connection may have been closed by the server in the meantime; retry once on a new one, unless
+            # the server may have received the whole request and running it twice could e.g. submit a job twice
+            if reused and not isinstance(e, socket.timeout) and (method in _idempotentMethods or not sent): continue
+            raise
+
+def request(method, url, body=None, headers=None, requestTimeout=None):
+    """Performs a request over a pooled connection and returns a Response.
+
+    body may be a string or a callable returning an iterable of chunks for bodies
+    too large to hold in memory; callers streaming a body must set Content-Length.
+    Does not raise on HTTP error statuses; connection errors and timeouts do raise."""
+    parsed, conn, resp = _send(method, url, body, headers, requestTimeout)
+    try: data = resp.read()
+    except BaseException:
+        conn.close()
+        raise
+
+    if resp.will_close: conn.close()
+    else: _release(parsed.scheme, parsed.netloc, conn)
+
+    respHeaders = dict((name.lower(), value) for name, value in resp.getheaders())
+    if respHeaders.get('content-encoding') == 'gzip': data = zlib.decompress(data, 16 + zlib.MAX_WBITS)
+
+    return Response(resp.status, respHeaders, data)
+
+def requestStream(method, url, body=None, headers=None, requestTimeout=None):
+    """Like request, but returns a StreamingResponse as soon as the response headers have arrived."""
+    parsed, conn, resp = _send(method, url, body, headers, requestTimeout)
+    return StreamingResponse(parsed.scheme, parsed.netloc, conn, resp)
+
+def get(url, params=None, requestTimeout=None):
+    if params: url += ('&' if '?' in url else '?') + urlencode(params)
+    return request('GET', url, requestTimeout=requestTimeout)
+
+def post(url, postdata=None, requestTimeout=None):
+    headers = { 'Content-Type' : 'application/x-www-form-urlencoded' }
+    return request('POST', url, urlencode(postdata or {}), headers, requestTimeout)
+
+def postStream(url, postdata=None, requestTimeout=None):
+    headers = { 'Content-Type' : 'application/x-www-form-urlencoded' }
+    return requestStream('POST', url, urlencode(postdata or {}), headers, requestTimeout)
+
+def postJSON(url, postdata=None, requestTimeout=None):
+    """POSTs form data and returns the parsed JSON response."""
+    return post(url, postdata, requestTimeout).json()
+
+def _benchmark(url, count):
+    def perCall():
+        # what the scripts used to do: a brand new connection for every request
+        parsed = urlparse(url)
+        for i in range(count):
+            if parsed.scheme == 'https': conn = httplib.HTTPSConnection(parsed.netloc, timeout=timeout, context=_getSSLContext())
+            else: conn = httplib.HTTPConnection(parsed.netloc, timeout=timeout)
+            conn.request('GET', parsed.path or '/')
+            conn.getresponse().read()
+            conn.close()
+
+    def pooled():
+        for i in range(count): get(url)
+
+    for name, run in (('new connection per request', perCall), ('pooled keep-alive connections', pooled)):
+        start = time.time()
+        run()
+        elapsed = time.time() - start
+        print('{0}: {1:.1f} requests/s'.format(name, count / elapsed))
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print('Usage: httpclient.py <url> [number of requests]')
+        sys.exit(1)
+    _benchmark(sys.argv[1], int(sys.argv[2]) if len(sys.argv) > 2 else 200)
@@ -0,0 +1,207 @@
+"""Incremental JSON parsing for large responses, such as usage report data.
+
+JSONStream parses a JSON document from an iterable of byte chunks (e.g.
+httpclient.StreamingResponse.iterChunks) and yields the items of one array in
+it as soon as each of them has been read, without holding the raw response or
+the other items in memory. Everything else in the document is parsed as
+usual into JSONStream.document, which is filled in as parsing goes on, so an
+error response (which has no items) can be checked once items() is done,
+without parsing anything twice.
+
+The path to the streamed array names the object keys to follow, with '*'
+for every element of an array; for usage report data, ('report',
+'report-data', '*', '*') yields every resource/metric entry. Each item is
+parsed by the standard json module, so this is about as fast as json.loads.
+Works with both Python 2.7 and Python 3.
+
+Run it directly to compare ExportServiceStats.postAndStreamReport with reading
+the whole response, in time and memory, on a synthetic report:
+    jsonstream.py [entries] [time slices]"""
+
+import sys
+import json
+import time
+import codecs
+import random
+
+read_size = 1 << 16 # minimum number of characters to read whenever the buffer runs out
+
+_whitespace = ' \t\n\r'
+
+class JSONStream(object):
+    def __init__(self, chunks, path):
+        self.document = None
+        self._chunks = iter(chunks)
+        self._path = tuple(path)
+        self._decoder = json.JSONDecoder()
+        self._textDecoder = codecs.getincrementaldecoder('utf-8')()
+        self._buf = u''
+        self._pos = 0
+        self._eof = False
+
+    def _more(self, minimum):
+        # drops what has been parsed already and reads at least minimum more characters; False at the end of the input
+        self._buf = self._buf[self._pos:]
+        self._pos = 0
+        wanted = len(self._buf) + max(minimum, read_size)
+        while len(self._buf) < wanted and not self._eof:
+            try: self._buf += self._textDecoder.decode(next(self._chunks))
+            except StopIteration:
+                self._buf += self._textDecoder.decode(b'', True)
+                self._eof = True
+        return wanted <= len(self._buf) or bool(self._buf)
+
+    def _peek(self):
+        while True:
+            while self._pos < len(self._buf) and self._buf[self._pos] in _whitespace: self._pos += 1
+            if self._pos < len(self._buf): return self._buf[self._pos]
+            if self._eof or not self._more(1): raise ValueError('Unexpected end of JSON input')
+
+    def _next(self):
+        char = self._peek()
+        self._pos += 1
+        return char
+
+    def _expect(self, char):
+        if self._next() != char: raise ValueError('Expected {0!r} at character {1}'.format(char, self._pos - 1))
+
+    def _value(self):
+        self._peek()
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self._buf, self._pos)
+                # a number at the very end of the buffer may continue in the next chunk
+                if end < len(self._buf) or self._eof:
+                    self._pos = end
+                    return value
+            except ValueError:
+                if self._eof: raise
+            # incomplete value: at least double what is buffered, so a large value isn't parsed over and over
+            self._more(len(self._buf) - self._pos)
+
+    def _leadsInto(self, path):
+        # whether the value ahead is an object or array that path continues into
+        char = self._peek()
+        if not path or char not in '{[': return False
+        return (char == '[') == (path[0] == '*')
+
+    def _container(self, path):
+        # parses the object or array ahead, yielding the items on path; returns (container, item generator)
+        if self._peek() == '{':
+            target = {}
+            return target, self._object(path, target)
+        target = []
+        return target, self._array(path[1:], target)
+
+    def _object(self, path, target):
+        self._expect('{')
+        if self._peek() == '}':
+            self._pos += 1
+            return
+        while True:
+            key = self._value()
+            self._expect(':')
+            if path[0] == key and self._leadsInto(path[1:]):
+                target[key], items = self._container(path[1:])
+                for item in items: yield item
+            else: target[key] = self._value()
+            char = self._next()
+            if char == '}': return
+            if char != ',': raise ValueError('Expected \',\' or \'}}\' at character {0}'.format(self._pos - 1))
+
+    def _array(self, path, target):
+        # path applies to every element; an empty path means the elements are the items to yield
+        self._expect('[')
+        if self._peek() == ']':
+            self._pos += 1
+            return
+        while True:
+            if not path: yield self._value()
+            elif self._leadsInto(path):
+                container, items = self._container(path)
+                target.append(container)
+                for item in items: yield item
+            else: target.append(self._value())
+            char = self._next()
+            if char == ']': return
+            if char != ',': raise ValueError('Expected \',\' or \']\' at character {0}'.format(self._pos - 1))
+
+    def items(self):
+        """Yields the items of the array at the path; self.document holds the rest of the document parsed so far."""
+        if self._leadsInto(self._path):
+            self.document, items = self._container(self._path)
+            for item in items: yield item
+        else: self.document = self._value()
+        try: self._peek()
+        except ValueError: return # nothing but whitespace left
+        raise ValueError('Extra data after JSON document at character {0}'.format(self._pos))
+
+def _syntheticReport(entries, slices):
+    rnd = random.Random(0)
+    start = 1704067200000
+    return { 'report' : { 'reportname' : 'benchmark', 'time-slices' : [start + i * 60000 for i in range(slices)],
+             'report-data' : [[{ 'resourceURI' : 'services/Service{0}.MapServer'.format(i), 'metric-type' : 'RequestCount',
+                                 'data' : [None if rnd.random() < 0.1 else rnd.randint(0, 500) for t in range(slices)] }
+                               for i in range(entries)]] } }
+
+def _benchmark(entries, slices):
+    # the two ways ExportServiceStats fetches a report, from a local server that answers with a synthetic one
+    import threading
+    import httpclient
+    from ExportServiceStats import postAndLoadJSON, postAndStreamReport
+    try:
+        from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    except ImportError:
+        from http.server import BaseHTTPRequestHandler, HTTPServer
+
+    body = json.dumps(_syntheticReport(entries, slices)).encode('utf-8')
+    print('{0} entries x {1} time slices, {2:.1f} MB response'.format(entries, slices, len(body) / 1e6))
+
+    class ReportHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_POST(self):
+            self.rfile.read(int(self.headers.get('content-length') or 0))
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args): pass
+
+    server = HTTPServer(('127.0.0.1', 0), ReportHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    url = 'http://127.0.0.1:{0}/arcgis/admin/usagereports/benchmark/data'.format(server.server_address[1])
+
+    def whole():
+        # what the exporters used to do: read() the whole response and json.loads it
+        return postAndLoadJSON(url, None, { 'filter' : '{}' })['report']
+
+    def streamed():
+        return postAndStreamReport(url, None, { 'filter' : '{}' })
+
+    try: import tracemalloc
+    except ImportError: tracemalloc = None # Python 2: timings only
+    try:
+        for name, run in (('read() and json.loads', whole), ('postAndStreamReport', streamed)):
+            if tracemalloc: tracemalloc.start()
+            begin = time.time()
+            report = run()
+            elapsed = time.time() - begin
+            total = sum(sum(count for count in entry['data'] if count) for entry in report['report-data'][0])
+            del report
+            if tracemalloc:
+                peak = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+                print('{0}: {1:.2f}s, peak {2:.1f} MB, {3} requests'.format(name, elapsed, peak / 1e6, total))
+            else: print('{0}: {1:.2f}s, {2} requests'.format(name, elapsed, total))
+    finally:
+        httpclient.closeAll()
+        server.shutdown()
+        server.server_close()
+
+if __name__ == '__main__':
+    _benchmark(int(sys.argv[1]) if len(sys.argv) > 1 else 1000, int(sys.argv[2]) if len(sys.argv) > 2 else 10000)
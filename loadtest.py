@@ -0,0 +1,166 @@
+"""Results and request sources shared by the BurstOfHttpRequests load engines.
+
+Latencies are recorded per label (a URL, or a request type for generated
+workloads) in HDR-style histograms that can be merged across threads and
+worker processes. Works with both Python 2.7 and Python 3."""
+
+from __future__ import print_function
+import sys, time, threading, itertools, json, csv
+
+timer = getattr(time, 'perf_counter', time.time)
+
+# requests are (label, url, body) tuples: body is sent url-encoded in a POST, or None for a GET
+pjsonBody = 'f=pjson'
+
+class LatencyHistogram(object):
+    # HDR-style histogram: values (in microseconds) are counted in buckets whose width grows with the
+    # value, which keeps ~3 significant digits of precision over any range in a small, mergeable dict
+    sub_bucket_bits = 11
+
+    def __init__(self):
+        self.counts = {}
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = 0
+
+    def record(self, seconds):
+        value = max(0, int(seconds * 1000000))
+        shift = max(0, value.bit_length() - self.sub_bucket_bits)
+        key = (value >> shift) << shift
+        self.counts[key] = self.counts.get(key, 0) + 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min: self.min = value
+        if value > self.max: self.max = value
+
+    def merge(self, other):
+        for key, n in other.counts.items(): self.counts[key] = self.counts.get(key, 0) + n
+        self.count += other.count
+        self.total += other.total
+        if other.min is not None and (self.min is None or other.min < self.min): self.min = other.min
+        self.max = max(self.max, other.max)
+
+    def percentile(self, p):
+        """Returns the value (in seconds) below which p percent of the recorded values fall."""
+        if self.count == 0: return 0.0
+        threshold = self.count * p / 100.0
+        seen = 0
+        for key in sorted(self.counts):
+            seen += self.counts[key]
+            if seen >= threshold: return min(key, self.max) / 1000000.0
+        return self.max / 1000000.0
+
+    def mean(self):
+        return self.total / 1000000.0 / self.count if self.count else 0.0
+
+class Results(object):
+    # latency histogram, error count and bytes received per label (a URL, or a request type for generated workloads)
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms = {}
+        self.errors = {}
+        self.bytes = {}
+        self.errorMessages = {}
+        self.start = None # wall clock times so results from several processes can be merged
+        self.end = None
+
+    def __getstate__(self):
+        # results are pickled when worker processes send them back to the parent
+        state = self.__dict__.copy()
+        del state['lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def record(self, label, seconds, size, error=None):
+        with self.lock:
+            if label not in self.histograms:
+                self.histograms[label] = LatencyHistogram()
+                self.errors[label] = 0
+                self.bytes[label] = 0
+            self.histograms[label].record(seconds)
+            self.bytes[label] += size
+            if error:
+                self.errors[label] += 1
+                self.errorMessages[error] = self.errorMessages.get(error, 0) + 1
+
+    def merge(self, other):
+        with self.lock:
+            for label, h in other.histograms.items():
+                if label not in self.histograms:
+                    self.histograms[label] = LatencyHistogram()
+                    self.errors[label] = 0
+                    self.bytes[label] = 0
+                self.histograms[label].merge(h)
+                self.errors[label] += other.errors[label]
+                self.bytes[label] += other.bytes[label]
+            for msg, n in other.errorMessages.items(): self.errorMessages[msg] = self.errorMessages.get(msg, 0) + n
+            if other.start is not None: self.start = other.start if self.start is None else min(self.start, other.start)
+            if other.end is not None: self.end = other.end if self.end is None else max(self.end, other.end)
+
+    def summary(self):
+        elapsed = (self.end - self.start) if self.start is not None and self.end is not None else 0.0
+        total = LatencyHistogram()
+        for h in self.histograms.values(): total.merge(h)
+        rows = []
+        for label in sorted(self.histograms) + [None]:
+            h = total if label is None else self.histograms[label]
+            errors = sum(self.errors.values()) if label is None else self.errors[label]
+            size = sum(self.bytes.values()) if label is None else self.bytes[label]
+            rows.append({ 'label' : 'TOTAL' if label is None else label, 'requests' : h.count, 'errors' : errors,
+                          'errorRate' : float(errors) / h.count if h.count else 0.0, 'bytes' : size,
+                          'throughput' : h.count / elapsed if elapsed else 0.0,
+                          'mean' : h.mean(), 'p50' : h.percentile(50), 'p90' : h.percentile(90), 'p99' : h.percentile(99),
+                          'p999' : h.percentile(99.9), 'max' : h.max / 1000000.0 })
+        return { 'elapsed' : elapsed, 'rows' : rows, 'errorMessages' : self.errorMessages }
+
+def readURLs(urlFilePath):
+    # one URL per line, each POSTed with f=pjson; each URL is its own label in the results
+    with open(urlFilePath, 'r') as urlFile:
+        return [(line.strip(), line.strip(), pjsonBody) for line in urlFile if line.strip()]
+
+def urlRequests(urls, cycle, index=0, count=1):
+    """Returns the requests worker index of count should send: every count-th URL for a single
+    pass, or all of them over and over (each worker starting at a different offset) for timed runs."""
+    if not cycle: return iter(urls[index::count])
+    offset = len(urls) * index // count
+    return itertools.cycle(urls[offset:] + urls[:offset])
+
+def responseError(status, body):
+    """Returns a short description of the error in a response, or None if it succeeded."""
+    if status >= 400: return 'HTTP {0}'.format(status)
+    # ArcGIS Server reports most errors with a 200 status and an error object
+    if b'"error"' in body[:64]: return 'error response'
+    return None
+
+def arrivalRate(rate, elapsed, rampUp):
+    # during ramp-up the arrival rate grows linearly from a tenth of the target rate
+    if not rampUp or elapsed >= rampUp: return rate
+    return rate * max(0.1, elapsed / rampUp)
+
+def printSummary(summary):
+    print('')
+    print('{0:<60} {1:>8} {2:>7} {3:>8} {4:>8} {5:>8} {6:>8} {7:>8}'.format('Request', 'requests', 'errors', 'p50 ms', 'p90 ms', 'p99 ms', 'p999 ms', 'max ms'))
+    for row in summary['rows']:
+        label = row['label'] if len(row['label']) <= 60 else '...' + row['label'][-57:]
+        print('{0:<60} {1:>8} {2:>7} {3:>8.1f} {4:>8.1f} {5:>8.1f} {6:>8.1f} {7:>8.1f}'.format(label, row['requests'], row['errors'],
+              row['p50'] * 1000, row['p90'] * 1000, row['p99'] * 1000, row['p999'] * 1000, row['max'] * 1000))
+    total = summary['rows'][-1]
+    print('')
+    print('Elapsed time in seconds: {0:.1f}'.format(summary['elapsed']))
+    print('Throughput: {0:.1f} requests/s, error rate: {1:.2%}, received: {2:.1f} MB'.format(
+          total['throughput'], total['errorRate'], total['bytes'] / 1048576.0))
+    for msg, n in sorted(summary['errorMessages'].items(), key=lambda item: -item[1]): print(' {0} x {1}'.format(n, msg))
+
+def writeResults(summary, jsonPath, csvPath):
+    if jsonPath:
+        with open(jsonPath, 'w') as f: json.dump(summary, f, indent=2)
+    if csvPath:
+        fields = ['label', 'requests', 'errors', 'errorRate', 'bytes', 'throughput', 'mean', 'p50', 'p90', 'p99', 'p999', 'max']
+        with (open(csvPath, 'wb') if sys.version_info[0] < 3 else open(csvPath, 'w', newline='')) as f:
+            writer = csv.DictWriter(f, fieldnames=fields)
+            writer.writeheader()
+            for row in summary['rows']: writer.writerow(row)
@@ -0,0 +1,204 @@
+"""Output layer for usage report data in the export scripts.
+
+Loads the time slices of a usage report into one array per report (a row per
+resource and metric, NaN where the server returned null) and computes totals,
+maximums, means and percentiles over whole rows at once instead of value by
+value. Writes the data as CSV, or as Parquet (.parquet) or Arrow (.arrow,
+.feather) files that BI tools read without parsing text again; the format is
+picked from the file extension.
+
+NumPy is used for the arrays when it is installed and pyarrow for Parquet and
+Arrow files; without NumPy the same results are computed in plain Python.
+Works with both Python 2.7 and Python 3.
+
+Run it directly to time aggregation and output on a synthetic report (the
+default 1,000 services x 100,000 time slices needs several GB of memory):
+    reportoutput.py [services] [time slices] [output file]"""
+
+import os
+import sys
+import csv
+import time
+import math
+import random
+
+try: import numpy
+except ImportError: numpy = None
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+    import pyarrow.feather
+except ImportError: pyarrow = None
+
+percentiles = (50, 95, 99) # percentiles computed per resource and metric
+
+_columnarFormats = ('.parquet', '.arrow', '.feather')
+
+def _openCSV(fileName):
+    if sys.version_info[0] < 3: return open(fileName, 'wb')
+    return open(fileName, 'w', newline='')
+
+def _formatTime(timeslice):
+    return time.strftime('%Y-%m-%d %H:%M', time.localtime(timeslice / 1000.0))
+
+def toArray(report):
+    """Returns the (resourceURI, metric-type) keys and the report's values: a NumPy array with a row per key and NaN for
+    null values, or a list of lists with None when NumPy is not installed."""
+    series = report['report-data'][0]
+    keys = [(serviceMetric['resourceURI'], serviceMetric['metric-type']) for serviceMetric in series]
+    if numpy is None: return keys, [serviceMetric['data'] for serviceMetric in series]
+    values = numpy.array([serviceMetric['data'] for serviceMetric in series], dtype=float) # None becomes NaN
+    return keys, values.reshape(len(keys), len(report['time-slices']))
+
+def _percentile(values, q):
+    # linear interpolation between the closest ranks, like numpy.percentile
+    position = (len(values) - 1) * q / 100.0
+    lower = int(math.floor(position))
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (position - lower)
+
+def _aggregatePython(keys, values):
+    rows = []
+    for key, data in zip(keys, values):
+        present = sorted(float(value) for value in data if value is not None)
+        row = { 'count' : len(present), 'total' : sum(present) }
+        row['max'] = present[-1] if present else None
+        row['mean'] = row['total'] / len(present) if present else None
+        for q in percentiles: row['p{0}'.format(q)] = _percentile(present, q) if present else None
+        rows.append(row)
+    return rows
+
+def _aggregateNumPy(keys, values):
+    count = numpy.sum(~numpy.isnan(values), axis=1)
+    columns = { 'count' : count, 'total' : numpy.nansum(values, axis=1) }
+    # sort every row once (NaN sorts last) and read the maximum and percentiles off the sorted values,
+    # which is much faster than numpy.nanpercentile's row by row fallback for arrays with NaN
+    ordered = numpy.sort(values, axis=1)
+    last = numpy.maximum(count - 1, 0)
+    rowIndex = numpy.arange(len(keys))
+    empty = count == 0
+    def pick(position):
+        lower = numpy.floor(position).astype(int)
+        upper = numpy.minimum(lower + 1, last)
+        low, high = ordered[rowIndex, lower], ordered[rowIndex, upper]
+        return numpy.where(empty, numpy.nan, low + (high - low) * (position - lower))
+    if values.shape[1]:
+        columns['max'] = pick(last.astype(float))
+        columns['mean'] = numpy.where(empty, numpy.nan, columns['total'] / numpy.maximum(count, 1))
+        for q in percentiles: columns['p{0}'.format(q)] = pick(last * q / 100.0)
+    else:
+        for name in ['max', 'mean'] + ['p{0}'.format(q) for q in percentiles]: columns[name] = numpy.full(len(keys), numpy.nan)
+
+    rows = []
+    for i in range(len(keys)):
+        row = dict((name, column[i].item()) for name, column in columns.items())
+        for name in row:
+            if row[name] != row[name]: row[name] = None # NaN
+        rows.append(row)
+    return rows
+
+def aggregate(report):
+    """Returns a dict per resource and metric with resourceURI, metric-type, count (of non-null slices), total, max,
+    mean and a pNN entry per percentile; all but count and total are None if every slice is null."""
+    keys, values = toArray(report)
+    rows = _aggregatePython(keys, values) if numpy is None else _aggregateNumPy(keys, values)
+    for (resource, metric), row in zip(keys, rows):
+        row['resourceURI'] = resource
+        row['metric-type'] = metric
+    return rows
+
+def isColumnar(fileName):
+    """Whether fileName is written as Parquet or Arrow rather than CSV."""
+    return os.path.splitext(fileName)[1].lower() in _columnarFormats
+
+def checkFormat(fileName):
+    """Raises RuntimeError if the format picked by the file extension can't be written, so scripts can fail before fetching data."""
+    if isColumnar(fileName) and pyarrow is None:
+        raise RuntimeError('The pyarrow package is required to write {0}'.format(fileName))
+
+def _writeArrowTable(fileName, table):
+    if os.path.splitext(fileName)[1].lower() == '.parquet': pyarrow.parquet.write_table(table, fileName)
+    else: pyarrow.feather.write_feather(table, fileName)
+
+def writeLongFormat(fileName, report):
+    """Writes the report as one row per resource, metric and time slice, in the format given by the file extension."""
+    timeslices = report['time-slices']
+    if not isColumnar(fileName):
+        output = _openCSV(fileName)
+        csvwriter = csv.writer(output, dialect='excel')
+        csvwriter.writerow(['Service Name', 'Metric', 'Time', 'Value'])
+        times = [_formatTime(timeslice) for timeslice in timeslices]
+        for serviceMetric in report['report-data'][0]:
+            for t, value in zip(times, serviceMetric['data']):
+                csvwriter.writerow([serviceMetric['resourceURI'], serviceMetric['metric-type'], t, value])
+        output.close()
+        return
+
+    checkFormat(fileName)
+    keys, values = toArray(report)
+    # the service and metric names are dictionary encoded, so each is stored once instead of once per time slice
+    resources = sorted(set(key[0] for key in keys))
+    metrics = sorted(set(key[1] for key in keys))
+    resourceIds = dict((resource, i) for i, resource in enumerate(resources))
+    metricIds = dict((metric, i) for i, metric in enumerate(metrics))
+    if numpy is None:
+        values = [value for data in values for value in data]
+        resourceIndex = [resourceIds[key[0]] for key in keys for t in timeslices]
+        metricIndex = [metricIds[key[1]] for key in keys for t in timeslices]
+        times = list(timeslices) * len(keys)
+    else:
+        values = values.ravel()
+        resourceIndex = numpy.repeat(numpy.array([resourceIds[key[0]] for key in keys], dtype=numpy.int32), len(timeslices))
+        metricIndex = numpy.repeat(numpy.array([metricIds[key[1]] for key in keys], dtype=numpy.int32), len(timeslices))
+        times = numpy.tile(numpy.array(timeslices, dtype=numpy.int64), len(keys))
+    table = pyarrow.table({
+        'service' : pyarrow.DictionaryArray.from_arrays(pyarrow.array(resourceIndex, pyarrow.int32()), pyarrow.array(resources)),
+        'metric' : pyarrow.DictionaryArray.from_arrays(pyarrow.array(metricIndex, pyarrow.int32()), pyarrow.array(metrics)),
+        'time' : pyarrow.array(times, pyarrow.int64()).cast(pyarrow.timestamp('ms')),
+        'value' : pyarrow.array(values, pyarrow.float64(), from_pandas=True) }) # NaN is stored as null
+    _writeArrowTable(fileName, table)
+
+def writeTable(fileName, header, rows):
+    """Writes a small table (e.g. totals per service) in the format given by the file extension."""
+    if not isColumnar(fileName):
+        output = _openCSV(fileName)
+        csvwriter = csv.writer(output, dialect='excel')
+        csvwriter.writerow(header)
+        for row in rows: csvwriter.writerow(row)
+        output.close()
+        return
+
+    checkFormat(fileName)
+    columns = list(zip(*rows)) if rows else [[] for name in header]
+    _writeArrowTable(fileName, pyarrow.table(dict((name, pyarrow.array(list(column))) for name, column in zip(header, columns))))
+
+def _benchmark(serviceCount, sliceCount, fileName):
+    rnd = random.Random(0)
+    start = 1704067200000
+    report = { 'time-slices' : [start + i * 60000 for i in range(sliceCount)], 'report-data' : [[
+        { 'resourceURI' : 'services/Service{0}.MapServer'.format(i), 'metric-type' : 'RequestCount',
+          'data' : [None if rnd.random() < 0.1 else rnd.randint(0, 500) for t in range(sliceCount)] }
+        for i in range(serviceCount)]] }
+    print('{0} services x {1} time slices, {2}'.format(serviceCount, sliceCount, 'NumPy' if numpy else 'plain Python (NumPy not installed)'))
+
+    # what ExportTotalRequests used to do
+    begin = time.time()
+    for serviceMetric in report['report-data'][0]:
+        totalCount = 0
+        for count in serviceMetric['data']:
+            if count: totalCount += int(count)
+    print('value by value totals: {0:.2f}s'.format(time.time() - begin))
+
+    begin = time.time()
+    aggregate(report)
+    print('aggregate (total, max, mean, percentiles): {0:.2f}s'.format(time.time() - begin))
+
+    if fileName:
+        begin = time.time()
+        writeLongFormat(fileName, report)
+        print('write {0}: {1:.2f}s, {2:.1f} MB'.format(fileName, time.time() - begin, os.path.getsize(fileName) / 1e6))
+
+if __name__ == '__main__':
+    _benchmark(int(sys.argv[1]) if len(sys.argv) > 1 else 1000, int(sys.argv[2]) if len(sys.argv) > 2 else 100000,
+               sys.argv[3] if len(sys.argv) > 3 else None)
@@ -0,0 +1,182 @@
+"""Catalog of the services in an ArcGIS Server site, shared by the scripts in this repository.
+
+Lists the root of the admin services directory and then every folder at
+the same time instead of one after another, asking for the service details
+(type, provider, ...) in the same listing so no request per service is
+needed. The catalog is kept in memory per site, so every part of a script
+gets the same one, and can optionally be cached on disk between runs: a
+cached catalog younger than max_age is used as is, an older one is checked
+with conditional requests (ETag / Last-Modified) and only the folders that
+changed are read again.
+
+Set the ARCGIS_SERVICE_CATALOG environment variable to the cache file to
+use, or assign cache_file. Works with both Python 2.7 and Python 3.
+
+Run it directly to time a crawl:
+    servicecatalog.py <admin url> <user name> <password>"""
+
+import os
+import sys
+import json
+import time
+import threading
+
+import atomicfile
+import httpclient
+import tokencache
+
+try: from urllib.parse import urlencode
+except ImportError: from urllib import urlencode
+
+cache_file = os.environ.get('ARCGIS_SERVICE_CATALOG') # JSON file with the catalogs listed so far, disabled when not set
+max_age = 600 # seconds a cached catalog is used without checking the server for changes
+crawl_thread_count = 8 # folders listed at the same time
+
+_catalogs = {}
+_catalogsLock = threading.Lock()
+_cacheFileLock = threading.Lock()
+
+class ServiceCatalog(object):
+    """The services of one site; each service is a dict with folder, serviceName, type, provider (None if the
+    server didn't report it), resource (e.g. 'services/folder/name.MapServer') and the rest of the service details."""
+    def __init__(self, adminUrl, services, folders):
+        self.adminUrl = adminUrl
+        self.services = services
+        self.folders = folders
+
+    def byType(self, serviceType):
+        return [service for service in self.services if service['type'] == serviceType]
+
+    def byProvider(self, provider):
+        return [service for service in self.services if service['provider'] == provider]
+
+    def byFolder(self, folder):
+        """Services in folder; '/' or '' for the root folder."""
+        folder = folder.strip('/')
+        return [service for service in self.services if service['folder'] == folder]
+
+    def resources(self):
+        """The resource URIs of all services, as used in usage report queries."""
+        return [service['resource'] for service in self.services]
+
+    def serviceUrl(self, service):
+        """The admin URL of a service."""
+        return '{0}/services/{1}'.format(self.adminUrl, service['resource'][len('services/'):])
+
+def _toService(folder, entry):
+    service = dict(entry)
+    service['folder'] = folder
+    service['provider'] = entry.get('provider')
+    name = '{0}.{1}'.format(entry['serviceName'], entry['type'])
+    service['resource'] = 'services/{0}/{1}'.format(folder, name) if folder else 'services/' + name
+    return service
+
+def _readCacheFile():
+    if not os.path.exists(cache_file): return {}
+    try:
+        with open(cache_file, 'r') as f: return json.load(f)
+    except (ValueError, IOError, OSError): return {} # corrupt file, start afresh
+
+def _loadCached(adminUrl):
+    if not cache_file: return None
+    with _cacheFileLock: return _readCacheFile().get(adminUrl)
+
+def _saveCached(adminUrl, entry):
+    if not cache_file: return
+    with _cacheFileLock:
+        entries = _readCacheFile()
+        entries[adminUrl] = entry
+        atomicfile.writeAtomically(cache_file, lambda f: json.dump(entries, f))
+
+def _getListing(url, tokens, cached):
+    # returns the listing at url (folder or root) as { 'etag', 'lastModified', 'body' }, reusing cached if unchanged
+    headers = {}
+    if cached:
+        if cached.get('etag'): headers['If-None-Match'] = cached['etag']
+        if cached.get('lastModified'): headers['If-Modified-Since'] = cached['lastModified']
+
+    def get(token):
+        params = { 'detail' : 'true', 'f' : 'json' }
+        if token: params['token'] = token
+        response = httpclient.request('GET', url + '?' + urlencode(params), headers=headers)
+        if response.getcode() == 304 and cached: return cached
+        if response.getcode() != 200: raise Exception('Error performing request to {0}'.format(url))
+        body = tokencache.checkToken(response.json())
+        if body.get('status') == 'error': raise Exception('Error returned by operation. ' + json.dumps(body))
+        return { 'etag' : response.headers.get('etag'), 'lastModified' : response.headers.get('last-modified'), 'body' : body }
+
+    if tokens: return tokens.call(get)
+    return get(None)
+
+def crawl(adminUrl, tokens, cached=None):
+    """Lists every folder of the site at adminUrl (e.g. http://server:6080/arcgis/admin) concurrently and returns
+    the listings by URL; cached are the listings of an earlier crawl, reused for folders that haven't changed."""
+    cached = cached or {}
+    rootUrl = adminUrl + '/services'
+    listings = { rootUrl : _getListing(rootUrl, tokens, cached.get(rootUrl)) }
+    folderUrls = ['{0}/{1}'.format(rootUrl, folder) for folder in listings[rootUrl]['body'].get('folders', [])]
+
+    pending = list(reversed(folderUrls))
+    errors = []
+    lock = threading.Lock()
+    def crawlThread():
+        while True:
+            with lock:
+                if not pending or errors: return
+                url = pending.pop()
+            try: listing = _getListing(url, tokens, cached.get(url))
+            except Exception as e:
+                with lock: errors.append(e)
+                return
+            with lock: listings[url] = listing
+
+    threadList = [threading.Thread(target=crawlThread) for i in range(min(crawl_thread_count, len(folderUrls)))]
+    for thread in threadList: thread.start()
+    for thread in threadList: thread.join()
+    if errors: raise errors[0]
+    return listings
+
+def _fromListings(adminUrl, listings):
+    rootUrl = adminUrl + '/services'
+    root = listings[rootUrl]['body']
+    folders = list(root.get('folders', []))
+    services = [_toService('', entry) for entry in root.get('services', [])]
+    for folder in folders:
+        for entry in listings['{0}/{1}'.format(rootUrl, folder)]['body'].get('services', []):
+            services.append(_toService(folder, entry))
+    return ServiceCatalog(adminUrl, services, folders)
+
+def load(adminUrl, tokens, refresh=False):
+    """Returns the catalog of the site at adminUrl, from the disk cache if it is fresh enough; refresh forces
+    checking the server for changes."""
+    adminUrl = adminUrl.rstrip('/')
+    cached = _loadCached(adminUrl)
+    if cached and not refresh and time.time() - cached['fetched'] < max_age: return _fromListings(adminUrl, cached['listings'])
+
+    fetched = time.time()
+    listings = crawl(adminUrl, tokens, cached['listings'] if cached else None)
+    _saveCached(adminUrl, { 'fetched' : fetched, 'listings' : listings })
+    return _fromListings(adminUrl, listings)
+
+def getCatalog(adminUrl, tokens, refresh=False):
+    """Returns the catalog of the site at adminUrl shared by all callers in this process, loading it on first use."""
+    key = adminUrl.rstrip('/')
+    with _catalogsLock:
+        if key in _catalogs and not refresh: return _catalogs[key]
+        _catalogs[key] = catalog = load(key, tokens, refresh)
+        return catalog
+
+def _benchmark(adminUrl, username, password):
+    tokens = tokencache.getTokenManager(adminUrl.rstrip('/') + '/generateToken', username, password)
+    tokens.getToken()
+    for name, refresh in (('crawl', True), ('from the cache file', False)):
+        if not refresh and not cache_file: break
+        begin = time.time()
+        catalog = load(adminUrl, tokens, refresh)
+        print('{0}: {1} services in {2} folders, {3:.2f}s'.format(name, len(catalog.services), len(catalog.folders), time.time() - begin))
+
+if __name__ == '__main__':
+    if len(sys.argv) < 4:
+        print('Usage: servicecatalog.py <admin url> <user name> <password>')
+        sys.exit(1)
+    _benchmark(sys.argv[1], sys.argv[2], sys.argv[3])
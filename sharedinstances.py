@@ -1,6 +1,32 @@
+import os
 import sys
+import json
+import math
+import time
+import socket
 import argparse
-import urllib
+import threading
+
+import atomicfile
+import httpclient
+import tokencache
+import servicecatalog
+import ExportServiceStats
+
+migrate_thread_count = 8 # maximum number of changeProvider calls (i.e. service restarts) in flight at the same time
+migrate_retry_count = 5 # times a changeProvider call is retried when the server is overloaded or unreachable
+migrate_backoff = 5 # seconds to wait before the first retry, doubled on every further retry
+journal_file = 'sharedinstances_journal.json' # default journal of the provider changes made, used by --rollback
+analysis_days = 7 # default number of days of usage statistics analyzed by --analyze
+analysis_interval = 60 # minutes per time slice of the usage statistics analyzed; the busiest slice is the peak
+busy_threshold = 0.25 # services keeping at most this many instances busy at their peak are suitable for the shared pool
+max_response_threshold = 30 # seconds; services with slower requests would tie up shared instances and are kept dedicated
+instance_memory_mb = 250 # estimated memory per ArcSOC process, for the memory freed by moving services
+pool_headroom = 2.0 # the shared pool is sized for this many times the combined peak of the services moved to it
+printLock = threading.Lock()
+
+class ServerBusyError(Exception):
+    pass
 
 def parseInputParameters():
     parser = argparse.ArgumentParser(description='List and optionally update map services in an ArcGIS Server site.')
@@ -8,78 +34,283 @@ def parseInputParameters():
     parser.add_argument('--user', help='Username of the administrative account', required=True)
     parser.add_argument('--password', help='Password of the specified user account.', required=True)
     parser.add_argument('--update', action='store_true', help='Specify this parameter to change all Pro-based services from dedicated to shared instances.')
+    parser.add_argument('--rollback', action='store_true', help='Specify this parameter to move the services changed by earlier updates (see --journal) back to dedicated instances.')
+    parser.add_argument('--threads', type=int, default=migrate_thread_count, help='Maximum number of services changed at the same time (default %(default)s).')
+    parser.add_argument('--journal', default=journal_file, help='File recording the provider changes made, read by --rollback (default %(default)s).')
+    parser.add_argument('--analyze', action='store_true', help='Specify this parameter to rank the Pro-based services by how suitable they are for the shared instance pool, from their usage statistics.')
+    parser.add_argument('--days', type=int, default=analysis_days, help='Days of usage statistics analyzed by --analyze (default %(default)s).')
 
     args = parser.parse_args()
 
     return args
 
-def listServices(server):
+def listServices(catalog):
     arcmapsvcs = []
     prosvcs = []
     sharedinstancesvcs = []
-    for folder in server.services.folders:
+    # the catalog lists every folder at once with the service details, so reading the provider costs no extra requests
+    for service in catalog.byType('MapServer'): # skip everything that's not a map service; we don't support anything else in the shared pool at 10.7.x
         # skip the system folders
-        if folder in ['Hosted', 'DataStoreCatalogs', 'System', 'Utilities']: continue
+        if service['folder'] in ['Hosted', 'DataStoreCatalogs', 'System', 'Utilities']: continue
 
-        for service in server.services.list(folder=folder):
-            # skip everything that's not a map service; we don't support anything else in the shared pool at 10.7.x
-            if service.properties['type'] != 'MapServer': continue
-
-            # the provider value is case-sensitive!
-            if service.properties['provider'] == 'ArcObjects': # provider='ArcObjects' means the service is running under the ArcMap runtime i.e. published from ArcMap
-                arcmapsvcs.append(service)
-            elif service.properties['provider'] == 'ArcObjects11': # provider='ArcObjects11' means the service is running under the ArcGIS Pro runtime i.e. published from ArcGIS Pro
-                prosvcs.append(service)
-            elif service.properties['provider'] == 'DMaps': # provider='DMaps' means the service is running in the shared instance pool (and thus running under the ArcGIS Pro provider runtime)
-                sharedinstancesvcs.append(service)
-            else: pass # whoa nelly! unknown type of provider.. must be a fancy new server released after this script was written
+        # the provider value is case-sensitive!
+        if service['provider'] == 'ArcObjects': # provider='ArcObjects' means the service is running under the ArcMap runtime i.e. published from ArcMap
+            arcmapsvcs.append(service)
+        elif service['provider'] == 'ArcObjects11': # provider='ArcObjects11' means the service is running under the ArcGIS Pro runtime i.e. published from ArcGIS Pro
+            prosvcs.append(service)
+        elif service['provider'] == 'DMaps': # provider='DMaps' means the service is running in the shared instance pool (and thus running under the ArcGIS Pro provider runtime)
+            sharedinstancesvcs.append(service)
+        else: pass # whoa nelly! unknown type of provider.. must be a fancy new server released after this script was written
 
     return (arcmapsvcs, prosvcs, sharedinstancesvcs)
 
-args = parseInputParameters()
-
-print('Connecting to %s..' % args.server)
-import arcgis.gis.server
-server = arcgis.gis.server.Server(args.server, username=args.user, password=args.password)
-
-print("Connected, enumerating services..")
-(arcmapsvcs, prosvcs, sharedinstancesvcs) = listServices(server)
-print()
-
-if len(arcmapsvcs) == 0:
-    print('There are no services published from ArcMap. Impressive!')
-else:
-    print('Services from ArcMap not eligible to run in the shared instance pool:')
-    for service in arcmapsvcs:
-        print('- ' + service.properties['serviceName'])
-        # imagine what uncommenting this would do..
-        #if args.update:
-        #   data = urllib.parse.urlencode({ 'token' : service._con.token, 'provider' : 'ArcObjects11', 'f' : 'json' }).encode('ascii')
-        #   with urllib.request.urlopen(service.url + '/changeProvider', data) as f:
-        #       print(f.read().decode('utf-8'))
-
-print()
-if len(prosvcs) == 0:
-    print('There are no services published from ArcGIS Pro that are running with dedicated instances.')
-else:
-    print('Services from ArcGIS Pro that may be eligible to run in the shared instance pool:')
+def changeProvider(tokens, catalog, service, provider):
+    # updating the provider can only be done via the dedicated changeProvider operation, it can't be  done by
+    # simply editing the service properties directly (backwards compatibility concession to avoid older
+    # ArcGIS Desktop clients from modifying this property incorrectly)
+    url = catalog.serviceUrl(service) + '/changeProvider'
+    def post(token):
+        try: response = httpclient.post(url, { 'token' : token, 'provider' : provider, 'f' : 'json' })
+        except (socket.error, IOError) as e: raise ServerBusyError('Unable to reach {0}: {1}'.format(url, e))
+        if response.getcode() >= 500: raise ServerBusyError('HTTP {0} from {1}'.format(response.getcode(), url))
+        result = tokencache.checkToken(response.json())
+        if result.get('status') == 'error': raise Exception('Error returned by changeProvider: ' + json.dumps(result))
+        return result
+    return tokens.call(post)
+
+def loadJournal(path, adminUrl):
+    if not os.path.exists(path): return { 'server' : adminUrl, 'changes' : {} }
+    with open(path, 'r') as f: journal = json.load(f)
+    if journal['server'] != adminUrl: raise Exception('The journal {0} was written for {1}'.format(path, journal['server']))
+    return journal
+
+def saveJournal(path, journal):
+    # replaced in one step, so an interrupted run never leaves a truncated journal (or none) behind
+    atomicfile.writeAtomically(path, lambda f: json.dump(journal, f, indent=2))
+
+class Throttle(object):
+    """Limits the number of calls in flight; the limit is halved whenever the server is overloaded and grows back
+    by one with every call that succeeds."""
+    def __init__(self, limit):
+        self.maxLimit = limit
+        self.limit = limit
+        self.running = 0
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        with self.condition:
+            while self.running >= self.limit: self.condition.wait()
+            self.running += 1
+
+    def release(self, busy):
+        with self.condition:
+            self.running -= 1
+            if busy: self.limit = max(1, self.limit // 2)
+            else: self.limit = min(self.maxLimit, self.limit + 1)
+            self.condition.notify_all()
+
+def migrate(tokens, catalog, changes, threadCount, done):
+    """Calls changeProvider for every (service, provider) in changes with up to threadCount calls at a time,
+    calling done(service, provider) after each change; returns the list of (service, error) that failed."""
+    pending = list(reversed(changes))
+    failed = []
+    completed = [0]
+    lock = threading.Lock()
+    throttle = Throttle(threadCount)
+    started = time.time()
+
+    def progress():
+        # throughput and estimated time left, from the services changed so far
+        elapsed = time.time() - started
+        finished = completed[0] + len(failed)
+        rate = finished / elapsed if elapsed > 0 else 0
+        eta = (len(changes) - finished) / rate if rate else 0
+        return '{0}/{1}, {2:.1f} services/min, ETA {3:.0f}m{4:02.0f}s'.format(finished, len(changes), rate * 60, eta // 60, eta % 60)
+
+    def migrateThread():
+        while True:
+            with lock:
+                if not pending: return
+                service, provider = pending.pop()
+
+            error = None
+            for attempt in range(migrate_retry_count + 1):
+                throttle.acquire()
+                try:
+                    changeProvider(tokens, catalog, service, provider)
+                    throttle.release(False)
+                    error = None
+                    break
+                except ServerBusyError as e:
+                    throttle.release(True)
+                    error = e
+                    if attempt < migrate_retry_count: time.sleep(migrate_backoff * 2 ** attempt)
+                except Exception as e:
+                    throttle.release(False)
+                    error = e
+                    break
+
+            with lock:
+                if error is None:
+                    completed[0] += 1
+                    done(service, provider)
+                else: failed.append((service, error))
+                status = progress()
+            with printLock:
+                if error is None: print('- {0} -> {1} ({2})'.format(service['resource'], provider, status))
+                else: print('- {0} FAILED: {1} ({2})'.format(service['resource'], error, status))
+
+    threadList = [threading.Thread(target=migrateThread) for i in range(min(threadCount, len(changes)))]
+    for thread in threadList: thread.start()
+    for thread in threadList: thread.join()
+    return failed
+
+def update(tokens, catalog, prosvcs, journalPath, threadCount):
+    # switch Pro-based services to the shared instance pool, journaling every change as soon as it is made
+    journal = loadJournal(journalPath, catalog.adminUrl)
+    def done(service, provider):
+        journal['changes'][service['resource']] = { 'serviceName' : service['serviceName'], 'from' : service['provider'], 'to' : provider, 'time' : int(time.time()) }
+        saveJournal(journalPath, journal)
+
+    print('Moving {0} services to the shared instance pool, {1} at a time; changes are recorded in {2}'.format(len(prosvcs), threadCount, journalPath))
+    return migrate(tokens, catalog, [(service, 'DMaps') for service in prosvcs], threadCount, done)
+
+def rollback(tokens, catalog, journalPath, threadCount):
+    # move the journaled services back to the provider they had, unless they have been changed again since
+    journal = loadJournal(journalPath, catalog.adminUrl)
+    services = dict((service['resource'], service) for service in catalog.services)
+    changes = []
+    for resource, change in sorted(journal['changes'].items()):
+        service = services.get(resource)
+        if service is None or service['provider'] != change['to']:
+            print('- {0} skipped, no longer running with provider {1}'.format(resource, change['to']))
+            continue
+        changes.append((service, change['from']))
+
+    def done(service, provider):
+        del journal['changes'][service['resource']]
+        saveJournal(journalPath, journal)
+
+    print('Moving {0} services back to dedicated instances, {1} at a time'.format(len(changes), threadCount))
+    return migrate(tokens, catalog, changes, threadCount, done)
+
+def fetchUsage(tokens, adminUrl, resources, metrics, fromTime, toTime, interval):
+    """Returns { (resourceURI, metric) : [value per time slice] } from temporary usage reports, fetched in batches
+    and time windows by ExportServiceStats."""
+    siteURL = adminUrl[:-len('/admin')] if adminUrl.endswith('/admin') else adminUrl
+    report = ExportServiceStats.fetchUsageReport(siteURL, tokens, resources, metrics, fromTime, toTime, interval)
+    return dict(((serviceMetric['resourceURI'], serviceMetric['metric-type']), serviceMetric['data'])
+                for serviceMetric in report['report-data'][0])
+
+def analyze(tokens, catalog, prosvcs, days):
+    """Returns a row per service with its usage, peak concurrency and whether it is suitable for the shared pool,
+    most suitable first."""
+    toTime = int(time.time() * 1000)
+    fromTime = toTime - days * 24 * 3600 * 1000
+    series = fetchUsage(tokens, catalog.adminUrl, [service['resource'] for service in prosvcs],
+                        ['RequestCount', 'RequestAvgResponseTime', 'RequestMaxResponseTime'], fromTime, toTime, analysis_interval)
+
+    rows = []
     for service in prosvcs:
-        print('- ' + service.properties['serviceName'])
-
-        # switch Pro-based service to shared instance pool
-        if args.update:
-            # updating the provider can only be done via the dedicated changeProvider operation, it can't be  done by 
-            # simply editing the service properties directly (backwards compatibility concession to avoid older 
-            # ArcGIS Desktop clients from modifying this property incorrectly)
-            data = urllib.parse.urlencode({ 'token' : service._con.token, 'provider' : 'DMaps', 'f' : 'json' }).encode('ascii')
-            with urllib.request.urlopen(service.url + '/changeProvider', data) as f:
-                print(f.read().decode('utf-8'))
-
-print()
-
-if len(sharedinstancesvcs) == 0:
-    print('There are no services published from ArcGIS Pro that are running in the shared instance pool.')
-else:
-    print('Services from ArcGIS Pro already running in the shared instance pool:')
-    for service in sharedinstancesvcs:
-        print('- ' + service.properties['serviceName'])
+        counts = series.get((service['resource'], 'RequestCount'), [])
+        averages = series.get((service['resource'], 'RequestAvgResponseTime'), [])
+        maximums = series.get((service['resource'], 'RequestMaxResponseTime'), [])
+        requests = sum(count or 0 for count in counts)
+        # response times in milliseconds, weighted by the requests in each time slice
+        busyMs = [(count or 0) * (average or 0) for count, average in zip(counts, averages)]
+        averageMs = sum(busyMs) / requests if requests else 0
+        maxMs = max([maximum or 0 for maximum in maximums] or [0])
+        # instances busy on average during the busiest time slice (Little's law: arrival rate x time in service)
+        peakBusy = max(busyMs or [0]) / (analysis_interval * 60 * 1000.0)
+        minInstances = service.get('minInstancesPerNode')
+        maxInstances = service.get('maxInstancesPerNode')
+        if minInstances is None or maxInstances is None:
+            # older servers leave the instance settings out of the folder listing
+            details = tokens.postJSON(catalog.serviceUrl(service), { 'f' : 'json' })
+            minInstances, maxInstances = details.get('minInstancesPerNode', 1), details.get('maxInstancesPerNode', 2)
+        rows.append({ 'service' : service, 'requests' : requests, 'averageMs' : averageMs, 'maxMs' : maxMs, 'peakBusy' : peakBusy,
+                      'minInstances' : minInstances, 'maxInstances' : maxInstances,
+                      'suitable' : peakBusy <= busy_threshold and maxMs <= max_response_threshold * 1000 })
+
+    # suitable services first, the ones that would take the least of the pool first among them
+    rows.sort(key=lambda row: (not row['suitable'], row['peakBusy'], row['maxMs']))
+    return rows
+
+def printAnalysis(rows, days):
+    print('Suitability for the shared instance pool, from {0} days of usage statistics:'.format(days))
+    print('{0:<50} {1:>10} {2:>8} {3:>9} {4:>9} {5:>7}  {6}'.format('Service', 'Requests', 'Avg ms', 'Max ms', 'Peak busy', 'Min/max', 'Advice'))
+    for row in rows:
+        print('{0:<50} {1:>10} {2:>8.0f} {3:>9.0f} {4:>9.2f} {5:>7}  {6}'.format(row['service']['resource'][len('services/'):], row['requests'],
+              row['averageMs'], row['maxMs'], row['peakBusy'], '{0}/{1}'.format(row['minInstances'], row['maxInstances']),
+              'shared' if row['suitable'] else 'keep dedicated'))
+
+    suitable = [row for row in rows if row['suitable']]
+    # moved services no longer keep their minimum instances running on every machine
+    processes = sum(row['minInstances'] for row in suitable)
+    poolSize = int(math.ceil(sum(row['peakBusy'] for row in suitable) * pool_headroom)) if suitable else 0
+    print()
+    print('{0} of {1} services are suitable for the shared instance pool.'.format(len(suitable), len(rows)))
+    print('Moving them frees {0} ArcSOC processes per machine (about {1:.1f} GB at {2} MB each)'.format(
+          processes, processes * instance_memory_mb / 1024.0, instance_memory_mb))
+    print('and needs a shared pool of at least {0} instances per machine ({1}x their combined peak).'.format(max(1, poolSize), pool_headroom))
+
+def main():
+    args = parseInputParameters()
+
+    print('Connecting to %s..' % args.server)
+    adminUrl = args.server.rstrip('/') + '/admin'
+    tokens = tokencache.getTokenManager(adminUrl + '/generateToken', args.user, args.password)
+    tokens.getToken()
+
+    print("Connected, enumerating services..")
+    # refreshed when changing services, so the providers are the ones the server has now
+    catalog = servicecatalog.getCatalog(adminUrl, tokens, refresh=args.update or args.rollback)
+
+    if args.rollback:
+        failed = rollback(tokens, catalog, args.journal, args.threads)
+        print()
+        print('Rollback done, {0} services failed.'.format(len(failed)))
+        return 1 if failed else 0
+
+    (arcmapsvcs, prosvcs, sharedinstancesvcs) = listServices(catalog)
+    print()
+
+    if args.analyze:
+        if not prosvcs: print('There are no services published from ArcGIS Pro that are running with dedicated instances.')
+        else: printAnalysis(analyze(tokens, catalog, prosvcs, args.days), args.days)
+        return 0
+
+    if len(arcmapsvcs) == 0:
+        print('There are no services published from ArcMap. Impressive!')
+    else:
+        print('Services from ArcMap not eligible to run in the shared instance pool:')
+        for service in arcmapsvcs:
+            print('- ' + service['serviceName'])
+            # imagine what changing these to 'ArcObjects11' with changeProvider would do..
+
+    print()
+    if len(prosvcs) == 0:
+        print('There are no services published from ArcGIS Pro that are running with dedicated instances.')
+    else:
+        print('Services from ArcGIS Pro that may be eligible to run in the shared instance pool:')
+        for service in prosvcs:
+            print('- ' + service['serviceName'])
+
+    print()
+
+    if len(sharedinstancesvcs) == 0:
+        print('There are no services published from ArcGIS Pro that are running in the shared instance pool.')
+    else:
+        print('Services from ArcGIS Pro already running in the shared instance pool:')
+        for service in sharedinstancesvcs:
+            print('- ' + service['serviceName'])
+
+    if args.update and prosvcs:
+        print()
+        failed = update(tokens, catalog, prosvcs, args.journal, args.threads)
+        print()
+        print('Update done, {0} services failed; run with --rollback to undo.'.format(len(failed)))
+        return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
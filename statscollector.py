@@ -0,0 +1,194 @@
+# Collects ArcGIS Server usage statistics continuously and serves them as an OpenMetrics (Prometheus) endpoint
+# ArcGIS Server 10.3 or higher
+
+# Every poll creates temporary usage reports for the last few minutes through the same code as
+# ExportServiceStats.py, keeps a rolling window of time slices per service in memory and serves the
+# latest complete slice and the rolling window's totals at http://<host>:<listen port>/metrics
+
+# For usage reports, tokens, the list of services and the site URL
+import ExportServiceStats, servicecatalog, exportjobs
+# For time-based functions
+import time
+# For system tools
+import sys, os
+# For command line arguments and reading passwords without echoing
+import argparse, getpass
+# For polling in the background while serving the endpoint
+import threading
+
+try: from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+except ImportError: from http.server import BaseHTTPRequestHandler, HTTPServer
+try: from SocketServer import ThreadingMixIn
+except ImportError: from socketserver import ThreadingMixIn
+
+poll_seconds = 60 # seconds between polls of the server
+trailing_minutes = 5 # every poll fetches this many minutes before now, so late and corrected slices are picked up
+retention_minutes = 15 # time slices kept in memory per service and metric; the window totals are over this range
+slice_lag_seconds = 30 # a one minute slice is only reported once it ended this long ago, when the server has aggregated it
+catalog_refresh_polls = 60 # the list of services is refreshed every this many polls
+listen_port = 9420 # port the /metrics endpoint is served on
+
+metrics = ['RequestCount', 'RequestsFailed', 'RequestsTimedOut', 'RequestMaxResponseTime', 'RequestAvgResponseTime']
+
+# OpenMetrics name, help text and scale (response times are reported in milliseconds, exposed in seconds)
+_families = {
+    'RequestCount' : ('arcgis_service_requests', 'Requests per time slice', 1),
+    'RequestsFailed' : ('arcgis_service_requests_failed', 'Failed requests per time slice', 1),
+    'RequestsTimedOut' : ('arcgis_service_requests_timed_out', 'Timed out requests per time slice', 1),
+    'RequestMaxResponseTime' : ('arcgis_service_max_response_time_seconds', 'Maximum response time', 0.001),
+    'RequestAvgResponseTime' : ('arcgis_service_avg_response_time_seconds', 'Average response time', 0.001) }
+
+class RollingStats(object):
+    """The one minute time slices of the last retention_minutes per (service, metric), filled in by the poller."""
+    def __init__(self):
+        self.series = {} # (resourceURI, metric) -> { time slice : value }
+        self.lastPoll = 0
+        self.pollDuration = 0
+        self.pollErrors = 0
+        self.lock = threading.Lock()
+
+    def add(self, report, now):
+        with self.lock:
+            for serviceMetric in report['report-data'][0]:
+                values = self.series.setdefault((serviceMetric['resourceURI'], serviceMetric['metric-type']), {})
+                values.update(zip(report['time-slices'], serviceMetric['data']))
+            oldest = (now - retention_minutes * 60) * 1000
+            for values in self.series.values():
+                for t in [t for t in values if t < oldest]: del values[t]
+
+    def render(self, now):
+        """Returns the OpenMetrics text exposition: per service and metric the latest complete slice (window="1m")
+        and the rolling window (window="<retention>m": total for counts, maximum, request-weighted mean)."""
+        completeBefore = (now - slice_lag_seconds - 60) * 1000 # slices are labeled with their start time
+        window = '{0}m'.format(retention_minutes)
+        with self.lock:
+            lines = []
+            for metric in metrics:
+                name, description, scale = _families[metric]
+                lines.append('# TYPE {0} gauge'.format(name))
+                lines.append('# HELP {0} {1}'.format(name, description))
+                for (resource, seriesMetric), values in sorted(self.series.items()):
+                    if seriesMetric != metric: continue
+                    complete = sorted(t for t in values if t <= completeBefore)
+                    if not complete: continue
+                    labels = 'service="{0}"'.format(resource.replace('\\', '\\\\').replace('"', '\\"'))
+                    latest = values[complete[-1]]
+                    if latest is not None: lines.append('{0}{{{1},window="1m"}} {2}'.format(name, labels, latest * scale))
+                    present = [(t, values[t]) for t in complete if values[t] is not None]
+                    if not present: continue
+                    if metric == 'RequestMaxResponseTime': total = max(value for t, value in present)
+                    elif metric == 'RequestAvgResponseTime':
+                        counts = self.series.get((resource, 'RequestCount'), {})
+                        weights = [(counts.get(t) or 0, value) for t, value in present]
+                        requests = sum(count for count, value in weights)
+                        total = sum(count * value for count, value in weights) / float(requests) if requests else 0
+                    else: total = sum(value for t, value in present)
+                    lines.append('{0}{{{1},window="{2}"}} {3}'.format(name, labels, window, total * scale))
+            lines.append('# TYPE arcgis_collector_last_poll_timestamp_seconds gauge')
+            lines.append('arcgis_collector_last_poll_timestamp_seconds {0}'.format(self.lastPoll))
+            lines.append('# TYPE arcgis_collector_poll_duration_seconds gauge')
+            lines.append('arcgis_collector_poll_duration_seconds {0}'.format(self.pollDuration))
+            lines.append('# TYPE arcgis_collector_poll_errors counter')
+            lines.append('arcgis_collector_poll_errors_total {0}'.format(self.pollErrors))
+            lines.append('# EOF')
+            return '\n'.join(lines) + '\n'
+
+def poll(siteURL, tokens, services, stats):
+    # one temporary report per batch of services for the trailing minutes, fetched in parallel
+    now = time.time()
+    toTime = int(now * 1000)
+    fromTime = toTime - trailing_minutes * 60 * 1000
+    batches = [services[i:i + ExportServiceStats.report_batch_size] for i in range(0, len(services), ExportServiceStats.report_batch_size)]
+    errors = []
+    lock = threading.Lock()
+
+    def pollThread():
+        while True:
+            with lock:
+                if not batches: return
+                batch = batches.pop()
+            queries = [{ 'resourceURIs' : batch, 'metrics' : metrics }]
+            try: stats.add(ExportServiceStats.fetchReportWindow(siteURL, tokens, queries, fromTime, toTime, 1), now)
+            except Exception as e:
+                with lock: errors.append(e)
+
+    threadList = [threading.Thread(target=pollThread) for i in range(min(ExportServiceStats.fetch_thread_count, len(batches)))]
+    for thread in threadList: thread.start()
+    for thread in threadList: thread.join()
+
+    with stats.lock:
+        stats.lastPoll = now
+        stats.pollDuration = time.time() - now
+        stats.pollErrors += len(errors)
+    if errors: print("Poll failed for {0} reports: {1}".format(len(errors), errors[0]))
+
+def collect(siteURL, tokens, serviceName, stats):
+    polls = 0
+    services = []
+    while True:
+        started = time.time()
+        try:
+            if serviceName != '*': services = [serviceName]
+            elif polls % catalog_refresh_polls == 0:
+                services = servicecatalog.getCatalog(siteURL + "/admin", tokens, refresh=polls > 0).resources()
+            poll(siteURL, tokens, services, stats)
+        except Exception as e:
+            with stats.lock: stats.pollErrors += 1
+            print("Poll failed: {0}".format(e))
+        polls += 1
+        time.sleep(max(0, poll_seconds - (time.time() - started)))
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+def serve(stats, port):
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+            body = stats.render(time.time()).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/openmetrics-text; version=1.0.0; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args): pass
+
+    _ThreadingHTTPServer(('', port), MetricsHandler).serve_forever()
+
+# Defines the entry point into the script
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Collect ArcGIS Server usage statistics and serve them as an OpenMetrics endpoint.')
+    parser.add_argument('--server', help='Name of the ArcGIS Server machine', required=True)
+    parser.add_argument('--port', type=int, default=6080, help='ArcGIS Server port (default %(default)s, 6443 for HTTPS)')
+    parser.add_argument('--https', action='store_true', help='Connect over HTTPS')
+    parser.add_argument('--context', default='arcgis', help='Web context of the site (default %(default)s)')
+    parser.add_argument('--user', help='Administrator or publisher user name', required=True)
+    parser.add_argument('--password', help='Password; read from the ARCGIS_PASSWORD environment variable or asked for when not given')
+    parser.add_argument('--service', default='*', help='Service name and type (e.g. planning/firehydrants.MapServer), or * for all services in the site (default)')
+    parser.add_argument('--listen', type=int, default=listen_port, help='Port to serve /metrics on (default %(default)s)')
+    args = parser.parse_args(argv)
+
+    password = args.password or os.environ.get('ARCGIS_PASSWORD') or getpass.getpass("Enter password: ")
+    serviceName = args.service
+    if serviceName != '*' and not serviceName.startswith('services/'): serviceName = "services/" + serviceName
+
+    siteURL = exportjobs.siteURL({ 'server' : args.server, 'port' : args.port, 'https' : args.https, 'context' : args.context })
+    tokens = ExportServiceStats.getToken(args.user, password, siteURL)
+    if not tokens:
+        print("Could not generate a token with the username and password provided.")
+        return 1
+
+    stats = RollingStats()
+    collector = threading.Thread(target=collect, args=(siteURL, tokens, serviceName, stats))
+    collector.daemon = True
+    collector.start()
+
+    print("Serving metrics on http://localhost:{0}/metrics".format(args.listen))
+    serve(stats, args.listen)
+
+# Script start
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,115 @@
+"""Local store of ArcGIS Server usage statistics for the export scripts.
+
+Keeps the time slices already fetched from usage reports in a SQLite file,
+per site, resource, metric and aggregation interval, together with the range of
+time each of them is known to cover. A scheduled export then only asks the
+server for the time after what it already has (and before, if the range was
+extended backwards) and answers the rest of the range from the local copy,
+so every run costs as much as the new data instead of the whole history.
+
+The last few minutes before a fetch are not marked as covered, because the
+server may still be aggregating them; the next run fetches them again and
+replaces the stored values. Set the ARCGIS_STATS_STORE environment variable
+to the file to use, or assign store_file; one file can be shared by the
+exports of many sites, also running at the same time (see exportjobs.py).
+Works with both Python 2.7 and Python 3."""
+
+import os
+import time
+import sqlite3
+import threading
+
+store_file = os.environ.get('ARCGIS_STATS_STORE') # SQLite file with the statistics fetched so far, disabled when not set
+settle_seconds = 300 # statistics younger than this are fetched again on the next run
+busy_timeout = 60 # seconds to wait for another export writing to the same file
+
+_writeLock = threading.Lock() # one writer at a time within a process; SQLite's own locking between processes
+
+_schema = '''
+CREATE TABLE IF NOT EXISTS slices (
+    site TEXT NOT NULL, resource TEXT NOT NULL, metric TEXT NOT NULL, interval INTEGER NOT NULL, time INTEGER NOT NULL, value NUMERIC,
+    PRIMARY KEY (site, resource, metric, interval, time));
+CREATE TABLE IF NOT EXISTS coverage (
+    site TEXT NOT NULL, resource TEXT NOT NULL, metric TEXT NOT NULL, interval INTEGER NOT NULL, fromTime INTEGER NOT NULL, toTime INTEGER NOT NULL,
+    PRIMARY KEY (site, resource, metric, interval));
+'''
+
+class StatsStore(object):
+    """Time slices of usage statistics per (site, resource, metric, interval); sites are site URLs (e.g.
+    https://server:6443/arcgis) and times are epoch milliseconds. Open one per thread."""
+    def __init__(self, path):
+        self.path = path
+        self.db = sqlite3.connect(path, timeout=busy_timeout)
+        with _writeLock:
+            # stores written before statistics were kept per site can't tell the sites apart; they are a cache, start afresh
+            columns = [row[1] for row in self.db.execute('PRAGMA table_info(slices)')]
+            if columns and 'site' not in columns: self.db.executescript('DROP TABLE slices; DROP TABLE coverage;')
+            self.db.executescript(_schema)
+
+    def close(self):
+        self.db.close()
+
+    def _coverage(self, site, resource, metric, interval):
+        return self.db.execute('SELECT fromTime, toTime FROM coverage WHERE site=? AND resource=? AND metric=? AND interval=?',
+                               (site, resource, metric, interval)).fetchone()
+
+    def missingRanges(self, site, resource, metric, interval, fromTime, toTime):
+        """Returns the (from, to) ranges within fromTime-toTime that still have to be fetched from the server."""
+        covered = self._coverage(site, resource, metric, interval)
+        if covered is None: return [(fromTime, toTime)]
+        # a range that doesn't overlap the covered one is fetched up to it, so the covered range never has holes
+        ranges = []
+        if fromTime < covered[0]: ranges.append((fromTime, covered[0]))
+        if toTime > covered[1]:
+            # start at the last stored slice so the new slices line up with the server's grid
+            last = self.db.execute('SELECT MAX(time) FROM slices WHERE site=? AND resource=? AND metric=? AND interval=? AND time<=?',
+                                   (site, resource, metric, interval, covered[1])).fetchone()[0]
+            ranges.append((last or covered[1], toTime))
+        return ranges
+
+    def addReport(self, site, report, interval, fromTime, toTime, fetched=None):
+        """Stores the time slices of a usage report fetched for fromTime-toTime and extends the covered range."""
+        if fetched is None: fetched = time.time()
+        settledTo = min(toTime, int((fetched - settle_seconds) * 1000))
+        timeslices = report['time-slices']
+        with _writeLock, self.db:
+            for serviceMetric in report['report-data'][0]:
+                key = (site, serviceMetric['resourceURI'], serviceMetric['metric-type'], interval)
+                self.db.executemany('INSERT OR REPLACE INTO slices VALUES (?, ?, ?, ?, ?, ?)',
+                                    [key + (t, value) for t, value in zip(timeslices, serviceMetric['data'])])
+                if settledTo <= fromTime: continue # nothing in this range has settled yet
+                coveredFrom, coveredTo = fromTime, settledTo
+                covered = self._coverage(*key)
+                if covered is not None and fromTime <= covered[1] and settledTo >= covered[0]:
+                    coveredFrom, coveredTo = min(fromTime, covered[0]), max(settledTo, covered[1])
+                self.db.execute('INSERT OR REPLACE INTO coverage VALUES (?, ?, ?, ?, ?, ?)', key + (coveredFrom, coveredTo))
+
+    def report(self, site, resources, metrics, interval, fromTime, toTime):
+        """Returns the stored slices for fromTime-toTime in the shape of a usage report's 'report' object."""
+        series = {}
+        for resource, metric, t, value in self.db.execute(
+                'SELECT resource, metric, time, value FROM slices WHERE site=? AND interval=? AND time>=? AND time<=?', (site, interval, fromTime, toTime)):
+            series.setdefault((resource, metric), {})[t] = value
+        keys = [(resource, metric) for resource in resources for metric in metrics]
+        timeslices = sorted(set(t for key in keys for t in series.get(key, {})))
+
+        reportData = []
+        for resource, metric in keys:
+            values = series.get((resource, metric), {})
+            reportData.append({ 'resourceURI' : resource, 'metric-type' : metric, 'data' : [values.get(t) for t in timeslices] })
+        return { 'time-slices' : timeslices, 'report-data' : [reportData] }
+
+def fetchIncremental(store, site, fetch, resources, metrics, interval, fromTime, toTime):
+    """Fetches what the store is missing of site for fromTime-toTime with fetch(resources, fromTime, toTime), which
+    returns a usage report's 'report' object, and returns the whole range from the store."""
+    # resources missing the same range are fetched together in one report
+    pending = {}
+    for resource in resources:
+        ranges = set()
+        for metric in metrics: ranges.update(store.missingRanges(site, resource, metric, interval, fromTime, toTime))
+        for missing in ranges: pending.setdefault(missing, []).append(resource)
+
+    for (missingFrom, missingTo), missingResources in sorted(pending.items()):
+        fetched = time.time()
+        store.addReport(site, fetch(missingResources, missingFrom, missingTo), interval, missingFrom, missingTo, fetched)
+    return store.report(site, resources, metrics, interval, fromTime, toTime)
@@ -0,0 +1,376 @@
+"""Harness for the publishing job poller of PublishAllSDsinFolder.py.
+
+Runs the pollers against a local fake GP server whose jobs wait, execute and
+finish on a schedule, and checks that every job is reported as soon as the
+backoff allows, failed jobs keep their messages and jobs whose status can't
+be read are given up on. Also runs uploads in parts against a local fake of
+the uploads endpoints, and checks that an interrupted upload resumes with the
+missing parts only, that its journal is dropped when the file changes and
+that the parts are committed in order. PublishAllSDsinFolder.py is a Python
+2.7 script, so these tests run with Python 2.7:
+    python -m unittest test_publishing
+
+Run it directly with a number of jobs to measure how long it takes to notice
+that a job has finished:
+    test_publishing.py benchmark [number of jobs]"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import threading
+import unittest
+
+try:
+    import Queue
+    import urlparse
+    import PublishAllSDsinFolder as publisher
+    import httpclient
+    import tokencache
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+except ImportError:
+    raise unittest.SkipTest('PublishAllSDsinFolder.py runs on Python 2.7 only')
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    request_queue_size = 128 # every poller connects at once
+
+class FakeGPServer(object):
+    """A Publish Service Definition job service; addJob schedules when a job starts executing and finishes, and
+    finishedSeen records when each finished job was first reported to a status check."""
+    def __init__(self):
+        self.jobs = {} # jobid -> (executing at, finished at, final status, messages); final status None fails every check
+        self.finishedSeen = {}
+        self.checks = {}
+        self.lock = threading.Lock()
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            wbufsize = -1 # headers and body in one write, or delayed ACKs add 40ms to every check
+
+            def do_POST(self):
+                self.rfile.read(int(self.headers.getheader('content-length') or 0))
+                jobid = self.path.split('?')[0].split('/')[-1]
+                status, body = server.status(jobid)
+                data = json.dumps(body)
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args): pass
+
+        self.httpd = _ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.baseurl = 'http://127.0.0.1:{0}'.format(self.httpd.server_address[1])
+        thread = threading.Thread(target=self.httpd.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def addJob(self, jobid, waitSeconds, executeSeconds, finalStatus='esriJobSucceeded', messages=()):
+        now = time.time()
+        with self.lock:
+            self.jobs[jobid] = (now + waitSeconds, now + waitSeconds + executeSeconds, finalStatus, list(messages))
+
+    def finishedAt(self, jobid):
+        return self.jobs[jobid][1]
+
+    def status(self, jobid):
+        now = time.time()
+        with self.lock:
+            self.checks[jobid] = self.checks.get(jobid, 0) + 1
+            if jobid not in self.jobs: return 404, { 'error' : { 'code' : 404, 'message' : 'Job not found' } }
+            executingAt, finishedAt, finalStatus, messages = self.jobs[jobid]
+            if finalStatus is None: return 500, { 'error' : { 'code' : 500, 'message' : 'Internal error' } }
+            if now < executingAt: return 200, { 'jobId' : jobid, 'jobStatus' : 'esriJobWaiting', 'messages' : [] }
+            if now < finishedAt: return 200, { 'jobId' : jobid, 'jobStatus' : 'esriJobExecuting', 'messages' : [] }
+            self.finishedSeen.setdefault(jobid, now)
+            return 200, { 'jobId' : jobid, 'jobStatus' : finalStatus, 'messages' : messages }
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+class FakeUploadsServer(object):
+    """The token and uploads endpoints of an ArcGIS Server admin API; failParts holds (itemID, partNumber) of the
+    parts to fail once, and partDelay(partNumber) is how long receiving a part takes."""
+    def __init__(self, partDelay=lambda partNumber: 0):
+        self.partDelay = partDelay
+        self.items = {} # itemID -> { partNumber : bytes }
+        self.committed = {} # itemID -> (part numbers in the order given to commit, the file they make up)
+        self.partsReceived = [] # (itemID, partNumber) in the order they arrived
+        self.failParts = set()
+        self.lock = threading.Lock()
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            wbufsize = -1
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.getheader('content-length') or 0))
+                form = _parseForm(self.headers.getheader('content-type'), body)
+                status, result = server.handle(self.path.split('?')[0].split('/')[3:], form)
+                data = json.dumps(result)
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args): pass
+
+        self.httpd = _ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.baseurl = 'http://127.0.0.1:{0}'.format(self.httpd.server_address[1])
+        thread = threading.Thread(target=self.httpd.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def handle(self, path, form):
+        # path is what follows /arcgis/admin/
+        if path == ['generateToken']: return 200, { 'token' : 'fake', 'expires' : (time.time() + 3600) * 1000 }
+        if path == ['uploads', 'register']:
+            with self.lock:
+                itemid = 'i{0}'.format(len(self.items) + 1)
+                self.items[itemid] = {}
+            return 200, { 'status' : 'success', 'item' : { 'itemID' : itemid, 'itemName' : form['itemName'] } }
+        itemid = path[1]
+        if itemid not in self.items: return 200, { 'error' : { 'code' : 404, 'message' : 'Item not found' } }
+        if len(path) == 2: return 200, { 'itemID' : itemid }
+        if path[2] == 'uploadPart':
+            partNumber = int(form['partNumber'])
+            time.sleep(self.partDelay(partNumber))
+            with self.lock:
+                self.partsReceived.append((itemid, partNumber))
+                if (itemid, partNumber) in self.failParts:
+                    self.failParts.discard((itemid, partNumber))
+                    return 500, { 'status' : 'error', 'messages' : ['Part could not be stored'] }
+                self.items[itemid][partNumber] = form['partFile']
+            return 200, { 'status' : 'success' }
+        if path[2] == 'commit':
+            partNumbers = [int(n) for n in form['parts'].split(',')]
+            with self.lock: self.committed[itemid] = (partNumbers, ''.join(self.items[itemid][n] for n in partNumbers))
+            return 200, { 'status' : 'success' }
+        return 404, { 'error' : { 'code' : 404, 'message' : 'Not found' } }
+
+    def close(self):
+        httpclient.closeAll()
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+def _parseForm(contentType, body):
+    # url-encoded or multipart/form-data fields, as sent by _post and _postmultipart
+    if not contentType.startswith('multipart/form-data'): return dict(urlparse.parse_qsl(body))
+    boundary = contentType.split('boundary=')[1]
+    form = {}
+    for part in body.split('--' + boundary)[1:-1]:
+        headers, value = part[2:].split('\r\n\r\n', 1)
+        form[headers.split('name="')[1].split('"')[0]] = value[:-2]
+    return form
+
+class PollerHarness(object):
+    """Fresh publishing state for PublishAllSDsinFolder, a fake GP server and poller threads polling it."""
+    def __init__(self, pollerCount=publisher.poll_thread_count):
+        self.folder = tempfile.mkdtemp()
+        publisher.timings_file = os.path.join(self.folder, 'timings.jsonl')
+        publisher.manifest_folder = os.path.join(self.folder, 'published')
+        publisher.pendingJobs.clear()
+        del publisher.pendingJobsSchedule[:]
+        publisher.runTimings.clear()
+        publisher.publishedManifest.clear()
+        publisher.plannedHashes.clear()
+        publisher.publishedQueue = Queue.Queue()
+        publisher.failedQueue = Queue.Queue()
+
+        self.server = FakeGPServer()
+        self.slots = threading.Semaphore(1000)
+        self.pollers = [threading.Thread(target=publisher.pollerThread, args=(self.server.baseurl, None, self.slots)) for i in range(pollerCount)]
+        for thread in self.pollers:
+            thread.daemon = True
+            thread.start()
+
+    def submit(self, jobid, waitSeconds, executeSeconds, finalStatus='esriJobSucceeded', messages=()):
+        # what the submitter thread does once submitJob returned jobid
+        sdpath = os.path.join(self.folder, jobid + '.sd')
+        with open(sdpath, 'wb') as f: f.write(b'sd')
+        publisher.plannedHashes[sdpath] = jobid
+        self.server.addJob(jobid, waitSeconds, executeSeconds, finalStatus, messages)
+        submitted = time.time()
+        publisher._recordTiming(sdpath, jobId=jobid, submitted=submitted, uploadStarted=submitted)
+        publisher._schedulePendingJob(jobid, sdpath, submitted)
+        return sdpath
+
+    def waitForAll(self, count, timeout):
+        deadline = time.time() + timeout
+        while publisher.publishedQueue.qsize() + publisher.failedQueue.qsize() < count:
+            if time.time() > deadline: raise AssertionError('Only {0} of {1} jobs finished'.format(
+                publisher.publishedQueue.qsize() + publisher.failedQueue.qsize(), count))
+            time.sleep(0.01)
+        return list(publisher.publishedQueue.queue), list(publisher.failedQueue.queue)
+
+    def close(self):
+        publisher.stopPollers(len(self.pollers))
+        for thread in self.pollers:
+            thread.join(10)
+            if thread.is_alive(): raise AssertionError('A poller did not stop')
+        httpclient.closeAll() # so the server's connection threads see the end of their keep-alive connections
+        self.server.close()
+        shutil.rmtree(self.folder)
+
+class PollDelayTest(unittest.TestCase):
+    def test_backoff(self):
+        self.assertEqual(publisher._pollDelay(0), publisher.poll_interval)
+        self.assertEqual(publisher._pollDelay(60), max(publisher.poll_interval, 60 * publisher.poll_backoff_factor))
+        self.assertEqual(publisher._pollDelay(24 * 3600), publisher.poll_max_interval)
+        delays = [publisher._pollDelay(seconds) for seconds in range(0, 600, 10)]
+        self.assertEqual(delays, sorted(delays))
+
+class PollerTest(unittest.TestCase):
+    def setUp(self):
+        self.tunables = (publisher.poll_interval, publisher.poll_max_interval, publisher.poll_max_failures)
+        publisher.poll_interval, publisher.poll_max_interval, publisher.poll_max_failures = 0.05, 0.4, 3
+        self.harness = PollerHarness()
+
+    def tearDown(self):
+        self.harness.close()
+        publisher.poll_interval, publisher.poll_max_interval, publisher.poll_max_failures = self.tunables
+
+    def test_jobs_finish(self):
+        sdpaths = dict((self.harness.submit('j{0}'.format(i), 0.1 * (i % 3), 0.1 + 0.05 * i), 'j{0}'.format(i)) for i in range(20))
+        published, failed = self.harness.waitForAll(20, 10)
+        self.assertEqual(failed, [])
+        self.assertEqual(sorted(published), sorted((jobid, sdpath) for sdpath, jobid in sdpaths.items()))
+
+        server = self.harness.server
+        for sdpath, jobid in sdpaths.items():
+            # noticed within the backoff delay (plus scheduling slack) of finishing
+            submitted = publisher.runTimings[sdpath]['submitted']
+            self.assertLess(server.finishedSeen[jobid] - server.finishedAt(jobid),
+                            publisher._pollDelay(server.finishedAt(jobid) - submitted) + 0.1)
+            self.assertEqual(publisher.runTimings[sdpath]['status'], 'esriJobSucceeded')
+            self.assertIn(sdpath, publisher.publishedManifest)
+        self.assertEqual(len(publisher.pendingJobs), 0)
+
+    def test_long_job_backs_off(self):
+        self.harness.submit('long', 0, 2.0)
+        self.harness.waitForAll(1, 10)
+        # checking every poll_interval would take 40 checks
+        self.assertLess(self.harness.server.checks['long'], 20)
+
+    def test_failed_job_keeps_messages(self):
+        messages = [{ 'type' : 'esriJobMessageTypeInformative', 'description' : 'Submitted.' },
+                    { 'type' : 'esriJobMessageTypeError', 'description' : 'ERROR 001487: Failed to update the published service.' }]
+        sdpath = self.harness.submit('bad', 0, 0.1, 'esriJobFailed', messages)
+        published, failed = self.harness.waitForAll(1, 10)
+        self.assertEqual(failed, [('bad', sdpath)])
+        self.assertEqual(publisher.runTimings[sdpath]['messages'], ['ERROR 001487: Failed to update the published service.'])
+        self.assertNotIn(sdpath, publisher.publishedManifest)
+
+    def test_status_failures(self):
+        brokenPath = self.harness.submit('broken', 0, 0, finalStatus=None)
+        okPath = self.harness.submit('ok', 0, 0.2)
+        published, failed = self.harness.waitForAll(2, 10)
+        self.assertEqual(published, [('ok', okPath)])
+        self.assertEqual(failed, [('broken', brokenPath)])
+        self.assertEqual(self.harness.server.checks['broken'], publisher.poll_max_failures)
+        self.assertEqual(publisher.runTimings[brokenPath]['status'], 'statusFailed')
+
+        # every line of the timings file is complete once the job is on a queue
+        with open(publisher.timings_file) as f: lines = [json.loads(line) for line in f]
+        self.assertEqual(sorted(line['status'] for line in lines), ['esriJobSucceeded', 'statusFailed'])
+
+    def test_bookkeeping_failures(self):
+        # the manifest and the timings can't be written (a file is in the way of their folder), as with a full disk
+        blocker = os.path.join(self.harness.folder, 'blocker')
+        with open(blocker, 'w') as f: f.write('')
+        publisher.manifest_folder = os.path.join(blocker, 'published')
+        publisher.timings_file = os.path.join(blocker, 'timings.jsonl')
+        okPath = self.harness.submit('ok', 0, 0.1)
+        badPath = self.harness.submit('bad', 0, 0.1, 'esriJobFailed')
+        published, failed = self.harness.waitForAll(2, 10)
+        self.assertEqual(published, [])
+        self.assertEqual(sorted(failed), [('bad', badPath), ('ok', okPath)])
+        self.assertEqual(publisher.runTimings[okPath]['status'], 'recordFailed')
+
+class UploadInPartsTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.tunables = (publisher.upload_journal_folder, publisher.upload_part_size, publisher.upload_part_thread_count)
+        publisher.upload_journal_folder = os.path.join(self.folder, 'uploads')
+        publisher.upload_part_size = 1000
+        self.server = FakeUploadsServer()
+        self.tokens = tokencache.TokenManager(self.server.baseurl + '/arcgis/admin/generateToken', 'admin', 'secret')
+        self.sdpath = os.path.join(self.folder, 'big.sd')
+        self.content = ''.join(chr(i % 251) for i in range(4500)) # 5 parts, the last one short
+        with open(self.sdpath, 'wb') as f: f.write(self.content)
+
+    def tearDown(self):
+        self.server.close()
+        publisher.upload_journal_folder, publisher.upload_part_size, publisher.upload_part_thread_count = self.tunables
+        shutil.rmtree(self.folder)
+
+    def upload(self):
+        return publisher.uploadFileInParts(self.server.baseurl, self.tokens, self.sdpath)
+
+    def test_resume_sends_missing_parts(self):
+        self.server.failParts.add(('i1', 3))
+        self.assertRaises(Exception, self.upload)
+        self.assertEqual(sorted(publisher._loadUploadJournal(self.server.baseurl, self.sdpath)['parts']), [1, 2, 4, 5])
+
+        del self.server.partsReceived[:]
+        self.assertEqual(self.upload(), 'i1')
+        self.assertEqual(self.server.partsReceived, [('i1', 3)])
+        self.assertEqual(self.server.committed['i1'], ([1, 2, 3, 4, 5], self.content))
+        self.assertIsNone(publisher._loadUploadJournal(self.server.baseurl, self.sdpath))
+
+    def test_journal_dropped_when_file_changes(self):
+        self.server.failParts.add(('i1', 2))
+        self.assertRaises(Exception, self.upload)
+        stat = os.stat(self.sdpath)
+        os.utime(self.sdpath, (stat.st_atime, stat.st_mtime - 60)) # same size, different modification time
+        self.assertIsNone(publisher._loadUploadJournal(self.server.baseurl, self.sdpath))
+
+        del self.server.partsReceived[:]
+        self.assertEqual(self.upload(), 'i2')
+        self.assertEqual(sorted(self.server.partsReceived), [('i2', n) for n in range(1, 6)])
+
+        self.server.failParts.add(('i3', 2))
+        self.assertRaises(Exception, self.upload)
+        self.content += 'more'
+        with open(self.sdpath, 'ab') as f: f.write('more')
+        os.utime(self.sdpath, (stat.st_atime, stat.st_mtime - 60)) # a different size is enough
+        self.assertEqual(self.upload(), 'i4')
+        self.assertEqual(self.server.committed['i4'], ([1, 2, 3, 4, 5], self.content))
+
+    def test_commit_in_order(self):
+        # the first parts take longest, so the parts finish in reverse order
+        publisher.upload_part_thread_count = 5
+        self.server.partDelay = lambda partNumber: (6 - partNumber) * 0.05
+        self.assertEqual(self.upload(), 'i1')
+        self.assertEqual([n for itemid, n in self.server.partsReceived], [5, 4, 3, 2, 1])
+        self.assertEqual(self.server.committed['i1'], ([1, 2, 3, 4, 5], self.content))
+
+def _benchmark(jobCount):
+    # jobs with a mix of short and long run times, all submitted at once, as after a burst of uploads
+    harness = PollerHarness()
+    try:
+        sdpaths = {}
+        for i in range(jobCount): sdpaths[harness.submit('j{0}'.format(i), (i % 5) * 0.5, 1 + (i % 13) * 1.5)] = 'j{0}'.format(i)
+        started = time.time()
+        harness.waitForAll(jobCount, 600)
+        server = harness.server
+        delays = sorted(server.finishedSeen[jobid] - server.finishedAt(jobid) for jobid in sdpaths.values())
+        checks = sum(server.checks.values())
+        print('{0} jobs finished in {1:.1f}s with {2} status checks ({3:.1f} per job)'.format(jobCount, time.time() - started, checks, checks / float(jobCount)))
+        print('time to notice a finished job: mean {0:.2f}s, median {1:.2f}s, max {2:.2f}s'.format(
+            sum(delays) / len(delays), delays[len(delays) // 2], delays[-1]))
+    finally: harness.close()
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['benchmark']:
+        _benchmark(int(sys.argv[2]) if len(sys.argv) > 2 else 200)
+    else: unittest.main()
@@ -0,0 +1,163 @@
+"""Harness for the provider migration of sharedinstances.py.
+
+Runs --update and --rollback against a local fake ArcGIS Server admin API
+that lists the services and changes their provider, and is overloaded for a
+while when asked to, and checks that every Pro-based service is moved to the
+shared instance pool and back, that the journal records exactly the changes
+made and that --rollback skips the services that changed again since.
+sharedinstances.py is a Python 3 script, so these tests run with Python 3:
+    python -m unittest test_sharedinstances"""
+
+import os
+import sys
+import json
+import shutil
+import tempfile
+import threading
+import unittest
+
+if sys.version_info[0] < 3: raise unittest.SkipTest('sharedinstances.py runs on Python 3 only')
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import parse_qs, urlparse
+
+import httpclient
+import servicecatalog
+import sharedinstances
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+class FakeAdminServer(object):
+    """The services directory and changeProvider operation of an ArcGIS Server admin API. services maps
+    (folder, serviceName) to the provider of a map service; busy maps a resource to how many changeProvider
+    calls on it fail with HTTP 503 before one succeeds."""
+    def __init__(self, services):
+        self.services = dict(services)
+        self.busy = {}
+        self.changes = [] # (resource, provider) in the order they were made
+        self.lock = threading.Lock()
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            wbufsize = -1
+
+            def respond(self, status, body):
+                data = json.dumps(body).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_GET(self):
+                self.respond(*server.listing(urlparse(self.path).path.split('/')[4:]))
+
+            def do_POST(self):
+                form = dict((key, values[0]) for key, values in parse_qs(self.rfile.read(int(self.headers.get('content-length') or 0)).decode('utf-8')).items())
+                self.respond(*server.post(urlparse(self.path).path.split('/')[3:], form))
+
+            def log_message(self, format, *args): pass
+
+        self.httpd = _ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.adminUrl = 'http://127.0.0.1:{0}/arcgis/admin'.format(self.httpd.server_address[1])
+        thread = threading.Thread(target=self.httpd.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def listing(self, path):
+        # path is what follows /arcgis/admin/services/: nothing for the root folder, or a folder name
+        folder = path[0] if path else ''
+        with self.lock:
+            entries = [{ 'serviceName' : name, 'type' : 'MapServer', 'provider' : provider }
+                       for (serviceFolder, name), provider in sorted(self.services.items()) if serviceFolder == folder]
+            folders = sorted(set(serviceFolder for serviceFolder, name in self.services if serviceFolder))
+        body = { 'folderName' : folder or '/', 'services' : entries }
+        if not folder: body['folders'] = folders
+        return 200, body
+
+    def post(self, path, form):
+        # path is what follows /arcgis/admin/
+        if path == ['generateToken']: return 200, { 'token' : 'fake', 'expires' : 4102444800000 }
+        if path[0] != 'services' or path[-1] != 'changeProvider': return 404, { 'status' : 'error', 'messages' : ['Not found'] }
+        folder, name = (path[1], path[2]) if len(path) == 4 else ('', path[1])
+        key = (folder, name[:-len('.MapServer')])
+        resource = '/'.join(['services'] + path[1:-1])
+        with self.lock:
+            if key not in self.services: return 200, { 'status' : 'error', 'messages' : ['Service not found'] }
+            if self.busy.get(resource):
+                self.busy[resource] -= 1
+                return 503, { 'status' : 'error', 'messages' : ['Server busy'] }
+            self.services[key] = form['provider']
+            self.changes.append((resource, form['provider']))
+        return 200, { 'status' : 'success' }
+
+    def close(self):
+        httpclient.closeAll()
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+class MigrationTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.journalPath = os.path.join(self.folder, 'journal.json')
+        self.tunables = (sharedinstances.migrate_backoff, servicecatalog.cache_file)
+        sharedinstances.migrate_backoff, servicecatalog.cache_file = 0.01, None
+        self.server = FakeAdminServer({ ('', 'Basemap') : 'ArcObjects11', ('Maps', 'Parcels') : 'ArcObjects11',
+                                        ('Maps', 'Roads') : 'ArcObjects11', ('Maps', 'Zoning') : 'ArcObjects11',
+                                        ('Maps', 'Legacy') : 'ArcObjects', ('Maps', 'Pooled') : 'DMaps',
+                                        ('System', 'Internal') : 'ArcObjects11' })
+
+    def tearDown(self):
+        self.server.close()
+        sharedinstances.migrate_backoff, servicecatalog.cache_file = self.tunables
+        shutil.rmtree(self.folder)
+
+    def run_script(self, *args):
+        argv = sys.argv
+        sys.argv = ['sharedinstances.py', '--server', self.server.adminUrl[:-len('/admin')], '--user', 'admin', '--password', 'secret',
+                    '--journal', self.journalPath, '--threads', '3'] + list(args)
+        try: return sharedinstances.main()
+        finally: sys.argv = argv
+
+    def journal(self):
+        with open(self.journalPath) as f: return json.load(f)
+
+    def test_update_and_rollback(self):
+        proServices = ['services/Basemap.MapServer', 'services/Maps/Parcels.MapServer', 'services/Maps/Roads.MapServer', 'services/Maps/Zoning.MapServer']
+        self.server.busy['services/Maps/Roads.MapServer'] = 2 # retried after backing off
+        self.assertEqual(self.run_script('--update'), 0)
+        self.assertEqual(sorted(resource for resource, provider in self.server.changes), proServices)
+        self.assertEqual(self.server.services[('Maps', 'Legacy')], 'ArcObjects')
+        self.assertEqual(self.server.services[('System', 'Internal')], 'ArcObjects11')
+        changes = self.journal()['changes']
+        self.assertEqual(sorted(changes), proServices)
+        self.assertTrue(all(change['from'] == 'ArcObjects11' and change['to'] == 'DMaps' for change in changes.values()))
+        self.assertEqual(os.listdir(self.folder), ['journal.json'])
+
+        # since the update, one service was moved back by hand and another one deleted
+        self.server.services[('Maps', 'Roads')] = 'ArcObjects11'
+        del self.server.services[('Maps', 'Zoning')]
+        del self.server.changes[:]
+        self.assertEqual(self.run_script('--rollback'), 0)
+        self.assertEqual(sorted(self.server.changes), [('services/Basemap.MapServer', 'ArcObjects11'), ('services/Maps/Parcels.MapServer', 'ArcObjects11')])
+        self.assertEqual(self.server.services[('Maps', 'Pooled')], 'DMaps')
+        # the skipped services stay in the journal
+        self.assertEqual(sorted(self.journal()['changes']), ['services/Maps/Roads.MapServer', 'services/Maps/Zoning.MapServer'])
+
+    def test_failed_changes_not_journaled(self):
+        self.server.busy['services/Maps/Parcels.MapServer'] = sharedinstances.migrate_retry_count + 1 # busy on every attempt
+        self.assertEqual(self.run_script('--update'), 1)
+        self.assertEqual(sorted(self.journal()['changes']), ['services/Basemap.MapServer', 'services/Maps/Roads.MapServer', 'services/Maps/Zoning.MapServer'])
+        self.assertEqual(self.server.services[('Maps', 'Parcels')], 'ArcObjects11')
+
+    def test_journal_of_another_server(self):
+        with open(self.journalPath, 'w') as f: json.dump({ 'server' : 'https://elsewhere/arcgis/admin', 'changes' : {} }, f)
+        self.assertRaises(Exception, self.run_script, '--rollback')
+        self.assertEqual(self.server.changes, [])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,189 @@
+"""Harness for the windowed usage report fetch of ExportServiceStats.py.
+
+Runs fetchUsageReport against a local fake admin API whose temporary usage
+reports take a while to build, finish in whatever order the test asks for
+and can fail, and checks that the windows are stitched back together in time
+order, that no time slice is dropped or duplicated at a window or batch
+boundary and that every temporary report is deleted, also when one fails.
+Works with both Python 2.7 and Python 3:
+    python -m unittest test_usagereports
+
+Run it directly to compare fetching a long range as one report with fetching
+it in windows:
+    test_usagereports.py benchmark [days]"""
+
+import sys
+import json
+import time
+import zlib
+import threading
+import unittest
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import parse_qs
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import parse_qs
+
+import ExportServiceStats
+import httpclient
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+def fakeValue(resource, metric, t):
+    # the same value for a service, metric and time slice in every report that covers it
+    return zlib.crc32('{0}|{1}|{2}'.format(resource, metric, t).encode('utf-8')) % 1000
+
+class FakeUsageReportServer(object):
+    """The usagereports endpoints of an ArcGIS Server admin API; a report's data covers every interval from its
+    from time up to and including its to time. buildSeconds(definition) is how long the data of a report takes,
+    and failing(definition) makes its data request fail."""
+    def __init__(self, buildSeconds=lambda definition: 0, failing=lambda definition: False):
+        self.buildSeconds = buildSeconds
+        self.failing = failing
+        self.reports = {} # report name -> definition
+        self.created = []
+        self.deleted = []
+        self.finishedFrom = [] # from times of the reports in the order their data was returned
+        self.lock = threading.Lock()
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            wbufsize = -1
+
+            def do_POST(self):
+                length = int(self.headers.get('content-length') or 0)
+                form = dict((key, values[0]) for key, values in parse_qs(self.rfile.read(length).decode('utf-8')).items())
+                status, body = server.handle(self.path.split('?')[0], form)
+                data = json.dumps(body).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args): pass
+
+        self.httpd = _ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.siteURL = 'http://127.0.0.1:{0}/arcgis'.format(self.httpd.server_address[1])
+        thread = threading.Thread(target=self.httpd.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def handle(self, path, form):
+        parts = path.split('/')[4:] # /arcgis/admin/usagereports/...
+        if parts == ['add']:
+            definition = json.loads(form['usagereport'])
+            with self.lock:
+                self.reports[definition['reportname']] = definition
+                self.created.append(definition['reportname'])
+            return 200, { 'status' : 'success' }
+        name, operation = parts
+        with self.lock: definition = self.reports.get(name)
+        if definition is None: return 200, { 'status' : 'error', 'messages' : ['Report {0} not found'.format(name)] }
+        if operation == 'delete':
+            with self.lock:
+                del self.reports[name]
+                self.deleted.append(name)
+            return 200, { 'status' : 'success' }
+        time.sleep(self.buildSeconds(definition))
+        if self.failing(definition): return 500, { 'status' : 'error', 'messages' : ['Report could not be built'] }
+        with self.lock: self.finishedFrom.append(definition['from'])
+        return 200, self.data(definition)
+
+    def data(self, definition):
+        step = definition['aggregationInterval'] * 60 * 1000
+        timeslices = list(range(definition['from'], definition['to'] + 1, step))
+        reportData = [{ 'resourceURI' : resource, 'metric-type' : metric, 'data' : [fakeValue(resource, metric, t) for t in timeslices] }
+                      for query in definition['queries'] for resource in query['resourceURIs'] for metric in query['metrics']]
+        return { 'report' : { 'reportname' : definition['reportname'], 'time-slices' : timeslices, 'report-data' : [reportData] } }
+
+    def close(self):
+        httpclient.closeAll()
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+class FetchUsageReportTest(unittest.TestCase):
+    def setUp(self):
+        self.tunables = (ExportServiceStats.window_minutes, ExportServiceStats.fetch_thread_count, ExportServiceStats.report_batch_size)
+        self.server = None
+
+    def tearDown(self):
+        if self.server: self.server.close()
+        ExportServiceStats.window_minutes, ExportServiceStats.fetch_thread_count, ExportServiceStats.report_batch_size = self.tunables
+
+    def fetch(self, resources, metrics, fromTime, toTime, interval):
+        return ExportServiceStats.fetchUsageReport(self.server.siteURL, None, resources, metrics, fromTime, toTime, interval)
+
+    def assertComplete(self, report, resources, metrics, fromTime, toTime, interval):
+        step = interval * 60 * 1000
+        expectedSlices = list(range(fromTime, toTime + 1, step))
+        self.assertEqual(report['time-slices'], expectedSlices)
+        entries = report['report-data'][0]
+        self.assertEqual([(entry['resourceURI'], entry['metric-type']) for entry in entries],
+                         [(resource, metric) for resource in resources for metric in metrics])
+        for entry in entries:
+            self.assertEqual(entry['data'], [fakeValue(entry['resourceURI'], entry['metric-type'], t) for t in expectedSlices])
+
+    def test_windows_stitched_in_time_order(self):
+        ExportServiceStats.window_minutes, ExportServiceStats.fetch_thread_count = 60, 8
+        fromTime = 1704067200000
+        toTime = fromTime + 6 * 3600 * 1000
+        # later windows are built faster, so they finish first
+        self.server = FakeUsageReportServer(buildSeconds=lambda definition: (toTime - definition['from']) / 3600000.0 * 0.05)
+        resources = ['services/A.MapServer', 'services/B.MapServer']
+        report = self.fetch(resources, ['RequestCount'], fromTime, toTime, 15)
+
+        self.assertEqual(len(self.server.created), 6)
+        self.assertNotEqual(self.server.finishedFrom, sorted(self.server.finishedFrom))
+        self.assertComplete(report, resources, ['RequestCount'], fromTime, toTime, 15)
+
+    def test_batch_and_window_boundaries(self):
+        ExportServiceStats.window_minutes, ExportServiceStats.fetch_thread_count, ExportServiceStats.report_batch_size = 45, 4, 3
+        self.server = FakeUsageReportServer()
+        resources = ['services/S{0}.MapServer'.format(i) for i in range(8)]
+        metrics = ['RequestCount', 'RequestAvgResponseTime']
+        fromTime = 1704067200000
+        toTime = fromTime + 5 * 3600 * 1000 + 30 * 60 * 1000 # the last window is a short one
+        report = self.fetch(resources, metrics, fromTime, toTime, 15)
+        # 3 batches of services in 8 windows of 45 minutes (the last one 15), each a report of its own
+        self.assertEqual(len(self.server.created), 3 * 8)
+        self.assertComplete(report, resources, metrics, fromTime, toTime, 15)
+
+    def test_reports_deleted_when_a_window_fails(self):
+        ExportServiceStats.window_minutes, ExportServiceStats.fetch_thread_count = 60, 3
+        fromTime = 1704067200000
+        toTime = fromTime + 6 * 3600 * 1000
+        self.server = FakeUsageReportServer(failing=lambda definition: definition['from'] == fromTime + 2 * 3600 * 1000)
+        self.assertRaises(Exception, self.fetch, ['services/A.MapServer'], ['RequestCount'], fromTime, toTime, 15)
+        self.assertEqual(len(self.server.created), 6)
+        self.assertEqual(sorted(self.server.deleted), sorted(self.server.created))
+        self.assertEqual(self.server.reports, {})
+
+def _benchmark(days):
+    # the server takes time in proportion to the number of values it aggregates, as a real one roughly does
+    resources = ['services/S{0}.MapServer'.format(i) for i in range(20)]
+    toTime = 1704067200000
+    fromTime = toTime - days * 24 * 3600 * 1000
+    server = FakeUsageReportServer(buildSeconds=lambda definition: (definition['to'] - definition['from']) / 60000.0 * len(definition['queries'][0]['resourceURIs']) * 2e-6)
+    tunables = ExportServiceStats.window_minutes, ExportServiceStats.fetch_thread_count
+    try:
+        for name, windowMinutes in (('one report', days * 24 * 60), ('7-day windows', 7 * 24 * 60), ('1-day windows', 24 * 60)):
+            ExportServiceStats.window_minutes = windowMinutes
+            started = time.time()
+            report = ExportServiceStats.fetchUsageReport(server.siteURL, None, resources, ['RequestCount'], fromTime, toTime, 1)
+            print('{0}: {1:.2f}s for {2} time slices'.format(name, time.time() - started, len(report['time-slices'])))
+    finally:
+        ExportServiceStats.window_minutes, ExportServiceStats.fetch_thread_count = tunables
+        server.close()
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['benchmark']:
+        _benchmark(int(sys.argv[2]) if len(sys.argv) > 2 else 90)
+    else: unittest.main()
@@ -0,0 +1,180 @@
+"""Token cache shared by the scripts in this repository.
+
+Tokens are cached per token endpoint (ArcGIS Server or Portal) and user, so
+every thread in a script shares one token. A token is refreshed in the
+background once it gets close to expiring; worker threads keep using the
+current (still valid) token in the meantime and only wait if it actually
+expired. Requests made through TokenManager.call are retried exactly once
+with a fresh token when the server reports an expired or invalid token.
+
+Tokens can optionally be persisted between runs in an encrypted file, which
+saves the generateToken round trip for scheduled scripts. Set the
+ARCGIS_TOKEN_CACHE environment variable to the file to use and
+ARCGIS_TOKEN_CACHE_KEY to the passphrase protecting it; this requires the
+cryptography package. Works with both Python 2.7 and Python 3."""
+
+import os
+import json
+import time
+import base64
+import hashlib
+import threading
+
+import atomicfile
+import httpclient
+
+try: from cryptography.fernet import Fernet, InvalidToken
+except ImportError: Fernet = None
+
+cache_file = os.environ.get('ARCGIS_TOKEN_CACHE') # encrypted on-disk cache, disabled when not set
+cache_passphrase = os.environ.get('ARCGIS_TOKEN_CACHE_KEY')
+refresh_margin = 0.2 # refresh in the background once less than this fraction of a token's lifetime is left
+invalid_token_codes = (498, 499) # error codes for expired/invalid and missing tokens
+
+_managers = {}
+_managersLock = threading.Lock()
+_cacheFileLock = threading.Lock()
+_warnedNoCryptography = False
+
+class TokenError(Exception):
+    pass
+
+class TokenExpiredError(TokenError):
+    pass
+
+def isTokenError(resp_json):
+    """Checks whether a JSON response reports an expired, invalid or missing token."""
+    if not isinstance(resp_json, dict): return False
+    error = resp_json.get('error') if isinstance(resp_json.get('error'), dict) else resp_json
+    try: return int(error.get('code')) in invalid_token_codes
+    except (TypeError, ValueError): return False
+
+def checkToken(resp_json):
+    """Raises TokenExpiredError if the response reports a token problem, otherwise returns it as-is."""
+    if isTokenError(resp_json): raise TokenExpiredError('Token expired or invalid')
+    return resp_json
+
+def _fernet():
+    if not cache_file or not cache_passphrase: return None
+    if Fernet is None:
+        global _warnedNoCryptography
+        if not _warnedNoCryptography:
+            print('WARNING: the cryptography package is required to persist tokens; caching them in memory only')
+            _warnedNoCryptography = True
+        return None
+    key = hashlib.pbkdf2_hmac('sha256', cache_passphrase.encode('utf-8'), b'arcgis-token-cache', 100000)
+    return Fernet(base64.urlsafe_b64encode(key))
+
+def _readCacheFile(fernet):
+    if not os.path.exists(cache_file): return {}
+    try:
+        with open(cache_file, 'rb') as f: return json.loads(fernet.decrypt(f.read()).decode('utf-8'))
+    except (InvalidToken, ValueError, IOError, OSError): return {} # wrong passphrase or corrupt file, start afresh
+
+def _loadPersisted(key):
+    fernet = _fernet()
+    if fernet is None: return None
+    with _cacheFileLock: return _readCacheFile(fernet).get(key)
+
+def _persist(key, entry):
+    fernet = _fernet()
+    if fernet is None: return
+    with _cacheFileLock:
+        entries = _readCacheFile(fernet)
+        now = time.time()
+        entries = dict((k, v) for k, v in entries.items() if v['expires'] > now) # drop expired tokens
+        entries[key] = entry
+        data = fernet.encrypt(json.dumps(entries).encode('utf-8'))
+        atomicfile.writeAtomically(cache_file, lambda f: f.write(data), 'wb')
+
+class TokenManager(object):
+    """Hands out a valid token for one token endpoint and user, refreshing it as needed."""
+    def __init__(self, tokenUrl, username, password, expiration=60, client='requestip', referer=None):
+        self.tokenUrl = tokenUrl
+        self.username = username
+        self.password = password
+        self.expiration = expiration
+        self.client = client
+        self.referer = referer
+        self.key = hashlib.sha256('{0}|{1}'.format(tokenUrl, username).encode('utf-8')).hexdigest()
+        self._token = None
+        self._issued = 0
+        self._expires = 0
+        self._lock = threading.Lock()
+        self._generateLock = threading.Lock() # only one thread generates a missing token, the others wait for it
+        self._refreshing = False
+
+        persisted = _loadPersisted(self.key)
+        if persisted and persisted['expires'] > time.time():
+            self._token, self._issued, self._expires = persisted['token'], persisted['issued'], persisted['expires']
+
+    def _generate(self):
+        postdata = { 'username' : self.username, 'password' : self.password, 'client' : self.client,
+                     'expiration' : self.expiration, 'f' : 'json' }
+        if self.referer:
+            postdata['client'] = 'referer'
+            postdata['referer'] = self.referer
+
+        resp_json = httpclient.postJSON(self.tokenUrl, postdata)
+        if 'token' not in resp_json: raise TokenError('Unable to generate a token at {0}'.format(self.tokenUrl))
+
+        issued = time.time()
+        # expires is in epoch milliseconds; fall back to the requested expiration if it is missing
+        expires = float(resp_json['expires']) / 1000.0 if 'expires' in resp_json else issued + self.expiration * 60
+        with self._lock:
+            self._token, self._issued, self._expires = resp_json['token'], issued, expires
+        _persist(self.key, { 'token' : resp_json['token'], 'issued' : issued, 'expires' : expires })
+
+    def _backgroundRefresh(self):
+        try: self._generate()
+        except Exception: pass # the current token is still valid; the next call will try again
+        finally:
+            with self._lock: self._refreshing = False
+
+    def getToken(self):
+        """Returns a valid token, generating one if needed."""
+        with self._lock:
+            now = time.time()
+            if self._token and now < self._expires:
+                if now > self._expires - (self._expires - self._issued) * refresh_margin and not self._refreshing:
+                    # close to expiring: refresh on a separate thread and keep using the current token meanwhile
+                    self._refreshing = True
+                    t = threading.Thread(target=self._backgroundRefresh)
+                    t.daemon = True
+                    t.start()
+                return self._token
+
+        # no usable token at all, every caller has to wait for a new one
+        with self._generateLock:
+            with self._lock:
+                if self._token and time.time() < self._expires: return self._token # another thread beat us to it
+            self._generate()
+            return self._token
+
+    def invalidate(self, token):
+        """Forgets token if it is still the current one, so the next getToken generates a new one."""
+        with self._lock:
+            if self._token == token: self._token = None
+
+    def call(self, fn):
+        """Calls fn(token), retrying exactly once with a new token if it raises TokenExpiredError."""
+        token = self.getToken()
+        try: return fn(token)
+        except TokenExpiredError:
+            self.invalidate(token)
+            return fn(self.getToken())
+
+    def postJSON(self, url, postdata=None, requestTimeout=None):
+        """POSTs form data with a token added and returns the parsed JSON response."""
+        def post(token):
+            data = dict(postdata or {})
+            data['token'] = token
+            return checkToken(httpclient.postJSON(url, data, requestTimeout))
+        return self.call(post)
+
+def getTokenManager(tokenUrl, username, password, **kwargs):
+    """Returns the TokenManager shared by all callers for tokenUrl and username."""
+    key = (tokenUrl, username)
+    with _managersLock:
+        if key not in _managers: _managers[key] = TokenManager(tokenUrl, username, password, **kwargs)
+        return _managers[key]
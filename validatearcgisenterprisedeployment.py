@@ -10,27 +10,275 @@ Designed for ArcGIS Enterprise 10.5 and higher."""
 import os
 import sys
 import ssl
+import time
 import socket
-import urllib.request
+import threading
+import json
 import getopt
 import getpass
-import json
 import traceback
+import concurrent.futures
+import urllib.parse
+import xml.etree.ElementTree
+import atomicfile
+import httpclient
+
+check_timeout = 30 # default seconds a check (and each of its requests) may take before the check fails
+check_thread_count = 8 # maximum number of checks running at the same time
+fleet_worker_count = 8 # default number of deployments validated at the same time in fleet mode
+probe_count = 0 # default number of timed calls per performance probe; the probes are off unless --probes asks for them
+probe_timeout = 300 # default seconds all performance probes of a deployment may take, separate from check_timeout
+probe_thresholds = {'portalSelf':500, 'hostingServerRest':500, 'featureQuery':1000, 'generateToken':1000, 'tlsHandshake':200} # p95 ms
+regression_tolerance = 0.5 # a probe whose median is this fraction slower than the baseline's is flagged
+baseline_file = os.path.join(os.path.expanduser('~'), '.validatedeployment', 'baseline.json') # probe results of earlier runs
+_baselineLock = threading.Lock()
+
+class Check(object):
+    """A validation step; fn(dependencies, timeout) is called with the values of the checks named in dependsOn
+    once all of them have succeeded. timeout overrides the time the whole check may take (not its requests), and
+    an optional check that fails or times out only warns."""
+    def __init__(self, name, fn, dependsOn=(), timeout=None, optional=False):
+        self.name = name
+        self.fn = fn
+        self.dependsOn = tuple(dependsOn)
+        self.timeout = timeout
+        self.optional = optional
+
+class CheckResult(object):
+    """The value returned by a check, or the exception it raised (as warning instead for optional checks); skipped
+    if one of its dependencies failed."""
+    def __init__(self, value=None, error=None, elapsed=0.0, skipped=False, warning=None):
+        self.value = value
+        self.error = error
+        self.elapsed = elapsed
+        self.skipped = skipped
+        self.warning = warning
+
+    def failed(self): return self.error is not None or self.skipped
+
+class InvalidLoginError(Exception):
+    """The portal didn't hand out a token for the username and password."""
+
+def _runCheck(check, dependencies, timeout, startedAt):
+    started = startedAt[check.name] = time.time()
+    try: return CheckResult(check.fn(dependencies, timeout), elapsed=time.time() - started)
+    except Exception as e: return _failedResult(check, e, time.time() - started)
+
+def _failedResult(check, error, elapsed):
+    if check.optional: return CheckResult(warning=error, elapsed=elapsed)
+    return CheckResult(error=error, elapsed=elapsed)
+
+def runChecks(checks, timeout=None):
+    """Runs the checks concurrently, each as soon as its dependencies have succeeded, and returns a CheckResult
+    per check name; a check that hasn't finished timeout seconds (or its own timeout) after it started fails,
+    and timeout also applies to every request it makes."""
+    if timeout is None: timeout = check_timeout
+    pending = dict((check.name, check) for check in checks)
+    results = {}
+    running = {}
+    startedAt = {} # check name -> when it started running, set by the worker thread
+    checksByName = dict((check.name, check) for check in checks)
+    deadline = lambda name: startedAt[name] + (checksByName[name].timeout or timeout)
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=check_thread_count)
+    try:
+        while pending or running:
+            scheduled = True
+            while scheduled: # skipping a check may resolve the dependencies of others
+                scheduled = False
+                for name, check in list(pending.items()):
+                    dependencies = [results.get(dependency) for dependency in check.dependsOn]
+                    if None in dependencies: continue # still waiting for a dependency
+                    del pending[name]
+                    scheduled = True
+                    if any(dependency.failed() for dependency in dependencies): results[name] = CheckResult(skipped=True)
+                    else: running[executor.submit(_runCheck, check, dict((d, results[d].value) for d in check.dependsOn), timeout, startedAt)] = name
+
+            if not running:
+                # every remaining check waits for one that will never run (unknown name or a cycle)
+                for name in pending: results[name] = CheckResult(error=Exception('Unresolvable dependencies'), skipped=True)
+                break
+            # wake up at the first deadline, or soon if a check is still queued for a worker and has none yet
+            now = time.time()
+            deadlines = [deadline(name) for name in running.values() if name in startedAt]
+            wait = min(deadlines) - now if len(deadlines) == len(running) else min(deadlines + [now + 0.1]) - now
+            done, notDone = concurrent.futures.wait(running, max(wait, 0), return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done: results[running.pop(future)] = future.result()
+            now = time.time()
+            for future, name in list(running.items()):
+                if name in startedAt and now >= deadline(name):
+                    # its thread is left to end on its own; the request timeout bounds how long that takes
+                    del running[future]
+                    error = Exception('Timed out after {0} seconds'.format(checksByName[name].timeout or timeout))
+                    results[name] = _failedResult(checksByName[name], error, now - startedAt[name])
+    finally:
+        executor.shutdown(wait=False) # don't wait for checks that timed out
+    return results
+
+def printCheckTimings(checks, results):
+    print()
+    print('Check timings')
+    for check in checks:
+        result = results[check.name]
+        if result.skipped: status = 'skipped'
+        elif result.error is not None: status = 'FAILED: %s' % result.error
+        elif result.warning is not None: status = 'WARNING: %s' % result.warning
+        else: status = 'ok'
+        print('- %-28s %7.0f ms  %s' % (check.name, result.elapsed * 1000, status))
+
+def latencyStats(samples):
+    """Returns the median and 95th percentile of samples (in ms) and their count."""
+    ordered = sorted(samples)
+    def percentile(q):
+        # linear interpolation between the closest ranks
+        position = (len(ordered) - 1) * q / 100.0
+        lower = int(position)
+        upper = min(lower + 1, len(ordered) - 1)
+        return ordered[lower] + (ordered[upper] - ordered[lower]) * (position - lower)
+    return {'median':percentile(50), 'p95':percentile(95), 'count':len(ordered)}
+
+def timeCalls(fn, count):
+    # the first call is not timed, so the samples are requests over an open (keep-alive) connection
+    fn()
+    samples = []
+    for i in range(count):
+        started = time.time()
+        fn()
+        samples.append((time.time() - started) * 1000)
+    return latencyStats(samples)
+
+def timeTLSHandshakes(url, count, timeout):
+    # new connections every time, timing only the TLS handshake; None for plain HTTP
+    parsed = urllib.parse.urlparse(url)
+    if parsed.scheme != 'https': return None
+    context = ssl._create_default_https_context()
+    samples = []
+    for i in range(count):
+        sock = socket.create_connection((parsed.hostname, parsed.port or 443), timeout)
+        try:
+            started = time.time()
+            context.wrap_socket(sock, server_hostname=parsed.hostname).close()
+            samples.append((time.time() - started) * 1000)
+        finally: sock.close()
+    return latencyStats(samples)
 
-def main(argv):
-    parameters = parseInputParameters(argv)
-    portalUrl = parameters['portalUrl']
-    token = parameters['token']
-
-    if token == '':
-        adminUsername = parameters['adminUsername']
-        adminPassword = parameters['adminPassword']
-        token = generateToken(adminUsername, adminPassword, portalUrl)
-        if token == 'Failed':
-            print('Invalid administrator username or password.')
-            sys.exit(1)
-
-    portalSelf = getPortalSelf(portalUrl, token)
+def findHostedFeatureService(serverUrl, token, timeout):
+    params = {'token':token, 'f':'json'}
+    folder = httpclient.get(serverUrl + '/rest/services/Hosted', params, timeout).json()
+    for service in folder.get('services', []):
+        if service['type'] == 'FeatureServer': return serverUrl + '/rest/services/' + service['name'] + '/FeatureServer'
+    return None
+
+def runProbes(portalUrl, hostingServer, token, username, password, count, timeout):
+    """Times count calls of each probe and returns their latencyStats by name; probes that don't apply to the
+    deployment (no hosting server, no hosted feature service, no credentials, plain HTTP) are left out."""
+    params = {'token':token, 'f':'json'}
+    probes = {'portalSelf':timeCalls(lambda: httpclient.post(portalUrl + '/sharing/portals/self', params, timeout), count)}
+    if hostingServer is not None:
+        probes['hostingServerRest'] = timeCalls(lambda: httpclient.get(hostingServer['url'] + '/rest/services', params, timeout), count)
+        featureService = findHostedFeatureService(hostingServer['url'], token, timeout)
+        if featureService is not None:
+            query = {'token':token, 'f':'json', 'where':'1=1', 'returnCountOnly':'true'}
+            probes['featureQuery'] = timeCalls(lambda: httpclient.get(featureService + '/0/query', query, timeout), count)
+    if username and password:
+        probes['generateToken'] = timeCalls(lambda: requestToken(username, password, portalUrl, timeout), count)
+    tlsHandshake = timeTLSHandshakes(portalUrl, count, timeout)
+    if tlsHandshake is not None: probes['tlsHandshake'] = tlsHandshake
+    return probes
+
+def describeProbes(probes, baseline):
+    """Returns the report lines of the performance probes, with warnings for probes above their threshold or
+    slower than in the baseline."""
+    lines = ['', 'Performance probes']
+    for name in sorted(probes):
+        stats = probes[name]
+        lines.append('- %s: median %.0f ms, p95 %.0f ms (%d calls)' % (name, stats['median'], stats['p95'], stats['count']))
+        threshold = probe_thresholds.get(name)
+        if threshold is not None and stats['p95'] > threshold:
+            lines.append('-- WARNING: p95 above the %d ms threshold' % threshold)
+        previous = (baseline or {}).get(name)
+        if previous and stats['median'] > previous['median'] * (1 + regression_tolerance):
+            lines.append('-- WARNING: regression, median was %.0f ms in the baseline' % previous['median'])
+    return lines
+
+def _readBaseline(path):
+    if not os.path.exists(path): return {}
+    try:
+        with open(path, 'r') as f: baseline = json.load(f)
+    except (ValueError, OSError) as e:
+        # e.g. cut short by a full disk; the probes of this run become the new baseline
+        print('WARNING: ignoring the unreadable baseline %s: %s' % (path, e))
+        return {}
+    return baseline if isinstance(baseline, dict) else {}
+
+def loadBaseline(path):
+    with _baselineLock: return _readBaseline(path)
+
+def updateBaseline(path, portalUrl, probes, replace):
+    """Stores the probes of portalUrl as its baseline, unless it has one already and replace is False."""
+    with _baselineLock:
+        baseline = _readBaseline(path)
+        if portalUrl in baseline and not replace: return
+        baseline[portalUrl] = probes
+        if not os.path.isdir(os.path.dirname(path) or '.'): os.makedirs(os.path.dirname(path))
+        atomicfile.writeAtomically(path, lambda f: json.dump(baseline, f, indent=2))
+
+def findHostingServer(federatedServers):
+    hostingServer = None
+    for server in federatedServers:
+        if 'serverRole' in server:
+            serverRole = server['serverRole']
+            if serverRole == 'HOSTING_SERVER': hostingServer = server
+    return hostingServer
+
+def deploymentChecks(portalUrl, token, username=None, password=None, probeCount=0, probeTimeout=None):
+    """The checks of a deployment, as a graph: the portal and its federated servers are queried at the same time,
+    and the hosting server checks start as soon as the hosting server is known. A token is generated from
+    username and password first unless one is given. With a probeCount, performance probes run once the
+    other checks are done, so they don't compete with them; they may take probeTimeout seconds in all (default
+    probe_timeout) and only warn if they fail."""
+    def generate(dependencies, timeout):
+        if token: return token
+        return requestToken(username, password, portalUrl, timeout)
+
+    def hostingServerValidation(dependencies, timeout):
+        hostingServer = findHostingServer(dependencies['federatedServers'])
+        if hostingServer is None: return None
+        return validateHostingServer(portalUrl, hostingServer['id'], dependencies['token'], timeout)
+
+    def relationalDataStore(dependencies, timeout):
+        hostingServer = findHostingServer(dependencies['federatedServers'])
+        if hostingServer is None or not dependencies['hostingServerValidation'][0]: return None
+        return checkArcGISDataStoreRelational(hostingServer['adminUrl'], hostingServer['url'], dependencies['token'], timeout)
+
+    def analysisServices(dependencies, timeout):
+        hostingServer = findHostingServer(dependencies['federatedServers'])
+        if hostingServer is None: return None
+        return checkAnalysisServices(hostingServer['url'], dependencies['token'], timeout)
+
+    def performanceProbes(dependencies, timeout):
+        hostingServer = findHostingServer(dependencies['federatedServers'])
+        return runProbes(portalUrl, hostingServer, dependencies['token'], username, password, probeCount, timeout)
+
+    return [Check('token', generate),
+            Check('portalSelf', lambda dependencies, timeout: getPortalSelf(portalUrl, dependencies['token'], timeout), ['token']),
+            Check('federatedServers', lambda dependencies, timeout: getFederatedServers(portalUrl, dependencies['token'], timeout), ['token']),
+            Check('hostingServerValidation', hostingServerValidation, ['token', 'federatedServers']),
+            Check('relationalDataStore', relationalDataStore, ['token', 'federatedServers', 'hostingServerValidation']),
+            Check('analysisServices', analysisServices, ['token', 'federatedServers'])] + (
+           [Check('performanceProbes', performanceProbes, ['token', 'federatedServers', 'relationalDataStore', 'analysisServices'],
+                  timeout=probeTimeout or probe_timeout, optional=True)] if probeCount else [])
+
+def describeDeployment(portalUrl, results, baseline=None):
+    """Returns the lines of the report on a deployment, from the results of its checks; baseline are the probe
+    results of an earlier run to compare with."""
+    lines = []
+    for name in ('token', 'portalSelf', 'federatedServers'):
+        if results[name].error is not None:
+            if name != 'federatedServers': lines.append('Unable to access ArcGIS Enterprise deployment at ' + portalUrl)
+            lines.append(str(results[name].error))
+            return lines
+
+    portalSelf = results['portalSelf'].value
     supportsHostedServices = portalSelf['supportsHostedServices']
     supportsSceneServices = portalSelf['supportsSceneServices']
 
@@ -54,42 +302,159 @@ def main(argv):
             rasterAnalyticsHelperService = helperServices['rasterAnalytics']['url']
             rasterAnalyticsHelperServiceRegistered = rasterAnalyticsHelperService != ''
 
-    # enumerate federated servers and find hosting server
-    federatedServers = getFederatedServers(portalUrl, token)
-    hostingServer = None
-    for server in federatedServers:
-        if 'serverRole' in server:
-            serverRole = server['serverRole']
-            if serverRole == 'HOSTING_SERVER': hostingServer = server
+    # find the hosting server among the federated servers
+    hostingServer = findHostingServer(results['federatedServers'].value)
 
-    print()
-    print("ArcGIS Enterprise deployment characteristics")
-    print("- Hosting server configured: %s" % (hostingServer is not None))
-    if hostingServer is None: print("-- WARNING: lack of a hosting server will prevent many functions from working")
+    lines.append('')
+    lines.append("ArcGIS Enterprise deployment characteristics")
+    lines.append("- Hosting server configured: %s" % (hostingServer is not None))
+    if hostingServer is None: lines.append("-- WARNING: lack of a hosting server will prevent many functions from working")
     else:
-        hostingServerValid, validationMsgs = validateHostingServer(portalUrl, hostingServer['id'], token)
-        if not hostingServerValid: print('-- ERROR: unable to validate hosting server')
-        for msg in validationMsgs: print('-- ' + msg)
+        hostingServerValid, validationMsgs = results['hostingServerValidation'].value or (False, [])
+        if not hostingServerValid: lines.append('-- ERROR: unable to validate hosting server')
+        for msg in validationMsgs: lines.append('-- ' + msg)
 
         if hostingServerValid:
-            hasRelationalDataStore = checkArcGISDataStoreRelational(hostingServer['adminUrl'], hostingServer['url'], token)
-            print("- ArcGIS Data Store (relational) configured with hosting server: %s" % hasRelationalDataStore)
-            if not hasRelationalDataStore: print("-- WARNING: you must use ArcGIS Data Store to configure a relational database")
+            hasRelationalDataStore, dataStoreMsgs = results['relationalDataStore'].value or (False, [])
+            lines.append("- ArcGIS Data Store (relational) configured with hosting server: %s" % hasRelationalDataStore)
+            lines.extend(dataStoreMsgs)
+            if not hasRelationalDataStore: lines.append("-- WARNING: you must use ArcGIS Data Store to configure a relational database")
+
+            lines.append('- Analysis Tools helper service is configured: %s' % analysisHelperServiceRegistered)
+            if not analysisHelperServiceRegistered: lines.append('-- WARNING: analysis tools helper service not configured')
+
+            analysisServiceStarted = bool(results['analysisServices'].value)
+            lines.append("- Hosting server's spatial analysis service is started and available: %s" % analysisServiceStarted)
+            if not analysisServiceStarted: lines.append("-- WARNING: analysis service not started or unreachable")
+
+            lines.append("- Hosted feature services are supported: %s" % supportsHostedServices)
+            if not supportsHostedServices: lines.append("-- WARNING: this indicates a lack of ArcGIS Data Store configured with the relational data store type")
+            lines.append("- Scene services are supported: %s" % supportsSceneServices)
+            if not supportsSceneServices: lines.append("-- WARNING: this indicates a lack of ArcGIS Data Store (tile cache)")
+
+            lines.append('- GeoAnalytics configured: %s' % geoanalyticsHelperServiceRegistered)
+            lines.append('- Raster Analytics configured: %s' % rasterAnalyticsHelperServiceRegistered)
+
+    if 'performanceProbes' in results and results['performanceProbes'].value:
+        lines.extend(describeProbes(results['performanceProbes'].value, baseline))
+    elif 'performanceProbes' in results and results['performanceProbes'].warning is not None:
+        lines.append('')
+        lines.append('-- WARNING: performance probes did not complete: %s' % results['performanceProbes'].warning)
 
-            print('- Analysis Tools helper service is configured: %s' % analysisHelperServiceRegistered)
-            if not analysisHelperServiceRegistered: print('-- WARNING: analysis tools helper service not configured')
+    return lines
+
+def deploymentStatus(results, lines):
+    """'failed' if a check failed or the report has errors, 'warning' if it has warnings, 'passed' otherwise."""
+    if any(result.error is not None for result in results.values()) or any(line.startswith('-- ERROR') for line in lines): return 'failed'
+    if any(line.startswith('-- WARNING') for line in lines): return 'warning'
+    return 'passed'
+
+def main(argv):
+    parameters = parseInputParameters(argv)
+    timeout = parameters['timeout']
+    if parameters['inventory']:
+        records = validateFleet(loadInventory(parameters['inventory']), timeout, parameters['workers'], parameters['outputDir'], parameters['format'],
+                                parameters['probes'], parameters['baseline'], parameters['updateBaseline'], parameters['probeTimeout'])
+        return 1 if any(record['status'] == 'failed' for record in records) else 0
+
+    portalUrl = parameters['portalUrl']
+    token = parameters['token']
 
-            analysisServiceStarted = checkAnalysisServices(hostingServer['url'], token)
-            print("- Hosting server's spatial analysis service is started and available: %s" % analysisServiceStarted)
-            if not analysisServiceStarted: print("-- WARNING: analysis service not started or unreachable")
+    if token == '':
+        adminUsername = parameters['adminUsername']
+        adminPassword = parameters['adminPassword']
+        token = generateToken(adminUsername, adminPassword, portalUrl, timeout)
+        if token == 'Failed':
+            print('Invalid administrator username or password.')
+            sys.exit(1)
 
-            print("- Hosted feature services are supported: %s" % supportsHostedServices)
-            if not supportsHostedServices: print("-- WARNING: this indicates a lack of ArcGIS Data Store configured with the relational data store type")
-            print("- Scene services are supported: %s" % supportsSceneServices)
-            if not supportsSceneServices: print("-- WARNING: this indicates a lack of ArcGIS Data Store (tile cache)")
+    checks = deploymentChecks(portalUrl, token, parameters['adminUsername'], parameters['adminPassword'], parameters['probes'], parameters['probeTimeout'])
+    results = runChecks(checks, timeout)
+
+    baseline = loadBaseline(parameters['baseline']).get(portalUrl)
+    for line in describeDeployment(portalUrl, results, baseline): print(line)
+    printCheckTimings(checks, results)
+    if 'performanceProbes' in results and results['performanceProbes'].value:
+        updateBaseline(parameters['baseline'], portalUrl, results['performanceProbes'].value, parameters['updateBaseline'])
+    if results['portalSelf'].error is not None or results['federatedServers'].error is not None: sys.exit(1)
+
+def loadInventory(path):
+    """Reads a JSON list of deployments, each with a url (e.g. https://portal.example.com/arcgis) and a token or a
+    username with a password or passwordEnv, the environment variable holding it; name is optional."""
+    with open(path, 'r') as f: inventory = json.load(f)
+    for entry in inventory:
+        if 'passwordEnv' in entry: entry['password'] = os.environ.get(entry['passwordEnv'], '')
+        if not entry.get('name'):
+            parsed = urllib.parse.urlparse(entry['url'])
+            entry['name'] = (parsed.netloc + parsed.path.rstrip('/')).replace('/', '_').replace(':', '_')
+    return inventory
+
+def validateDeployment(entry, timeout=None, probeCount=0, baselinePath=baseline_file, replaceBaseline=False, probeTimeout=None):
+    """Runs all checks of one inventory entry and returns its record: name, url, status, elapsed seconds, the
+    result of every check and probe and the report lines."""
+    started = time.time()
+    portalUrl = entry['url'].rstrip('/')
+    checks = deploymentChecks(portalUrl, entry.get('token'), entry.get('username'), entry.get('password'), probeCount, probeTimeout)
+    results = runChecks(checks, timeout)
+    lines = describeDeployment(entry['url'], results, loadBaseline(baselinePath).get(portalUrl))
+    probes = results['performanceProbes'].value if 'performanceProbes' in results else None
+    if probes: updateBaseline(baselinePath, portalUrl, probes, replaceBaseline)
+    checkRecords = []
+    for check in checks:
+        result = results[check.name]
+        checkRecords.append({'name':check.name, 'elapsed':result.elapsed, 'skipped':result.skipped,
+                             'error':None if result.error is None else str(result.error),
+                             'warning':None if result.warning is None else str(result.warning)})
+    return {'name':entry['name'], 'url':entry['url'], 'status':deploymentStatus(results, lines),
+            'elapsed':time.time() - started, 'checks':checkRecords, 'probes':probes, 'report':lines}
+
+def _validateOrRecordFailure(entry, *args):
+    # an unexpected error validating one deployment fails that deployment only, the rest of the fleet carries on
+    started = time.time()
+    try: return validateDeployment(entry, *args)
+    except Exception as e:
+        error = '%s: %s' % (type(e).__name__, e)
+        elapsed = time.time() - started
+        return {'name':entry['name'], 'url':entry['url'], 'status':'failed', 'elapsed':elapsed,
+                'checks':[{'name':'validation', 'elapsed':elapsed, 'skipped':False, 'error':error, 'warning':None}], 'probes':None,
+                'report':['Unable to validate ArcGIS Enterprise deployment at ' + entry['url'], error]}
+
+def writeJUnit(path, record):
+    # one test suite per deployment and a test case per check; the report is attached as system-out
+    suite = xml.etree.ElementTree.Element('testsuite', name=record['name'], tests=str(len(record['checks'])), time='%.3f' % record['elapsed'],
+                                          failures=str(sum(1 for check in record['checks'] if check['error'] is not None)),
+                                          skipped=str(sum(1 for check in record['checks'] if check['skipped'] and check['error'] is None)))
+    for check in record['checks']:
+        case = xml.etree.ElementTree.SubElement(suite, 'testcase', classname=record['name'], name=check['name'], time='%.3f' % check['elapsed'])
+        if check['error'] is not None: xml.etree.ElementTree.SubElement(case, 'failure', message=check['error'])
+        elif check['skipped']: xml.etree.ElementTree.SubElement(case, 'skipped')
+        if check.get('warning') is not None: xml.etree.ElementTree.SubElement(case, 'system-out').text = 'WARNING: ' + check['warning']
+    xml.etree.ElementTree.SubElement(suite, 'system-out').text = '\n'.join(record['report'])
+    xml.etree.ElementTree.ElementTree(suite).write(path, encoding='utf-8', xml_declaration=True)
+
+def validateFleet(inventory, timeout, workerCount, outputDir, outputFormat, probeCount=0, baselinePath=baseline_file, replaceBaseline=False, probeTimeout=None):
+    """Validates every deployment of the inventory with up to workerCount at a time, writes a result file per
+    deployment to outputDir (if given) and prints a summary; returns the records."""
+    if outputDir and not os.path.isdir(outputDir): os.makedirs(outputDir)
+    records = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workerCount) as executor:
+        futures = [executor.submit(_validateOrRecordFailure, entry, timeout, probeCount, baselinePath, replaceBaseline, probeTimeout) for entry in inventory]
+        for future in concurrent.futures.as_completed(futures):
+            record = future.result()
+            records.append(record)
+            print('%s: %s (%.1f s)' % (record['name'], record['status'], record['elapsed']))
+            if outputDir:
+                path = os.path.join(outputDir, record['name'] + ('.xml' if outputFormat == 'junit' else '.json'))
+                if outputFormat == 'junit': writeJUnit(path, record)
+                else:
+                    with open(path, 'w') as f: json.dump(record, f, indent=2)
 
-            print('- GeoAnalytics configured: %s' % geoanalyticsHelperServiceRegistered)
-            print('- Raster Analytics configured: %s' % rasterAnalyticsHelperServiceRegistered)
+    print()
+    print('%-40s %-8s %-40s %8s' % ('Deployment', 'Status', 'Failed checks', 'Time (s)'))
+    for record in sorted(records, key=lambda record: record['name']):
+        failedChecks = ', '.join(check['name'] for check in record['checks'] if check['error'] is not None)
+        print('%-40s %-8s %-40s %8.1f' % (record['name'], record['status'], failedChecks or '-', record['elapsed']))
+    return records
 
 def parseInputParameters(argv):
     currentHost = socket.getfqdn().lower()
@@ -100,12 +465,22 @@ def parseInputParameters(argv):
     adminPassword = ''
     outputDir = ''
     token = ''
+    timeout = check_timeout
+    inventory = ''
+    workers = fleet_worker_count
+    outputFormat = 'json'
+    probes = probe_count
+    probeTimeout = probe_timeout
+    baseline = baseline_file
+    replaceBaseline = False
     if len(sys.argv) > 0:
         try:
-            opts, args = getopt.getopt(argv, "?hn:c:u:p:t:", ("help", "portalurl=", "context=", "user=", "password=", "token=", "ignoressl"))
+            opts, args = getopt.getopt(argv, "?hn:c:u:p:t:", ("help", "portalurl=", "context=", "user=", "password=", "token=", "ignoressl", "timeout=", "inventory=", "workers=", "output=", "format=", "probes=", "probe-timeout=", "baseline=", "update-baseline"))
         except:
             print('One or more invalid arguments')
-            print('validatebasedeployment.py [-n <portal hostname>] [-c <portal context>] [-u <admin username>] [-p <admin password>] [-t <token>]')
+            print('validatebasedeployment.py [-n <portal hostname>] [-c <portal context>] [-u <admin username>] [-p <admin password>] [-t <token>] [--timeout <seconds per check>]')
+            print('validatebasedeployment.py --inventory <deployments.json> [--workers <count>] [--output <folder>] [--format json|junit] [--timeout <seconds per check>]')
+            print('    [--probes <timed calls per probe, e.g. 5; off by default>] [--probe-timeout <seconds for all probes>] [--baseline <file>] [--update-baseline]')
             sys.exit(2)
 
         for opt, arg in opts:
@@ -124,10 +499,35 @@ def parseInputParameters(argv):
                 ssl._create_default_https_context = _create_unverified_https_context
             elif opt in ('-t', '--token'):
                 token = arg
+            elif opt == '--timeout':
+                timeout = float(arg)
+            elif opt == '--inventory':
+                inventory = arg
+            elif opt == '--workers':
+                workers = int(arg)
+            elif opt == '--output':
+                outputDir = arg
+            elif opt == '--format':
+                outputFormat = arg
+            elif opt == '--probes':
+                probes = int(arg)
+            elif opt == '--probe-timeout':
+                probeTimeout = float(arg)
+            elif opt == '--baseline':
+                baseline = arg
+            elif opt == '--update-baseline':
+                replaceBaseline = True
             elif opt in ('-h', '-?', '--help'):
-                print('validatebasedeployment.py [-n <portal hostname>] [-c <portal context>] [-u <admin username>] [-p <admin password>] [-t <token>]')
+                print('validatebasedeployment.py [-n <portal hostname>] [-c <portal context>] [-u <admin username>] [-p <admin password>] [-t <token>] [--timeout <seconds per check>]')
+                print('validatebasedeployment.py --inventory <deployments.json> [--workers <count>] [--output <folder>] [--format json|junit] [--timeout <seconds per check>]')
+                print('    [--probes <timed calls per probe, e.g. 5; off by default>] [--probe-timeout <seconds for all probes>] [--baseline <file>] [--update-baseline]')
                 sys.exit(0)
 
+    # Fleet mode takes the deployments and their credentials from the inventory
+    if inventory != '':
+        return {'inventory':inventory, 'workers':workers, 'outputDir':outputDir, 'format':outputFormat, 'timeout':timeout,
+                'probes':probes, 'probeTimeout':probeTimeout, 'baseline':baseline, 'updateBaseline':replaceBaseline}
+
     # Prompt for portal hostname
     if portalHost == '':
         portalHost = input('Enter ArcGIS Enterprise FQDN [' + currentHost + ']: ')
@@ -149,95 +549,95 @@ def parseInputParameters(argv):
             adminPassword = getpass.getpass(prompt='Enter administrator password: ')
 
     portalUrl = 'https://' + portalHost + '/' + context
-    parameters = {'adminPassword':adminPassword, 'adminUsername':adminUsername, 'portalUrl':portalUrl, 'token':token}
+    parameters = {'adminPassword':adminPassword, 'adminUsername':adminUsername, 'portalUrl':portalUrl, 'token':token, 'timeout':timeout, 'inventory':'',
+                  'probes':probes, 'probeTimeout':probeTimeout, 'baseline':baseline, 'updateBaseline':replaceBaseline}
     return parameters
 
-def validateHostingServer(portalUrl, hostingServerID, token):
+def validateHostingServer(portalUrl, hostingServerID, token, timeout=None):
     params = {'token':token, 'f':'pjson', 'types':'egdb'}
-    request = urllib.request.Request(portalUrl + '/portaladmin/federation/servers/' + hostingServerID + '/validate?' + urllib.parse.urlencode(params))
+    msgs = []
     try:
-        response = urllib.request.urlopen(request)
-        result = json.loads(response.read().decode('utf-8'))
-        msgs = []
+        result = httpclient.get(portalUrl + '/portaladmin/federation/servers/' + hostingServerID + '/validate', params, timeout).json()
         if 'messages' in result: msgs = result['messages']
         if 'status' in result and result['status'] == 'success': return True, msgs
     except: pass
     return False, msgs
 
-def checkArcGISDataStoreRelational(serverAdminUrl, serverUrl, portalToken):
+def checkArcGISDataStoreRelational(serverAdminUrl, serverUrl, portalToken, timeout=None):
+    # returns whether the managed database is ArcGIS Data Store and the warnings to print under it
     params = {'token':portalToken, 'f':'pjson', 'types':'egdb'}
-    request = urllib.request.Request(serverAdminUrl + '/admin/data/findItems', urllib.parse.urlencode(params).encode('ascii'))
-    try: response = urllib.request.urlopen(request)
+    msgs = []
+    try:
+        response = httpclient.post(serverAdminUrl + '/admin/data/findItems', params, timeout)
+        if response.status != 200: raise Exception('HTTP %s' % response.status)
     except:
-        request = urllib.request.Request(serverUrl + '/admin/data/findItems', urllib.parse.urlencode(params).encode('ascii'))
         try:
-            response = urllib.request.urlopen(request)
-            print('-- WARNING: hosting server administrative endpoint not')
-            print('            accessible from this machine; this may cause')
-            print('            publishing issues from ArcGIS Pro')
+            response = httpclient.post(serverUrl + '/admin/data/findItems', params, timeout)
+            if response.status != 200: raise Exception('HTTP %s' % response.status)
+            msgs.append('-- WARNING: hosting server administrative endpoint not')
+            msgs.append('            accessible from this machine; this may cause')
+            msgs.append('            publishing issues from ArcGIS Pro')
         except:
-            print('-- ERROR: unable to reach hosting server administrative endpoint')
-            print('          maybe the administrative endpoint is only accessible internally?')
-    egdbs = json.loads(response.read().decode('utf-8'))
-    if 'error' in egdbs: return False
+            msgs.append('-- ERROR: unable to reach hosting server administrative endpoint')
+            msgs.append('          maybe the administrative endpoint is only accessible internally?')
+            return False, msgs
+    egdbs = response.json()
+    if 'error' in egdbs: return False, msgs
     else:
         managedegdb = None
         for egdb in egdbs['items']:
             if egdb['info']['isManaged']: managedegdb = egdb
-        if managedegdb is None: return False
-        return managedegdb['provider'] == 'ArcGIS Data Store'
+        if managedegdb is None: return False, msgs
+        return managedegdb['provider'] == 'ArcGIS Data Store', msgs
 
-def checkAnalysisServices(serverUrl, portalToken):
+def checkAnalysisServices(serverUrl, portalToken, timeout=None):
     params = {'token':portalToken, 'f':'json'}
-    request = urllib.request.Request(serverUrl + '/rest/services/System/SpatialAnalysisTools/GPServer?%s' % urllib.parse.urlencode(params))
     try:
-        response = urllib.request.urlopen(request)
-        serviceInfo = json.loads(response.read().decode('utf-8'))
+        serviceInfo = httpclient.get(serverUrl + '/rest/services/System/SpatialAnalysisTools/GPServer', params, timeout).json()
         if 'error' in serviceInfo: return False
         else: return True
     except:
         return False
 
-def getFederatedServers(portalUrl, token):
+def getFederatedServers(portalUrl, token, timeout=None):
     params = {'token':token, 'f':'json'}
-    request = urllib.request.Request(portalUrl + '/portaladmin/federation/servers?%s' % urllib.parse.urlencode(params))
-    response = urllib.request.urlopen(request)
-    federatedServers = json.loads(response.read().decode('utf-8'))
+    federatedServers = httpclient.get(portalUrl + '/portaladmin/federation/servers', params, timeout).json()
     if 'servers' not in federatedServers:
-        print('Unable to enumerate federated servers. Not an administrator login?')
-        sys.exit(1)
+        raise Exception('Unable to enumerate federated servers. Not an administrator login?')
 
     return federatedServers['servers']
 
-def getPortalSelf(portalUrl, token):
+def getPortalSelf(portalUrl, token, timeout=None):
     params = {'token':token, 'f':'json'}
-    request = urllib.request.Request(portalUrl + '/sharing/portals/self',
-                                     urllib.parse.urlencode(params).encode('ascii'))
-    response = urllib.request.urlopen(request)
-    portalSelf = json.loads(response.read().decode('utf-8'))
+    portalSelf = httpclient.post(portalUrl + '/sharing/portals/self', params, timeout).json()
+    if 'error' in portalSelf:
+        raise Exception('Unable to read the portal properties: %s' % portalSelf['error'].get('message', portalSelf['error']))
+
     return portalSelf
 
-def generateToken(username, password, portalUrl):
+def requestToken(username, password, portalUrl, timeout=None):
     params = {'username':username,
               'password':password,
               'referer':portalUrl,
               'f':'json'}
+    genToken = httpclient.post(portalUrl + '/sharing/rest/generateToken', params, timeout).json()
+    if 'token' not in genToken: raise InvalidLoginError('Invalid administrator username or password.')
+    return genToken['token']
+
+def generateToken(username, password, portalUrl, timeout=None):
+    # requestToken for interactive runs: connection problems are explained and end the script
     try:
-        request = urllib.request.Request(portalUrl + '/sharing/rest/generateToken',
-                                         urllib.parse.urlencode(params).encode('ascii'))
-        response = urllib.request.urlopen(request)
-        genToken = json.loads(response.read().decode('utf-8'))
-        if 'token' in genToken.keys():
-            return genToken.get('token')
-        else:
-            return 'Failed'
-    except urllib.error.URLError as urlError:
+        return requestToken(username, password, portalUrl, timeout)
+    except InvalidLoginError:
+        return 'Failed'
+    except ssl.SSLError:
+        print('Unable to access ArcGIS Enterprise deployment at ' + portalUrl)
+        print("SSL certificate validation error. Maybe you're using a self-signed certificate?")
+        print("Pass the --ignoressl parameter to disable certificate validation")
+        sys.exit(1)
+    except OSError as connectionError:
         print('Unable to access ArcGIS Enterprise deployment at ' + portalUrl)
-        if isinstance(urlError.reason, ssl.SSLError):
-            print("SSL certificate validation error. Maybe you're using a self-signed certificate?")
-            print("Pass the --ignoressl parameter to disable certificate validation")
-        else:
-            print(urlError.reason)
+        print(connectionError)
         sys.exit(1)
     except Exception as ex:
         print('Unable to access ArcGIS Enterprise deployment at ' + portalUrl)
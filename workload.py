@@ -0,0 +1,148 @@
+"""Randomized, reproducible map-viewer workloads for BurstOfHttpRequests.
+
+Replaying a fixed URL file mostly measures how fast the server returns
+responses it has already cached. This module simulates people using a web
+map instead: each simulated session starts at a random place and zoom level
+inside an extent, then pans around nearby, zooms in and out, or jumps
+somewhere else. Every view it produces turns into the requests a viewer would
+send for the configured services:
+
+- "tile":   every cached tile (REST tile/{level}/{row}/{col}) covering the view
+- "export": one MapServer/export image of the view
+- "query":  one feature service layer query for the features in the view
+
+Requests are generated lazily, so a run of any length keeps memory flat, and
+the same seed always produces the same stream. A workload is described in a
+JSON file, e.g.:
+
+    {
+      "seed": 42,
+      "extent": { "xmin": -13650000, "ymin": 4520000, "xmax": -13580000, "ymax": 4600000, "wkid": 3857 },
+      "zoomLevels": { "12": 1, "13": 2, "14": 4, "15": 4, "16": 2, "17": 1 },
+      "viewSizes": [ [1280, 720], [1920, 1080], [390, 844] ],
+      "panProbability": 0.7,
+      "zoomProbability": 0.2,
+      "services": [
+        { "type": "tile", "url": "https://gis.example.com/arcgis/rest/services/Basemap/MapServer" },
+        { "type": "export", "url": "https://gis.example.com/arcgis/rest/services/Parcels/MapServer" },
+        { "type": "query", "url": "https://gis.example.com/arcgis/rest/services/Hydrants/FeatureServer/0" }
+      ]
+    }
+
+zoomLevels maps tile levels to relative weights for where sessions start.
+Levels use the tiling scheme given by tileOrigin, resolution0 (resolution at
+level 0) and tileSize, which default to the ArcGIS Online/Web Mercator
+scheme. "count" optionally limits the number of requests generated; without
+it the stream never ends and the load test needs a duration. Works with both
+Python 2.7 and Python 3."""
+
+import json
+import random
+
+try: from urllib.parse import urlencode
+except ImportError: from urllib import urlencode
+
+webMercatorOrigin = (-20037508.342787, 20037508.342787)
+webMercatorResolution0 = 156543.03392800014
+
+def loadWorkload(path):
+    with open(path, 'r') as f: return json.load(f)
+
+def _weightedChoice(rnd, weights):
+    # weights is a list of (value, weight) pairs
+    target = rnd.uniform(0, sum(weight for value, weight in weights))
+    for value, weight in weights:
+        target -= weight
+        if target <= 0: return value
+    return weights[-1][0]
+
+def _serviceName(url):
+    # e.g. .../rest/services/Folder/Parcels/MapServer -> Folder/Parcels/MapServer
+    parts = url.rstrip('/').split('/rest/services/')
+    return parts[-1]
+
+class _Viewer(object):
+    """Moves a simulated map view around the extent the way a person panning and zooming would."""
+    def __init__(self, config, rnd):
+        self.rnd = rnd
+        self.extent = config['extent']
+        self.levels = sorted((int(level), float(weight)) for level, weight in config['zoomLevels'].items())
+        self.minLevel = self.levels[0][0]
+        self.maxLevel = self.levels[-1][0]
+        self.viewSizes = config.get('viewSizes', [[1280, 720]])
+        self.panProbability = config.get('panProbability', 0.7)
+        self.zoomProbability = config.get('zoomProbability', 0.2)
+        self.resolution0 = config.get('resolution0', webMercatorResolution0)
+        self.newSession()
+
+    def resolution(self):
+        return self.resolution0 / (2 ** self.level)
+
+    def newSession(self):
+        self.x = self.rnd.uniform(self.extent['xmin'], self.extent['xmax'])
+        self.y = self.rnd.uniform(self.extent['ymin'], self.extent['ymax'])
+        self.level = _weightedChoice(self.rnd, self.levels)
+        self.width, self.height = self.rnd.choice(self.viewSizes)
+
+    def move(self):
+        r = self.rnd.random()
+        if r < self.panProbability:
+            # pan by up to one view width/height; most pans are small, so neighbouring tiles get reused
+            self.x += self.rnd.triangular(-1, 1, 0) * self.width * self.resolution()
+            self.y += self.rnd.triangular(-1, 1, 0) * self.height * self.resolution()
+            self.x = min(max(self.x, self.extent['xmin']), self.extent['xmax'])
+            self.y = min(max(self.y, self.extent['ymin']), self.extent['ymax'])
+        elif r < self.panProbability + self.zoomProbability:
+            self.level = min(max(self.level + self.rnd.choice((-1, 1)), self.minLevel), self.maxLevel)
+        else:
+            self.newSession() # somebody else opens the map
+
+    def bbox(self):
+        halfWidth = self.width * self.resolution() / 2.0
+        halfHeight = self.height * self.resolution() / 2.0
+        return (self.x - halfWidth, self.y - halfHeight, self.x + halfWidth, self.y + halfHeight)
+
+def _viewRequests(config, viewer):
+    wkid = config['extent'].get('wkid', 3857)
+    originX, originY = config.get('tileOrigin', webMercatorOrigin)
+    tileSize = config.get('tileSize', 256)
+    xmin, ymin, xmax, ymax = viewer.bbox()
+    bbox = '{0:.2f},{1:.2f},{2:.2f},{3:.2f}'.format(xmin, ymin, xmax, ymax)
+
+    for service in config['services']:
+        url = service['url'].rstrip('/')
+        label = '{0} {1} L{2}'.format(_serviceName(url), service['type'], viewer.level)
+        if service['type'] == 'tile':
+            tileSpan = tileSize * viewer.resolution()
+            for row in range(int((originY - ymax) // tileSpan), int((originY - ymin) // tileSpan) + 1):
+                for col in range(int((xmin - originX) // tileSpan), int((xmax - originX) // tileSpan) + 1):
+                    yield (label, '{0}/tile/{1}/{2}/{3}'.format(url, viewer.level, row, col), None)
+        elif service['type'] == 'export':
+            params = { 'bbox' : bbox, 'bboxSR' : wkid, 'imageSR' : wkid, 'size' : '{0},{1}'.format(viewer.width, viewer.height),
+                       'format' : service.get('format', 'png32'), 'transparent' : 'true', 'dpi' : 96, 'f' : 'image' }
+            yield (label, '{0}/export?{1}'.format(url, urlencode(sorted(params.items()))), None)
+        elif service['type'] == 'query':
+            # generalize geometries to the view's pixel size, like the ArcGIS web clients do
+            params = { 'geometry' : bbox, 'geometryType' : 'esriGeometryEnvelope', 'inSR' : wkid, 'outSR' : wkid,
+                       'spatialRel' : 'esriSpatialRelIntersects', 'where' : service.get('where', '1=1'),
+                       'outFields' : service.get('outFields', '*'), 'returnGeometry' : 'true',
+                       'maxAllowableOffset' : '{0:.4f}'.format(viewer.resolution()), 'f' : 'json' }
+            yield (label, '{0}/query?{1}'.format(url, urlencode(sorted(params.items()))), None)
+        else:
+            raise ValueError('Unknown service type {0}'.format(service['type']))
+
+def generateRequests(config, index=0, count=1):
+    """Yields (label, url, body) requests for worker index of count; each worker gets its own
+    reproducible stream derived from the workload's seed, and its share of the request count."""
+    rnd = random.Random(config.get('seed', 0) * 1000003 + index)
+    remaining = config.get('count')
+    if remaining is not None: remaining = remaining // count + (1 if index < remaining % count else 0)
+
+    viewer = _Viewer(config, rnd)
+    while True:
+        for request in _viewRequests(config, viewer):
+            if remaining is not None:
+                if remaining <= 0: return
+                remaining -= 1
+            yield request
+        viewer.move()